@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+import grpc
+import marketplace_pb2
+import marketplace_pb2_grpc
+from market_server import SEARCH_ITEMS, SERVER_OPTIONS, SNAPSHOT_INTERVAL, MarketplaceService
+from replication import REPLICATION_HEARTBEAT, ReplicaSink, encode_records
+from metrics import AsyncMetricsInterceptor, RpcMetrics
+from search_cache import AsyncSerializedResponseInterceptor
+from server_logging import setup_logging
+
+log = logging.getLogger("market_server")
+
+class LoopQueue:
+    '''
+    Adapts an asyncio.Queue to the put() interface MarketplaceService pushes notifications to.
+    Safe to call from any thread.
+    '''
+    def __init__(self, loop, q):
+        self.loop = loop
+        self.q = q
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.q.put_nowait, message)
+
+    def qsize(self):
+        return self.q.qsize()  # Approximate when called off the loop, which is all ReplicaSink needs
+
+class AsyncMarketplaceService(marketplace_pb2_grpc.MarketplaceServicer):
+    '''
+    asyncio front end for MarketplaceService, served by grpc.aio.
+    Unary handlers run the shared implementation inline on the event loop, since
+    none of them block, and notification streams wait on asyncio queues rather
+    than holding a thread each.
+    '''
+    def __init__(self, service=None):
+        self.service = service or MarketplaceService()
+
+    async def committed(self, response):
+        '''
+        Return response once the changes just logged on this thread are durable, without blocking the loop.
+        '''
+        wal = self.service.wal
+        if wal is not None:
+            await wal.wait_async(wal.last_lsn())
+        return response
+
+    async def RegisterSeller(self, request, context):
+        return await self.committed(self.service.RegisterSeller(request, context))
+
+    async def AddItem(self, request, context):
+        return await self.committed(self.service.AddItem(request, context))
+
+    async def BulkAddItems(self, request, context):
+        return await self.committed(self.service.BulkAddItems(request, context))
+
+    async def UpdateItem(self, request, context):
+        return await self.committed(self.service.UpdateItem(request, context))
+
+    async def BulkUpdateItems(self, request, context):
+        return await self.committed(self.service.BulkUpdateItems(request, context))
+
+    async def DeleteItem(self, request, context):
+        return await self.committed(self.service.DeleteItem(request, context))
+
+    async def DisplaySellerItems(self, request, context):
+        return self.service.DisplaySellerItems(request, context)
+
+    async def SearchItems(self, request, context):
+        return self.service.SearchItems(request, context)
+
+    async def serialized_search(self, request, context):
+        return self.service.serialized_search(request, context)
+
+    async def StreamSearchItems(self, request, context):
+        for response in self.service.StreamSearchItems(request, context):
+            yield response
+
+    async def BuyItem(self, request, context):
+        return await self.committed(self.service.BuyItem(request, context))
+
+    async def BuyItems(self, request, context):
+        return await self.committed(self.service.BuyItems(request, context))
+
+    async def AddToWishList(self, request, context):
+        return await self.committed(self.service.AddToWishList(request, context))
+
+    async def RemoveFromWishList(self, request, context):
+        return await self.committed(self.service.RemoveFromWishList(request, context))
+
+    async def GetWishList(self, request, context):
+        return self.service.GetWishList(request, context)
+
+    async def RateItem(self, request, context):
+        return await self.committed(self.service.RateItem(request, context))
+
+    async def FetchNotifications(self, request, context):
+        return self.service.FetchNotifications(request, context)
+
+    async def FetchSellerNotifications(self, request, context):
+        return self.service.FetchSellerNotifications(request, context)
+
+    async def GetStats(self, request, context):
+        return self.service.GetStats(request, context)
+
+    async def GetNotificationStats(self, request, context):
+        return self.service.GetNotificationStats(request, context)
+
+    async def SubscribeNotifications(self, request, context):
+        '''
+        Stream notifications to a seller (by uuid) or buyer (by buyer_address).
+        The handler is cancelled when the client goes away, which unregisters the queue.
+        '''
+        q = asyncio.Queue()
+        sink = LoopQueue(asyncio.get_running_loop(), q)
+        key, backlog = self.service.open_subscription(request, sink)
+        try:
+            if backlog:
+                yield marketplace_pb2.NotificationResponse(messages=[notification.text for notification in backlog])
+            while True:
+                messages = [(await q.get()).text]
+                # Send anything else that arrived meanwhile in the same response
+                while not q.empty():
+                    messages.append(q.get_nowait().text)
+                yield marketplace_pb2.NotificationResponse(messages=messages)
+        finally:
+            self.service.close_subscription(key, sink)
+
+    async def Replicate(self, request, context):
+        '''
+        Stream the catalog to a read replica, waiting on an asyncio queue (see MarketplaceService.Replicate).
+        '''
+        q = asyncio.Queue()
+        sink = ReplicaSink(LoopQueue(asyncio.get_running_loop(), q))
+        as_of = time.time()
+        snapshot = self.service.open_replication(sink)
+        log.info("Replica %s connected", context.peer())
+        try:
+            yield marketplace_pb2.ReplicationBatch(snapshot=snapshot, as_of=as_of)
+            while True:
+                try:
+                    records = await asyncio.wait_for(q.get(), REPLICATION_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield marketplace_pb2.ReplicationBatch(as_of=time.time())
+                    continue
+                batches = []
+                while records is not None:
+                    batches.append(records)
+                    as_of = time.time()
+                    if q.empty():
+                        break
+                    records = q.get_nowait()
+                if batches:
+                    yield marketplace_pb2.ReplicationBatch(records=encode_records(batches), as_of=as_of)
+                if records is None:
+                    log.warning("Replica %s fell too far behind and was disconnected", context.peer())
+                    break
+        finally:
+            self.service.replicas.unsubscribe(sink)
+
+async def serve_async(port=50051, data_dir=None, snapshot_interval=SNAPSHOT_INTERVAL, shard_index=0, shard_count=1):
+    '''
+    Start the server on the running asyncio event loop.
+    '''
+    service = MarketplaceService(data_dir, snapshot_interval, wait_for_commit=False,
+                                 shard_index=shard_index, shard_count=shard_count)
+    service.metrics = RpcMetrics()
+    servicer = AsyncMarketplaceService(service)
+    interceptors = [AsyncMetricsInterceptor(service.metrics),
+                    AsyncSerializedResponseInterceptor({SEARCH_ITEMS: servicer.serialized_search})]
+    server = grpc.aio.server(interceptors=interceptors, options=SERVER_OPTIONS)
+    marketplace_pb2_grpc.add_MarketplaceServicer_to_server(servicer, server)
+    server.add_insecure_port(f'[::]:{port}')
+    log.info("Market Server (asyncio) started. Listening on port %s.", port)
+    await server.start()
+    await server.wait_for_termination()
+
+if __name__ == '__main__':
+    setup_logging()
+    asyncio.run(serve_async())
@@ -3,25 +3,28 @@ import time
 import grpc
 import uuid
 import marketplace_pb2
-import marketplace_pb2_grpc
+from market_client import DEFAULT_TIMEOUT, MarketClient
 
 SERVER_ADDRESS = "10.190.0.2:50051"
 SELLER_ADDRESS = "10.190.0.4" 
+REPLICA_ADDRESSES = []  # Read replicas to send searches to, e.g. ["10.190.0.5:50051"]
+BATCH_SIZE = 1000  # Orders sent per BuyItems RPC
 
-class BuyerClient:
-    def __init__(self, address):
+class BuyerClient(MarketClient):
+    def __init__(self, address, pool=None, timeout=DEFAULT_TIMEOUT, replicas=()):
         '''
         Client for the buyer to interact with the marketplace.
         '''
-        self.channel = grpc.insecure_channel(address)
-        self.stub = marketplace_pb2_grpc.MarketplaceStub(self.channel)
+        super().__init__(address, pool, timeout, replicas)
         self.uuid = str(uuid.uuid4())
         self.buyer_address = f"{SELLER_ADDRESS}:{self.uuid[:8]}"  # Mock IP:Port with UUID
 
-    def search_items(self, name="", category=marketplace_pb2.ANY):
-        """Search for items by name and category."""
+    def search_items(self, name="", category=marketplace_pb2.ANY, sort_by=marketplace_pb2.ID, limit=0, **filters):
+        """Search for items by name and category, e.g. the 10 cheapest with sort_by=PRICE, limit=10.
+        filters are the SearchRequest range bounds: min_price, max_price, min_rating and max_rating."""
         try:
-            response = self.stub.SearchItems(marketplace_pb2.SearchRequest(name=name, category=category))
+            response = self.call("SearchItems", marketplace_pb2.SearchRequest(
+                name=name, category=category, sort_by=sort_by, limit=limit, **filters))
             print("Search Results:")
             for item in response.items:
                 rating = item.rating if item.rating != -1 else "UNRATED"
@@ -30,28 +33,89 @@ class BuyerClient:
         except grpc.RpcError as e:
             print(f"SearchItems failed with {e.code()}: {e.details()}")
 
+    def search_items_page(self, name="", category=marketplace_pb2.ANY, page_size=50, page_token=""):
+        """Fetch one page of search results. Returns the items and the token for the next page ("" on the last page)."""
+        try:
+            response = self.call("SearchItems", marketplace_pb2.SearchRequest(
+                name=name, category=category, page_size=page_size, page_token=page_token))
+            return response.items, response.next_page_token
+        except grpc.RpcError as e:
+            print(f"SearchItems failed with {e.code()}: {e.details()}")
+            return [], ""
+
+    def stream_search_items(self, name="", category=marketplace_pb2.ANY, page_size=0, sort_by=marketplace_pb2.ID):
+        """Search for items, printing each page of results as soon as it arrives."""
+        found = 0
+        try:
+            print("Search Results:")
+            for response in self.stream("StreamSearchItems", marketplace_pb2.SearchRequest(
+                    name=name, category=category, page_size=page_size, sort_by=sort_by)):
+                for item in response.items:
+                    rating = item.rating if item.rating != -1 else "UNRATED"
+                    print(f"Item ID: {item.id}, Name: {item.name}, Price: ${item.price}, Quantity: {item.quantity}, Rating: {rating}")
+                found += len(response.items)
+        except grpc.RpcError as e:
+            print(f"StreamSearchItems failed with {e.code()}: {e.details()}")
+        return found
+
     def buy_item(self, item_id, quantity):
         """Buy an item specifying its ID and the desired quantity."""
         try:
-            response = self.stub.BuyItem(marketplace_pb2.BuyItemRequest(
+            response = self.call("BuyItem", marketplace_pb2.BuyItemRequest(
                 item_id=item_id, quantity=quantity, buyer_address=self.buyer_address))
             print(f"BuyItem response: {response.message}")
         except grpc.RpcError as e:
             print(f"BuyItem failed with {e.code()}: {e.details()}")
 
+    def buy_items(self, orders):
+        """Buy several items at once, given as (item_id, quantity) tuples. Returns one OperationResponse per order."""
+        results = []
+        for start in range(0, len(orders), BATCH_SIZE):
+            batch = [marketplace_pb2.BuyItemRequest(item_id=item_id, quantity=quantity, buyer_address=self.buyer_address)
+                     for item_id, quantity in orders[start:start + BATCH_SIZE]]
+            try:
+                response = self.call("BuyItems", marketplace_pb2.BuyItemsRequest(orders=batch))
+            except grpc.RpcError as e:
+                print(f"BuyItems failed with {e.code()}: {e.details()}")
+                break
+            results.extend(response.results)
+        for (item_id, _), result in zip(orders, results):
+            print(f"BuyItems response for item {item_id}: {result.message}")
+        return results
+
     def add_to_wishlist(self, item_id):
         """Add an item to the wishlist."""
         try:
-            response = self.stub.AddToWishList(marketplace_pb2.WishlistRequest(
+            response = self.call("AddToWishList", marketplace_pb2.WishlistRequest(
                 item_id=item_id, buyer_address=self.buyer_address))
             print(f"AddToWishList response: {response.message}")
         except grpc.RpcError as e:
             print(f"AddToWishList failed with {e.code()}: {e.details()}")
 
+    def remove_from_wishlist(self, item_id):
+        """Remove an item from the wishlist."""
+        try:
+            response = self.call("RemoveFromWishList", marketplace_pb2.WishlistRequest(
+                item_id=item_id, buyer_address=self.buyer_address))
+            print(f"RemoveFromWishList response: {response.message}")
+        except grpc.RpcError as e:
+            print(f"RemoveFromWishList failed with {e.code()}: {e.details()}")
+
+    def get_wishlist(self):
+        """Print and return the items on the wishlist."""
+        try:
+            response = self.call("GetWishList", marketplace_pb2.GetWishListRequest(buyer_address=self.buyer_address))
+            print("Wishlist:")
+            for item in response.items:
+                print(f"Item ID: {item.id}, Name: {item.name}, Price: ${item.price}, Quantity: {item.quantity}")
+            return response.items
+        except grpc.RpcError as e:
+            print(f"GetWishList failed with {e.code()}: {e.details()}")
+
     def rate_item(self, item_id, rating):
         """Rate an item."""
         try:
-            response = self.stub.RateItem(marketplace_pb2.RateItemRequest(
+            response = self.call("RateItem", marketplace_pb2.RateItemRequest(
                 item_id=item_id, rating=rating, buyer_address=self.buyer_address))
             print(f"RateItem response: {response.message}")
         except grpc.RpcError as e:
@@ -59,15 +123,31 @@ class BuyerClient:
 
     def fetch_notifications(self):
         """Fetch and display notifications."""
-        response = self.stub.FetchNotifications(
-            marketplace_pb2.NotificationRequest(buyer_address=self.buyer_address))
+        response = self.call("FetchNotifications", marketplace_pb2.NotificationRequest(buyer_address=self.buyer_address))
         # print("there hsoudl be printintg")
         for message in response.messages:
             print(f"Notification: {message}")
+        if response.dropped:
+            print(f"{response.dropped} older notifications were dropped")
+
+    def listen_for_notifications(self):
+        """Print notifications as the server pushes them, until the stream ends."""
+        responses = self.stream("SubscribeNotifications", marketplace_pb2.NotificationRequest(buyer_address=self.buyer_address))
+        for response in responses:
+            for message in response.messages:
+                print(f"Notification: {message}")
 
     def start_notification_listener(self):
-        """Periodically fetch notifications in the background."""
+        """Receive notifications in the background, polling if the server cannot stream them."""
         def listener():
+            while True:
+                try:
+                    self.listen_for_notifications()
+                except grpc.RpcError as e:
+                    if e.code() in (grpc.StatusCode.UNIMPLEMENTED, grpc.StatusCode.RESOURCE_EXHAUSTED):
+                        break
+                time.sleep(5)  # Back off before resubscribing
+            # Server cannot stream, or has no room for another stream; fall back to polling
             while True:
                 self.fetch_notifications()
                 time.sleep(5)  # Adjust the frequency as needed
@@ -87,7 +167,9 @@ def buyer_menu(client):
         print("2. Buy Item")
         print("3. Add Item to Wishlist")
         print("4. Rate Item")
-        print("5. Exit")
+        print("5. Remove Item from Wishlist")
+        print("6. View Wishlist")
+        print("7. Exit")
         choice = input("Enter your choice: ")
 
         if choice == "1":
@@ -95,7 +177,11 @@ def buyer_menu(client):
             category = input("Enter item category (ELECTRONICS, FASHION, OTHERS, ANY): ")
             if category == "":
                 category = "ANY"
-            client.search_items(name, marketplace_pb2.Category.Value(category))
+            sort_by = input("Sort by (ID, PRICE, RATING, QUANTITY, RELEVANCE; leave blank for ID): ")
+            if sort_by == "":
+                sort_by = "ID"
+            client.stream_search_items(name, marketplace_pb2.Category.Value(category),
+                                       sort_by=marketplace_pb2.SortKey.Value(sort_by))
         elif choice == "2":
             item_id = int(input("Enter item ID to buy: "))
             quantity = int(input("Enter quantity: "))
@@ -112,6 +198,11 @@ def buyer_menu(client):
                 rating = 1
             client.rate_item(item_id, rating)
         elif choice == "5":
+            item_id = int(input("Enter item ID to remove from wishlist: "))
+            client.remove_from_wishlist(item_id)
+        elif choice == "6":
+            client.get_wishlist()
+        elif choice == "7":
             print("Exiting...")
             break
         else:
@@ -122,7 +213,7 @@ def main():
     '''
     Start the buyer client.
     '''
-    client = BuyerClient(SERVER_ADDRESS)
+    client = BuyerClient(SERVER_ADDRESS, replicas=REPLICA_ADDRESSES)
     client.start_notification_listener()
     threading.Thread(target=client.fetch_notifications, daemon=True).start()
     buyer_menu(client)
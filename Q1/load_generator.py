@@ -0,0 +1,318 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import grpc
+import marketplace_pb2
+import marketplace_pb2_grpc
+from metrics import LatencyHistogram, latency_bounds
+
+BATCH_SIZE = 1000  # Items per BulkAddItems call when seeding the catalog
+SEED_QUANTITY = 1000000  # Stock of every seeded item, so buyers rarely run out
+SELLER_MIX = "add=60,update=30,fetch=10"
+BUYER_MIX = "search=50,buy=20,rate=10,wishlist=10,fetch=10"
+SELLER_OPERATIONS = ("add", "update", "fetch")
+BUYER_OPERATIONS = ("search", "buy", "rate", "wishlist", "fetch")
+LATENCY_BOUNDS = latency_bounds(64)  # Buckets about 1% wide, far finer than --tolerance (the server's are 19%)
+CATEGORIES = [marketplace_pb2.ELECTRONICS, marketplace_pb2.FASHION, marketplace_pb2.OTHERS]
+WORDS = ["phone", "laptop", "shirt", "jacket", "lamp", "chair", "camera", "watch",
+         "shoes", "speaker", "table", "bottle", "keyboard", "monitor", "bag", "scarf"]
+
+def parse_mix(mix, operations):
+    '''
+    Parse "op=weight,op=weight" into parallel lists of operations and weights.
+    '''
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in operations:
+            raise ValueError(f"Unknown operation '{name}', expected one of {', '.join(operations)}")
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+def item_name(rng):
+    return f"{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randrange(1000)}"
+
+class OperationStats:
+    '''
+    Outcome counts and latencies of one operation, kept per simulated client and merged at the end.
+    '''
+    __slots__ = ("calls", "errors", "rejected", "latency")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0  # Calls that failed with an RPC error
+        self.rejected = 0  # Calls the server answered with success = false
+        self.latency = LatencyHistogram(LATENCY_BOUNDS)
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.rejected += other.rejected
+        self.latency.merge(other.latency)
+
+class SimulatedClient:
+    '''
+    One seller or buyer issuing a weighted random mix of operations.
+    With a target rate, calls are scheduled at fixed intervals and latency is
+    measured from the scheduled time, so a stalled server shows up as latency
+    instead of silently lowering the offered load.
+    '''
+    def __init__(self, kind, index, address, mix, rate, items, seed):
+        self.kind = kind
+        self.channel = grpc.insecure_channel(address)
+        self.stub = marketplace_pb2_grpc.MarketplaceStub(self.channel)
+        self.operations, self.weights = mix
+        self.interval = 1 / rate if rate else 0
+        self.items = items  # Shared list of item IDs that exist on the server
+        self.own_items = []  # IDs of the items this seller added
+        self.rng = random.Random(seed * 100003 + index)
+        self.uuid = f"load-{kind}-{index}"
+        self.address = f"127.0.0.1:{kind}-{index}"
+        self.stats = {}  # Maps operation name to OperationStats
+
+    def register(self):
+        if self.kind == "seller":
+            self.stub.RegisterSeller(marketplace_pb2.RegisterSellerRequest(ip_port=self.address, uuid=self.uuid))
+
+    def call(self, operation):
+        '''
+        Issue one operation and return the server's success flag (True for reads).
+        '''
+        rng = self.rng
+        if operation == "update" and not self.own_items:
+            operation = "add"
+        if operation == "add":
+            item = marketplace_pb2.Item(name=item_name(rng), category=rng.choice(CATEGORIES),
+                                        quantity=SEED_QUANTITY, description="load test item",
+                                        seller_address=self.address, price=rng.uniform(1, 1000))
+            response = self.stub.AddItem(marketplace_pb2.ItemOperationRequest(uuid=self.uuid, item=item))
+            if response.success:
+                self.own_items.append(response.item_id)
+                self.items.append(response.item_id)
+            return response.success
+        elif operation == "update":
+            response = self.stub.UpdateItem(marketplace_pb2.UpdateItemRequest(
+                uuid=self.uuid, id=rng.choice(self.own_items), quantity=SEED_QUANTITY, price=rng.uniform(1, 1000)))
+            return response.success
+        elif operation == "search":
+            self.stub.SearchItems(marketplace_pb2.SearchRequest(
+                name=rng.choice(WORDS), category=rng.choice(CATEGORIES + [marketplace_pb2.ANY]), page_size=20))
+            return True
+        elif operation == "buy":
+            response = self.stub.BuyItem(marketplace_pb2.BuyItemRequest(
+                item_id=rng.choice(self.items), quantity=1, buyer_address=self.address))
+            return response.success
+        elif operation == "rate":
+            response = self.stub.RateItem(marketplace_pb2.RateItemRequest(
+                item_id=rng.choice(self.items), rating=rng.randint(1, 5), buyer_address=self.address))
+            return response.success
+        elif operation == "wishlist":
+            response = self.stub.AddToWishList(marketplace_pb2.WishlistRequest(
+                item_id=rng.choice(self.items), buyer_address=self.address))
+            return response.success
+        elif self.kind == "seller":
+            self.stub.FetchSellerNotifications(marketplace_pb2.NotificationRequest(uuid=self.uuid))
+        else:
+            self.stub.FetchNotifications(marketplace_pb2.NotificationRequest(buyer_address=self.address))
+        return True
+
+    def run(self, start, measure_from, stop):
+        '''
+        Issue operations until `stop`, recording those that start after `measure_from`.
+        '''
+        scheduled = start
+        while True:
+            if self.interval:
+                scheduled += self.interval
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            if scheduled >= stop:
+                break
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            error = rejected = False
+            try:
+                rejected = not self.call(operation)
+            except grpc.RpcError:
+                error = True
+            if scheduled < measure_from:
+                continue
+            stats = self.stats.get(operation)
+            if stats is None:
+                stats = self.stats[operation] = OperationStats()
+            stats.calls += 1
+            stats.errors += error
+            stats.rejected += rejected
+            stats.latency.record(time.perf_counter() - scheduled)
+        self.channel.close()
+
+def seed_catalog(address, count, seed):
+    '''
+    Register a seller and bulk-add `count` items. Returns their IDs.
+    '''
+    rng = random.Random(seed)
+    with grpc.insecure_channel(address) as channel:
+        stub = marketplace_pb2_grpc.MarketplaceStub(channel)
+        stub.RegisterSeller(marketplace_pb2.RegisterSellerRequest(ip_port="127.0.0.1:seed", uuid="load-seed"))
+        ids = []
+        for start in range(0, count, BATCH_SIZE):
+            items = [marketplace_pb2.Item(name=item_name(rng), category=rng.choice(CATEGORIES), quantity=SEED_QUANTITY,
+                                          description="load test item", seller_address="127.0.0.1:seed",
+                                          price=rng.uniform(1, 1000))
+                     for _ in range(min(BATCH_SIZE, count - start))]
+            response = stub.BulkAddItems(marketplace_pb2.BulkAddItemsRequest(uuid="load-seed", items=items))
+            ids.extend(result.item_id for result in response.results if result.success)
+        return ids
+
+def server_stats(address):
+    '''
+    The server's own per-method statistics, or None if it does not expose GetStats.
+    '''
+    try:
+        with grpc.insecure_channel(address) as channel:
+            response = marketplace_pb2_grpc.MarketplaceStub(channel).GetStats(marketplace_pb2.StatsRequest(), timeout=5)
+    except grpc.RpcError:
+        return None
+    return {method.method: {"calls": method.calls, "errors": method.errors, "p50_ms": method.p50_ms,
+                            "p95_ms": method.p95_ms, "p99_ms": method.p99_ms, "max_ms": method.max_ms}
+            for method in response.methods}
+
+def summarize(stats, elapsed):
+    '''
+    Turn merged OperationStats into the JSON-ready results of a run.
+    '''
+    operations = {}
+    total = OperationStats()
+    for name, op in sorted(stats.items()):
+        total.merge(op)
+        operations[name] = describe(op, elapsed)
+    return {"duration_seconds": elapsed, "total": describe(total, elapsed), "operations": operations}
+
+def describe(op, elapsed):
+    latency = op.latency
+    return {"calls": op.calls, "errors": op.errors, "rejected": op.rejected,
+            "throughput": op.calls / elapsed if elapsed else 0.0,
+            "p50_ms": latency.percentile(0.5) * 1000, "p95_ms": latency.percentile(0.95) * 1000,
+            "p99_ms": latency.percentile(0.99) * 1000, "max_ms": latency.max * 1000}
+
+def print_results(results):
+    print(f"{'operation':<10} {'calls':>9} {'errors':>7} {'rejected':>9} {'ops/s':>10} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = list(results["operations"].items()) + [("total", results["total"])]
+    for name, op in rows:
+        print(f"{name:<10} {op['calls']:>9} {op['errors']:>7} {op['rejected']:>9} {op['throughput']:>10.1f} "
+              f"{op['p50_ms']:>9.2f} {op['p95_ms']:>9.2f} {op['p99_ms']:>9.2f} {op['max_ms']:>9.2f}")
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare a run with a baseline run. Returns a list of regressions: throughput
+    more than `tolerance` below the baseline, or p99 latency more than `tolerance` above it.
+    '''
+    regressions = []
+    rows = [("total", results["total"], baseline["total"])]
+    rows += [(name, op, baseline["operations"][name])
+             for name, op in results["operations"].items() if name in baseline["operations"]]
+    for name, op, base in rows:
+        if base["throughput"] and op["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {op['throughput']:.1f} ops/s, baseline {base['throughput']:.1f}")
+        if base["p99_ms"] and op["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {op['p99_ms']:.2f} ms, baseline {base['p99_ms']:.2f}")
+    return regressions
+
+def run(args):
+    '''
+    Run one load test as configured by the command line and return its results.
+    '''
+    server = None
+    address = args.address
+    if not address:
+        from market_server import create_server
+        server, _, port = create_server(0, args.workers, args.data_dir)
+        address = f"localhost:{port}"
+    try:
+        items = seed_catalog(address, args.items, args.seed)
+        if not items:
+            raise RuntimeError("Seeding the catalog failed, no items to buy or rate")
+        seller_mix = parse_mix(args.seller_mix, SELLER_OPERATIONS)
+        buyer_mix = parse_mix(args.buyer_mix, BUYER_OPERATIONS)
+        clients = [SimulatedClient("seller", i, address, seller_mix, args.rate, items, args.seed)
+                   for i in range(args.sellers)]
+        clients += [SimulatedClient("buyer", i, address, buyer_mix, args.rate, items, args.seed)
+                    for i in range(args.buyers)]
+        for client in clients:
+            client.register()
+
+        start = time.perf_counter()
+        measure_from = start + args.warmup
+        stop = measure_from + args.duration
+        threads = [threading.Thread(target=client.run, args=(start, measure_from, stop), daemon=True)
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = min(time.perf_counter(), stop) - measure_from
+
+        stats = {}
+        for client in clients:
+            for name, op in client.stats.items():
+                stats.setdefault(name, OperationStats()).merge(op)
+        results = summarize(stats, elapsed)
+        results["config"] = {"address": args.address or "in-process", "sellers": args.sellers, "buyers": args.buyers,
+                             "rate": args.rate, "duration": args.duration, "warmup": args.warmup, "items": args.items,
+                             "seller_mix": args.seller_mix, "buyer_mix": args.buyer_mix, "seed": args.seed}
+        results["server"] = server_stats(address)
+        return results
+    finally:
+        if server is not None:
+            server.stop(None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate load against the marketplace server and report throughput and latency.")
+    parser.add_argument("--address", help="Server to load, e.g. localhost:50051; an in-process server is started if omitted")
+    parser.add_argument("--workers", type=int, default=100, help="RPC thread pool size of the in-process server")
+    parser.add_argument("--data-dir", help="Data directory of the in-process server, to include write-ahead logging")
+    parser.add_argument("--sellers", type=int, default=4, help="Number of simulated sellers")
+    parser.add_argument("--buyers", type=int, default=16, help="Number of simulated buyers")
+    parser.add_argument("--seller-mix", default=SELLER_MIX, help=f"Weighted seller operations (default: {SELLER_MIX})")
+    parser.add_argument("--buyer-mix", default=BUYER_MIX, help=f"Weighted buyer operations (default: {BUYER_MIX})")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Target operations per second for each simulated client; 0 sends as fast as responses allow")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of load before measuring starts")
+    parser.add_argument("--items", type=int, default=1000, help="Items added to the catalog before the run")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, for repeatable operation sequences")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed fractional throughput drop or p99 increase against the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [key for key, value in results["config"].items() if baseline.get("config", {}).get(key) != value]
+        if changed:
+            print(f"Note: the baseline was run with different settings for {', '.join(changed)}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
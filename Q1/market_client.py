@@ -0,0 +1,185 @@
+import asyncio
+import itertools
+import json
+import threading
+import weakref
+import grpc
+import marketplace_pb2_grpc
+
+DEFAULT_TIMEOUT = 10  # Seconds a unary call may take before it fails with DEADLINE_EXCEEDED
+POOL_SIZE = 4  # Channels (TCP connections) kept per server address
+
+# Calls that can safely be sent again: reads, and writes that set absolute values.
+# BuyItem, AddItem, RateItem and FetchNotifications are not retried, since a
+# retry after a lost response would buy, add, rate or drain twice. Neither are
+# AddToWishList and RemoveFromWishList: a retry of one that was applied fails
+# with "already in wishlist" or "not in wishlist".
+IDEMPOTENT_METHODS = ["SearchItems", "StreamSearchItems", "DisplaySellerItems", "UpdateItem",
+                      "BulkUpdateItems", "GetWishList", "GetStats", "GetNotificationStats"]
+
+# Calls a read replica can answer, and the codes on which they are sent to the primary instead
+READ_METHODS = {"SearchItems", "StreamSearchItems", "DisplaySellerItems"}
+REPLICA_FALLBACK_CODES = {grpc.StatusCode.FAILED_PRECONDITION, grpc.StatusCode.UNAVAILABLE}
+
+SERVICE_CONFIG = json.dumps({
+    "methodConfig": [{
+        "name": [{"service": "marketplace.Marketplace", "method": method} for method in IDEMPOTENT_METHODS],
+        "retryPolicy": {
+            "maxAttempts": 4,
+            "initialBackoff": "0.1s",
+            "maxBackoff": "2s",
+            "backoffMultiplier": 2,
+            "retryableStatusCodes": ["UNAVAILABLE"],
+        },
+    }]
+})
+
+CHANNEL_OPTIONS = [
+    ("grpc.enable_retries", 1),
+    ("grpc.service_config", SERVICE_CONFIG),
+    ("grpc.keepalive_time_ms", 30000),  # Ping an idle connection every 30s so dead servers are noticed
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),  # Keep pinging while only a notification stream is open
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.use_local_subchannel_pool", 1),  # Give every pooled channel its own connection
+]
+
+class ChannelPool:
+    '''
+    Channels shared by every client in the process, `size` per server address,
+    handed out round-robin. gRPC multiplexes calls over a channel, so a few
+    channels serve any number of clients; more than one spreads the load over
+    several connections. With aio=True the channels are grpc.aio channels and
+    the pool must only be used from one event loop.
+    '''
+    def __init__(self, size=POOL_SIZE, aio=False):
+        self.size = size
+        self.aio = aio
+        self.channels = {}  # Maps address to (list of channels, round-robin counter)
+        self.lock = threading.Lock()
+
+    def channel(self, address):
+        '''
+        Return one of the pooled channels to address, opening them on first use.
+        '''
+        with self.lock:
+            entry = self.channels.get(address)
+            if entry is None:
+                connect = grpc.aio.insecure_channel if self.aio else grpc.insecure_channel
+                entry = self.channels[address] = ([connect(address, options=CHANNEL_OPTIONS) for _ in range(self.size)],
+                                                  itertools.count())
+        channels, counter = entry
+        return channels[next(counter) % len(channels)]
+
+    def close(self):
+        '''
+        Close every channel in the pool. Returns an awaitable for an aio pool.
+        '''
+        with self.lock:
+            channels = [channel for entry in self.channels.values() for channel in entry[0]]
+            self.channels = {}
+        closing = [channel.close() for channel in channels]
+        if self.aio:
+            return asyncio.gather(*closing)
+
+shared_pool = ChannelPool()  # Used by clients that are not given a pool
+aio_pools = weakref.WeakKeyDictionary()  # Maps an event loop to the aio pool shared by its clients
+aio_pools_lock = threading.Lock()  # Guards aio_pools
+
+def shared_aio_pool():
+    '''
+    The aio ChannelPool used by async clients on the running event loop that are not given a pool.
+    aio channels only work on the loop they were opened on, so every loop gets its own pool.
+    '''
+    loop = asyncio.get_running_loop()
+    with aio_pools_lock:
+        pool = aio_pools.get(loop)
+        if pool is None:
+            pool = aio_pools[loop] = ChannelPool(aio=True)
+        return pool
+
+class MarketClient:
+    '''
+    Thin client for the marketplace service over a pooled channel.
+    Every unary call gets a deadline (`timeout` seconds unless overridden), and
+    idempotent calls are retried by gRPC when the server is unavailable.
+    call() blocks for the response; future() returns a grpc.Future at once, so
+    many requests can be in flight from a single thread.
+    Given the addresses of read replicas of the server (see replica_server.py),
+    searches and seller listings are spread over them. call() falls back to the
+    server if a replica is down or too far behind; future() and stream() do not.
+    '''
+    def __init__(self, address, pool=None, timeout=DEFAULT_TIMEOUT, replicas=()):
+        pool = pool or shared_pool
+        self.channel = pool.channel(address)
+        self.stub = marketplace_pb2_grpc.MarketplaceStub(self.channel)
+        self.replica_stubs = [marketplace_pb2_grpc.MarketplaceStub(pool.channel(replica)) for replica in replicas]
+        self.next_replica = itertools.count()
+        self.timeout = timeout
+
+    def route(self, method):
+        '''
+        Stub to send a call to: the next replica for reads, when there are replicas, else the server.
+        '''
+        if method in READ_METHODS and self.replica_stubs:
+            return self.replica_stubs[next(self.next_replica) % len(self.replica_stubs)]
+        return self.stub
+
+    def call(self, method, request, timeout=None):
+        '''
+        Call a unary RPC by name, e.g. call("BuyItem", request), and return its response.
+        '''
+        stub = self.route(method)
+        try:
+            return getattr(stub, method)(request, timeout=timeout or self.timeout)
+        except grpc.RpcError as e:
+            if stub is self.stub or e.code() not in REPLICA_FALLBACK_CODES:
+                raise
+        return getattr(self.stub, method)(request, timeout=timeout or self.timeout)
+
+    def future(self, method, request, timeout=None):
+        '''
+        Start a unary RPC by name and return a grpc.Future for its response.
+        '''
+        return getattr(self.route(method), method).future(request, timeout=timeout or self.timeout)
+
+    def stream(self, method, request, timeout=None):
+        '''
+        Call a server-streaming RPC by name and return an iterator over its responses.
+        Streams have no deadline unless one is given, as notification streams stay open.
+        '''
+        return getattr(self.route(method), method)(request, timeout=timeout)
+
+class AsyncMarketClient:
+    '''
+    asyncio counterpart of MarketClient over a grpc.aio channel pool, by default
+    the one shared by every async client on the event loop.
+    Create it from inside the event loop it will be used on.
+    '''
+    def __init__(self, address, pool=None, timeout=DEFAULT_TIMEOUT, replicas=()):
+        self.pool = pool or shared_aio_pool()
+        self.channel = self.pool.channel(address)
+        self.stub = marketplace_pb2_grpc.MarketplaceStub(self.channel)
+        self.replica_stubs = [marketplace_pb2_grpc.MarketplaceStub(self.pool.channel(replica)) for replica in replicas]
+        self.next_replica = itertools.count()
+        self.timeout = timeout
+
+    route = MarketClient.route
+
+    async def call(self, method, request, timeout=None):
+        '''
+        Call a unary RPC by name and return its response, falling back from a replica to the server like MarketClient.
+        '''
+        stub = self.route(method)
+        try:
+            return await getattr(stub, method)(request, timeout=timeout or self.timeout)
+        except grpc.RpcError as e:
+            if stub is self.stub or e.code() not in REPLICA_FALLBACK_CODES:
+                raise
+        return await getattr(self.stub, method)(request, timeout=timeout or self.timeout)
+
+    def stream(self, method, request, timeout=None):
+        '''
+        Call a server-streaming RPC by name and return an async iterator over its responses.
+        '''
+        return getattr(self.route(method), method)(request, timeout=timeout)
@@ -1,70 +1,547 @@
-from datetime import datetime
 from concurrent import futures
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
 import grpc
 import marketplace_pb2
 import marketplace_pb2_grpc
+import persistence
+from metrics import MetricsInterceptor, RpcMetrics
+from notifications import ItemNotification, NotificationQueue, SaleNotification
+from replication import REPLICATION_HEARTBEAT, ReplicaSink, ReplicationFeed, encode_records, encode_snapshot
+from search_cache import SerializedResponseInterceptor, SearchCache
+from search_index import SearchIndex
+from search_order import SearchOrder
+from server_logging import setup_logging
+
+log = logging.getLogger("market_server")
+
+MAX_WORKERS = 100  # Each open notification stream holds a worker thread for its lifetime
+STREAM_SHARE = 0.5  # Fraction of the RPC thread pool that notification streams may hold
+ITEM_LOCK_STRIPES = 64  # Number of locks items are striped over by ID
+SEARCH_PAGE_SIZE = 100  # Items per response in StreamSearchItems when the request does not set page_size
+SNAPSHOT_INTERVAL = 300  # Seconds between snapshots of persisted state
+NOTIFICATION_QUEUE_SIZE = 100  # Pending notifications kept per recipient before the oldest are dropped
+SEARCH_ITEMS = "/marketplace.Marketplace/SearchItems"  # Answered by serialized_search on servers built here
+SERVER_OPTIONS = [
+    # Accept the clients' keepalive pings (every 30s, also on idle connections) instead of closing the connection
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", 20000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.so_reuseport", 0),  # Fail to start rather than silently share a port with another server
+]
+
+class StreamLimit:
+    '''
+    Count of the open notification streams on a thread-pool server, where each
+    holds a worker thread for its lifetime. New streams are refused past the
+    limit, so unary calls always find a free worker. A limit of None allows any
+    number, as on the asyncio server.
+    '''
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, context):
+        '''
+        Count a new stream and return True, or set RESOURCE_EXHAUSTED on the call and return False.
+        Clients fall back to polling on that code.
+        '''
+        with self.lock:
+            if self.limit is None or self.open < self.limit:
+                self.open += 1
+                return True
+        log.warning("Refused a notification stream, all %s are in use", self.limit)
+        context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        context.set_details("Too many notification streams, poll for notifications instead")
+        return False
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+def stream_limit(max_workers):
+    '''
+    StreamLimit for a thread pool of max_workers.
+    '''
+    return StreamLimit(max(1, int(max_workers * STREAM_SHARE)))
+
+class RatingAggregate:
+    '''
+    Running sum and count of the ratings given to a single item.
+    '''
+    __slots__ = ("total", "count", "raters")
 
-class MarketplaceService(marketplace_pb2_grpc.MarketplaceServicer):
     def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.raters = set()  # Buyer addresses that have rated the item
+
+    def add(self, buyer_address, rating):
+        '''
+        Record a rating and return the new average.
+        '''
+        self.raters.add(buyer_address)
+        self.total += rating
+        self.count += 1
+        return self.total / self.count
+
+class ItemRecord:
+    '''
+    One catalog listing. Items are kept as these slotted records rather than
+    protobuf messages, which are several times larger and slower to update;
+    Item messages are built from them only when a response is sent.
+    '''
+    __slots__ = ("id", "name", "category", "quantity", "description", "seller_address", "price", "rating")
+
+    def __init__(self, id, name, category, quantity, description, seller_address, price, rating=-1):
+        self.id = id
+        self.name = name
+        self.category = category
+        self.quantity = quantity
+        self.description = description
+        self.seller_address = sys.intern(seller_address)  # Shared by all of a seller's items
+        self.price = price
+        self.rating = rating  # Average rating, -1 until the first RateItem
+
+    @classmethod
+    def from_message(cls, item_id, item):
+        '''
+        Build a new, unrated record from an Item message sent by a seller.
+        '''
+        return cls(item_id, item.name, item.category, item.quantity, item.description, item.seller_address, item.price)
+
+    def fill(self, message):
+        '''
+        Copy the record into an Item message, e.g. record.fill(response.items.add()).
+        '''
+        message.id = self.id
+        message.name = self.name
+        message.category = self.category
+        message.quantity = self.quantity
+        message.description = self.description
+        message.seller_address = self.seller_address
+        message.price = self.price
+        message.rating = self.rating
+
+    def state(self):
+        '''
+        The record's fields as a tuple, for the write-ahead log and snapshots. ItemRecord(*state) restores it.
+        '''
+        return (self.id, self.name, self.category, self.quantity, self.description,
+                self.seller_address, self.price, self.rating)
+
+def item_record(state):
+    '''
+    Rebuild an ItemRecord from ItemRecord.state(), or from a serialized Item message
+    as written by servers that stored protobuf items.
+    '''
+    if isinstance(state, bytes):
+        item = marketplace_pb2.Item.FromString(state)
+        return ItemRecord(item.id, item.name, item.category, item.quantity, item.description,
+                          item.seller_address, item.price, item.rating)
+    return ItemRecord(*state)
+
+class MarketplaceService(marketplace_pb2_grpc.MarketplaceServicer):
+    def __init__(self, data_dir=None, snapshot_interval=SNAPSHOT_INTERVAL, wait_for_commit=True,
+                 shard_index=0, shard_count=1):
         '''
         Defines the functionality of the marketplace service.
         This is the server-side implementation of the gRPC service.
+        With a data_dir, every change is written to a write-ahead log there and
+        state is recovered from it on startup. Mutating RPCs then reply only once
+        their changes are on disk, unless wait_for_commit is False (the caller
+        takes care of waiting, as the asyncio server does).
+        As shard shard_index of shard_count (see shard_router.py), the service only
+        hands out item IDs with (id - 1) % shard_count == shard_index, so every
+        item ID identifies the shard that owns it.
         '''
         self.sellers = {}  # Maps UUID to seller details
-        self.items = {}  # Maps item ID to item details
-        self.wishlist = {}  # Maps buyer_address to a list of item_ids
-        self.item_watchers = {}  # New: Maps item_id to a list of buyer_addresses
-        self.notifications = {}  # Maps buyer_address to a list of notification messages
-        self.seller_notifications = {}  # Maps seller UUID to a list of notification messages
-        self.ratings = {}  # New: Maps item_id to a list of (buyer_address, rating)
-        self.next_item_id = 1
+        self.items = {}  # Maps item ID to its ItemRecord
+        self.seller_items = {}  # Maps seller UUID to an ordered set (dict) of their item_ids
+        self.item_sellers = {}  # Maps item_id to the UUID of the seller who listed it
+        self.wishlist = {}  # Maps buyer_address to an ordered set (dict) of item_ids
+        self.item_watchers = {}  # Maps item_id to an ordered set (dict) of the buyer_addresses watching it
+        self.notifications = {}  # Maps buyer_address to a NotificationQueue of pending notifications
+        self.seller_notifications = {}  # Maps seller UUID to a NotificationQueue of pending notifications
+        self.notifications_coalesced = 0  # Queued notifications replaced by a newer one for the same item
+        self.notifications_dropped = 0  # Queued notifications dropped because a queue was full
+        self.subscribers = {}  # Maps buyer_address to the set of queues feeding its notification streams
+        self.seller_subscribers = {}  # Maps seller UUID to the set of queues feeding its notification streams
+        self.streams = StreamLimit()  # Open notification streams, limited by create_server to a share of its threads
+        self.ratings = {}  # Maps item_id to a RatingAggregate
+        self.search_index = SearchIndex()  # Name trigram and category index over self.items
+        self.search_cache = SearchCache()  # Serialized SearchItems responses, invalidated by item changes
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.next_item_id = shard_index + 1  # Next item ID to hand out, advanced by shard_count under catalog_lock
+        self.metrics = None  # RpcMetrics backing GetStats, set by the server entry points
+        self.replicas = ReplicationFeed()  # Catalog changes streamed to read replicas
+
+        # Locks are always taken in this order: item stripe, catalog, wishlist, notification
+        self.item_locks = [threading.Lock() for _ in range(ITEM_LOCK_STRIPES)]  # Guard quantity, price and ratings per item
+        self.catalog_lock = threading.Lock()  # Guards sellers, items, search_index, seller_items and item_sellers
+        self.wishlist_lock = threading.Lock()  # Guards wishlist and item_watchers
+        self.notification_lock = threading.Lock()  # Guards notification queues and subscriber sets
+        self.snapshot_lock = threading.Lock()  # Allows one snapshot at a time
+
+        self.data_dir = data_dir
+        self.wait_for_commit = wait_for_commit
+        self.wal = None  # WriteAheadLog, set by recover() when persistence is enabled
+        if data_dir is not None:
+            os.makedirs(data_dir, exist_ok=True)
+            self.recover()
+            threading.Thread(target=self.snapshot_loop, args=(snapshot_interval,), daemon=True).start()
+
+    def persist(self, *records):
+        '''
+        Append records to the write-ahead log, if persistence is enabled, and pass them on to replicas.
+        Called while holding the lock that orders the change, so replay sees changes in the same order.
+        '''
+        if self.wal is not None:
+            self.wal.append(*records)
+        self.replicas.publish(records)
+
+    def commit(self, response):
+        '''
+        Return response once the changes logged by this thread are durable.
+        '''
+        if self.wal is not None and self.wait_for_commit:
+            self.wal.wait(self.wal.last_lsn())
+        return response
+
+    def recover(self):
+        '''
+        Load the latest snapshot, replay the log segments written after it and open a new segment.
+        '''
+        started = time.time()
+        state = persistence.load_snapshot(self.data_dir)
+        first_segment, next_item_id = 0, 1
+        if state is not None:
+            self.restore_state(state)
+            first_segment, next_item_id = state["segment"], state["next_item_id"]
+        last_segment, replayed = first_segment, 0
+        for number in persistence.segment_numbers(self.data_dir):
+            if number < first_segment:
+                continue  # Already covered by the snapshot
+            for record in persistence.read_segment(persistence.segment_path(self.data_dir, number)):
+                self.apply_record(record)
+                if record[0] == "add":
+                    next_item_id = max(next_item_id, record[2] + 1)
+                replayed += 1
+            last_segment = number
+        self.next_item_id = self.first_item_id(next_item_id)
+        self.wal = persistence.WriteAheadLog(self.data_dir, last_segment + 1)
+        log.info("Recovered %s items (%s log records) in %.2fs", len(self.items), replayed, time.time() - started)
+
+    def first_item_id(self, lowest):
+        '''
+        Smallest item ID of this shard that is at least `lowest`.
+        '''
+        return lowest + (self.shard_index - (lowest - 1)) % self.shard_count
+
+    def apply_record(self, record):
+        '''
+        Re-apply one write-ahead log record during recovery.
+        '''
+        op = record[0]
+        if op == "seller":
+            _, uuid, ip_port = record
+            self.sellers[uuid] = {"ip_port": ip_port}
+        elif op == "add":
+            _, seller_uuid, item_id, state = record
+            self.insert_item(seller_uuid, item_record(state))
+        elif op == "delete":
+            self.remove_item(record[1])
+        elif op == "update":
+            _, item_id, quantity, price = record
+            item = self.items[item_id]
+            item.quantity = quantity
+            item.price = price
+            self.search_cache.invalidate(item.category)
+        elif op == "stock":
+            _, item_id, quantity = record
+            item = self.items[item_id]
+            item.quantity = quantity
+            self.search_cache.invalidate(item.category)
+        elif op == "rate":
+            _, item_id, buyer_address, rating = record
+            aggregate = self.ratings.setdefault(item_id, RatingAggregate())
+            item = self.items[item_id]
+            item.rating = aggregate.add(buyer_address, rating)
+            self.search_cache.invalidate(item.category)
+        elif op == "wish":
+            _, buyer_address, item_id = record
+            self.add_to_wishlist(buyer_address, item_id)
+        elif op == "unwish":
+            _, buyer_address, item_id = record
+            self.remove_from_wishlist(buyer_address, item_id)
+        elif op == "notify":
+            _, kind, recipients, notification = record
+            pending = self.notifications if kind == "buyer" else self.seller_notifications
+            for recipient in recipients:
+                self.enqueue_notification(pending, recipient, notification)
+        elif op == "fetched":
+            _, kind, recipient = record
+            pending = self.notifications if kind == "buyer" else self.seller_notifications
+            pending.pop(recipient, None)
+
+    def snapshot_state(self, segment):
+        '''
+        Copy the persisted state into plain data. Must be called with every lock held.
+        '''
+        return {
+            "segment": segment,  # First log segment not covered by this snapshot
+            "next_item_id": self.next_item_id,
+            "sellers": {uuid: dict(details) for uuid, details in self.sellers.items()},
+            "items": [(self.item_sellers[item_id], item.state()) for item_id, item in self.items.items()],
+            "ratings": {item_id: (aggregate.total, aggregate.count, set(aggregate.raters))
+                        for item_id, aggregate in self.ratings.items()},
+            "wishlist": {buyer: list(item_ids) for buyer, item_ids in self.wishlist.items()},
+            "notifications": {buyer: pending.copy() for buyer, pending in self.notifications.items()},
+            "seller_notifications": {uuid: pending.copy() for uuid, pending in self.seller_notifications.items()},
+        }
+
+    def restore_state(self, state):
+        '''
+        Rebuild the in-memory state and indexes from a snapshot.
+        '''
+        self.sellers = state["sellers"]
+        for seller_uuid, item_state in state["items"]:
+            self.insert_item(seller_uuid, item_record(item_state))
+        for item_id, (total, count, raters) in state["ratings"].items():
+            aggregate = self.ratings[item_id] = RatingAggregate()
+            aggregate.total, aggregate.count, aggregate.raters = total, count, raters
+        for buyer_address, item_ids in state["wishlist"].items():
+            for item_id in item_ids:
+                self.add_to_wishlist(buyer_address, item_id)
+        self.notifications = state["notifications"]
+        self.seller_notifications = state["seller_notifications"]
+
+    def take_snapshot(self):
+        '''
+        Write a snapshot of the current state and delete the log segments it covers.
+        Writers are paused only while the state is copied; the file is written afterwards.
+        '''
+        with self.snapshot_lock:
+            with self.frozen():
+                segment = self.wal.rotate()
+                state = self.snapshot_state(segment)
+            persistence.write_snapshot(self.data_dir, state)
+            for number in persistence.segment_numbers(self.data_dir):
+                if number < segment:
+                    os.remove(persistence.segment_path(self.data_dir, number))
+            log.info("Snapshot written with %s items", len(state['items']))
+
+    def frozen(self):
+        '''
+        Context manager holding every lock, in order, so nothing changes inside it.
+        '''
+        stack = contextlib.ExitStack()
+        for lock in self.item_locks + [self.catalog_lock, self.wishlist_lock, self.notification_lock]:
+            stack.enter_context(lock)
+        return stack
+
+    def snapshot_loop(self, interval):
+        '''
+        Take a snapshot every interval seconds if anything was logged since the last one.
+        '''
+        while True:
+            time.sleep(interval)
+            if self.wal.segment_bytes:
+                self.take_snapshot()
+
+    def item_lock(self, item_id):
+        '''
+        Return the lock stripe guarding the given item_id.
+        '''
+        return self.item_locks[item_id % ITEM_LOCK_STRIPES]
 
     def identify_interested_buyers(self, item_id):
         '''
         Return a list of buyers interested in the given item_id.
         '''
-        return self.item_watchers.get(item_id, [])
+        with self.wishlist_lock:
+            return list(self.item_watchers.get(item_id, ()))
 
     def RegisterSeller(self, request, context):
         '''
         Register a new seller with the marketplace.
         '''
-        print(f"{datetime.now()} - Seller join request from {request.ip_port}, uuid = {request.uuid}")
-        if request.uuid in self.sellers:
-            return marketplace_pb2.OperationResponse(success=False, message="UUID already registered")
-        self.sellers[request.uuid] = {"ip_port": request.ip_port}
-        return marketplace_pb2.OperationResponse(success=True, message="Seller registered successfully")
+        log.info("Seller join request from %s, uuid = %s", request.ip_port, request.uuid)
+        with self.catalog_lock:
+            if request.uuid in self.sellers:
+                return marketplace_pb2.OperationResponse(success=False, message="UUID already registered")
+            self.sellers[request.uuid] = {"ip_port": request.ip_port}
+            self.persist(("seller", request.uuid, request.ip_port))
+        return self.commit(marketplace_pb2.OperationResponse(success=True, message="Seller registered successfully"))
 
     def AddItem(self, request, context):
         '''
         Add a new item to the marketplace.
         '''
-        print(f"{datetime.now()} - Add Item request from {request.uuid}")
+        log.info("Add Item request from %s", request.uuid)
         if request.uuid not in self.sellers:
             return marketplace_pb2.OperationResponse(success=False, message="Seller UUID not recognized")
-        item = request.item
-        item.id = self.next_item_id
-        self.items[self.next_item_id] = item
-        self.next_item_id += 1
-        return marketplace_pb2.OperationResponse(success=True, message=f"Item added successfully with ID {item.id}")
+        item_id, = self.add_items(request.uuid, [request.item])
+        return self.commit(marketplace_pb2.OperationResponse(success=True, message=f"Item added successfully with ID {item_id}", item_id=item_id))
+
+    def BulkAddItems(self, request, context):
+        '''
+        Add many items for one seller in a single call.
+        '''
+        log.info("Bulk Add %s Items request from %s", len(request.items), request.uuid)
+        if request.uuid not in self.sellers:
+            failure = marketplace_pb2.OperationResponse(success=False, message="Seller UUID not recognized")
+            return marketplace_pb2.BulkOperationResponse(results=[failure] * len(request.items))
+        results = [marketplace_pb2.OperationResponse(success=True, message=f"Item added successfully with ID {item_id}", item_id=item_id)
+                   for item_id in self.add_items(request.uuid, request.items)]
+        return self.commit(marketplace_pb2.BulkOperationResponse(results=results))
+
+    def add_items(self, seller_uuid, items):
+        '''
+        Assign IDs to Item messages and insert them into the catalog under one lock acquisition.
+        Returns the new item IDs in order.
+        '''
+        with self.catalog_lock:
+            # IDs are handed out under the lock so items enter the index in ascending ID order
+            records = [ItemRecord.from_message(self.allocate_item_id(), item) for item in items]
+            # Logged before the items become visible, so a buy, rating or update of a new item
+            # (which take only its stripe lock) is always logged after the item's "add"
+            self.persist(*[("add", seller_uuid, record.id, record.state()) for record in records])
+            for record in records:
+                self.insert_item(seller_uuid, record)
+        return [record.id for record in records]
+
+    def allocate_item_id(self):
+        '''
+        Hand out the next item ID of this shard. Must be called with catalog_lock held.
+        '''
+        item_id = self.next_item_id
+        self.next_item_id += self.shard_count
+        return item_id
+
+    def insert_item(self, seller_uuid, item):
+        '''
+        Put an item into the catalog and its indexes. Must be called with catalog_lock held.
+        '''
+        self.items[item.id] = item
+        self.search_index.add(item.id, item.name, item.category)
+        self.seller_items.setdefault(seller_uuid, {})[item.id] = None
+        self.item_sellers[item.id] = seller_uuid
+        self.search_cache.invalidate(item.category)
+
+    def remove_item(self, item_id):
+        '''
+        Take an item out of the catalog and its indexes, and off the wishlists of its watchers.
+        Must be called with catalog_lock held.
+        '''
+        item = self.items.pop(item_id)
+        self.ratings.pop(item_id, None)
+        seller_uuid = self.item_sellers.pop(item_id)
+        del self.seller_items[seller_uuid][item_id]
+        self.search_index.remove(item_id)
+        self.search_cache.invalidate(item.category)
+        with self.wishlist_lock:
+            for buyer_address in self.item_watchers.pop(item_id, ()):
+                self.discard_wish(buyer_address, item_id)
 
     def SearchItems(self, request, context):
         '''
-        Search for items by name and category.
-        '''
-        print(f"{datetime.now()} - Search request for Item name: {request.name}, Category: {request.category}")
-        result_items = []
-        for item in self.items.values():
-            if (request.category == marketplace_pb2.Category.ANY or item.category == request.category) and (request.name.lower() in item.name.lower() or not request.name):
-                # Check if the item has been rated
-                if item.id in self.ratings:
-                    total_ratings = sum(rating for _, rating in self.ratings[item.id])
-                    average_rating = total_ratings / len(self.ratings[item.id])
-                    item.rating = average_rating
-                else:
-                    item.rating = -1
-                result_items.append(item)
-        return marketplace_pb2.SearchResponse(items=result_items)
+        Search for items by name and category, optionally sorted, filtered by price and rating, and limited.
+        With page_size set, returns at most that many items and a token for the next page.
+        Servers built by create_server answer SearchItems with serialized_search instead, which caches.
+        '''
+        log.info("Search request for Item name: %s, Category: %s", request.name, request.category)
+        order = SearchOrder(request)
+        cursor = self.parse_page_token(order, request.page_token, context)
+        if cursor is None:
+            return marketplace_pb2.SearchResponse()
+        return self.search_page(request, order, cursor, request.page_size)
+
+    def serialized_search(self, request, context):
+        '''
+        SearchItems with its response serialized, for SerializedResponseInterceptor.
+        Responses are cached serialized, so a repeated query is answered with a
+        dictionary lookup, and sent without re-encoding, until an item it could match changes.
+        '''
+        log.info("Search request for Item name: %s, Category: %s", request.name, request.category)
+        category = None if request.category == marketplace_pb2.Category.ANY else request.category
+        order = SearchOrder(request)
+        key = (request.name.lower(), category, request.page_size, request.page_token, order.fields)
+        cached = self.search_cache.get(key, category)
+        if cached is not None:
+            return cached
+        generation = self.search_cache.generation(category)  # Read before searching, so a racing change invalidates the entry
+        cursor = self.parse_page_token(order, request.page_token, context)
+        if cursor is None:
+            return marketplace_pb2.SearchResponse()  # Errors are not cached
+        data = self.search_page(request, order, cursor, request.page_size).SerializeToString()
+        self.search_cache.put(key, generation, data)
+        return data
+
+    def StreamSearchItems(self, request, context):
+        '''
+        Stream search results in pages of page_size (SEARCH_PAGE_SIZE by default) items.
+        Each page is read under its own short catalog lock, so large results never hold it for long.
+        '''
+        log.info("Streaming search request for Item name: %s, Category: %s", request.name, request.category)
+        order = SearchOrder(request)
+        cursor = self.parse_page_token(order, request.page_token, context)
+        if cursor is None:
+            return
+        page_size = request.page_size or SEARCH_PAGE_SIZE
+        while True:
+            response = self.search_page(request, order, cursor, page_size)
+            if response.items:
+                yield response
+            if not response.next_page_token:
+                return
+            cursor = order.parse_token(response.next_page_token)
+
+    def parse_page_token(self, order, page_token, context):
+        '''
+        Return the (key, remaining limit) cursor a page token continues from, see SearchOrder.
+        Sets INVALID_ARGUMENT on the call and returns None for malformed tokens.
+        '''
+        try:
+            return order.parse_token(page_token)
+        except ValueError:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("Invalid page token")
+            return None
+
+    def search_page(self, request, order, cursor, page_size):
+        '''
+        Return the next page_size matching items in the request's order after the cursor
+        (all of them if page_size is 0), stopping at the request's limit.
+        Only a heap of one page is kept while scanning the matches, unless they are in ID order,
+        in which the index already yields them, starting after the cursor.
+        '''
+        after, remaining = cursor
+        count = order.page_count(page_size, remaining)
+        category = None if request.category == marketplace_pb2.Category.ANY else request.category
+        # In ID order the index seeks straight past the previous page
+        after_id = after[0] if after is not None and order.sort_by == marketplace_pb2.SortKey.ID else None
+        with self.catalog_lock:
+            item_ids = self.search_index.iter_search(request.name, category, after_id)
+            # One extra to tell if another page follows
+            result_items = order.select((self.items[item_id] for item_id in item_ids), after,
+                                        None if count is None else count + 1)
+        response = marketplace_pb2.SearchResponse()
+        if count is not None and len(result_items) > count:
+            result_items.pop()
+            response.next_page_token = order.next_token(result_items[-1], count, remaining)
+        for item in result_items:
+            item.fill(response.items.add())
+        return response
 
     def DisplaySellerItems(self, request, context):
         '''
@@ -73,155 +550,348 @@ class MarketplaceService(marketplace_pb2_grpc.MarketplaceServicer):
         if request.uuid not in self.sellers:
             return marketplace_pb2.DisplaySellerItemsResponse()  # Seller not found or other error handling
 
-        seller_items = []
-        for item in self.items.values():
-            if item.seller_address.endswith(request.uuid):
-                # Check if the item has been rated
-                if item.id in self.ratings:
-                    total_ratings = sum(rating for _, rating in self.ratings[item.id])
-                    average_rating = total_ratings / len(self.ratings[item.id])
-                    item.rating = average_rating
-                else:
-                    item.rating = -1
-                seller_items.append(item)
-        return marketplace_pb2.DisplaySellerItemsResponse(items=seller_items)
+        with self.catalog_lock:
+            seller_items = [self.items[item_id] for item_id in self.seller_items.get(request.uuid, {})]
+        response = marketplace_pb2.DisplaySellerItemsResponse()
+        for item in seller_items:
+            item.fill(response.items.add())
+        return response
     
     def DeleteItem(self, request, context):
         '''
         Delete an item from the marketplace.
         '''
-        print(f"{datetime.now()} - Delete Item {request.id} request from {request.uuid}")
+        log.info("Delete Item %s request from %s", request.id, request.uuid)
         if request.uuid not in self.sellers:
             return marketplace_pb2.OperationResponse(success=False, message="Seller UUID not recognized")
-        if request.id in self.items:
-            del self.items[request.id]
-            return marketplace_pb2.OperationResponse(success=True, message="Item deleted successfully")
-        else:
-            return marketplace_pb2.OperationResponse(success=False, message="Item ID not found")
+        with self.item_lock(request.id), self.catalog_lock:
+            if request.id not in self.items:
+                return marketplace_pb2.OperationResponse(success=False, message="Item ID not found")
+            self.remove_item(request.id)
+            self.persist(("delete", request.id))
+        return self.commit(marketplace_pb2.OperationResponse(success=True, message="Item deleted successfully"))
         
     def UpdateItem(self, request, context):
         '''
         Update an item in the marketplace.
         '''
-        print(f"{datetime.now()} - Update Item {request.id} request from {request.uuid}")
+        log.info("Update Item %s request from %s", request.id, request.uuid)
         if request.uuid not in self.sellers:
             return marketplace_pb2.OperationResponse(success=False, message="Seller UUID not recognized")
-        if request.id not in self.items:
-            return marketplace_pb2.OperationResponse(success=False, message="Item ID not found")
-        
-        item = self.items[request.id]
-        item.quantity = request.quantity
-        item.price = request.price
-        self.notify_buyers(request.id, "updated")
+        return self.commit(self.update_item(request))
+
+    def BulkUpdateItems(self, request, context):
+        '''
+        Apply many item updates for one seller in a single call.
+        '''
+        log.info("Bulk Update %s Items request from %s", len(request.updates), request.uuid)
+        if request.uuid not in self.sellers:
+            failure = marketplace_pb2.OperationResponse(success=False, message="Seller UUID not recognized")
+            return marketplace_pb2.BulkOperationResponse(results=[failure] * len(request.updates))
+        return self.commit(marketplace_pb2.BulkOperationResponse(results=[self.update_item(update) for update in request.updates]))
+
+    def update_item(self, request):
+        '''
+        Set an item's quantity and price and notify its watchers.
+        '''
+        with self.item_lock(request.id):
+            item = self.items.get(request.id)
+            if item is None:
+                return marketplace_pb2.OperationResponse(success=False, message="Item ID not found")
+            item.quantity = request.quantity
+            item.price = request.price
+            self.search_cache.invalidate(item.category)
+            self.persist(("update", request.id, request.quantity, request.price))
+            self.notify_buyers(request.id, "updated")
         return marketplace_pb2.OperationResponse(success=True, message="Item updated successfully")
     
     def BuyItem(self, request, context):
         '''
         Buy an item from the marketplace.
         '''
-        print(f"{datetime.now()} - Buy request {request.quantity} of item {request.item_id}, from {request.buyer_address}")
-        if request.item_id not in self.items:
-            return marketplace_pb2.OperationResponse(success=False, message="Item not found")
-        item = self.items[request.item_id]
-        if item.quantity < request.quantity:
-            return marketplace_pb2.OperationResponse(success=False, message="Not enough stock available")
-        item.quantity -= request.quantity
-        seller_uuid = self.find_seller_uuid_by_item_id(request.item_id)
-        if seller_uuid:
-            self.notify_seller(seller_uuid, item, request.quantity, request.buyer_address)
-
-        self.notify_buyers(request.item_id, "purchased")
+        log.info("Buy request %s of item %s, from %s", request.quantity, request.item_id, request.buyer_address)
+        return self.commit(self.buy_item(request))
+
+    def BuyItems(self, request, context):
+        '''
+        Place many orders in a single call. Each order succeeds or fails on its own.
+        '''
+        log.info("Buy request for %s orders", len(request.orders))
+        return self.commit(marketplace_pb2.BulkOperationResponse(results=[self.buy_item(order) for order in request.orders]))
+
+    def buy_item(self, request):
+        '''
+        Take stock for one order and notify the seller and the item's watchers.
+        '''
+        # The stock check and decrement happen under the item's lock so concurrent buys cannot oversell
+        with self.item_lock(request.item_id):
+            item = self.items.get(request.item_id)
+            if item is None:
+                return marketplace_pb2.OperationResponse(success=False, message="Item not found")
+            if item.quantity < request.quantity:
+                return marketplace_pb2.OperationResponse(success=False, message="Not enough stock available")
+            item.quantity -= request.quantity
+            self.search_cache.invalidate(item.category)
+            self.persist(("stock", request.item_id, item.quantity))
+            seller_uuid = self.find_seller_uuid_by_item_id(request.item_id)
+            if seller_uuid:
+                self.notify_seller(seller_uuid, item, request.quantity, request.buyer_address)
+
+            self.notify_buyers(request.item_id, "purchased")
         return marketplace_pb2.OperationResponse(success=True, message="Purchase successful")
 
     def RateItem(self, request, context):
         '''
         Rate an item in the marketplace.
         '''
-        # Existing rate item
-        if request.item_id not in self.ratings:
-            self.ratings[request.item_id] = []
-        elif any(buyer_address == request.buyer_address for buyer_address, _ in self.ratings[request.item_id]):
-            return marketplace_pb2.OperationResponse(success=False, message="Buyer has already rated this item")
-        # Add the new rating
-        self.ratings[request.item_id].append((request.buyer_address, request.rating))
-        # Update item's average rating
-        total_ratings = sum(rating for _, rating in self.ratings[request.item_id])
-        average_rating = total_ratings / len(self.ratings[request.item_id])
-        item = self.items[request.item_id]  # Assuming this exists from your item addition logic
-        item.rating = average_rating  # Assuming your item proto has a rating field
-        return marketplace_pb2.OperationResponse(success=True, message="Rating successful, average rating updated.")
+        with self.item_lock(request.item_id):
+            item = self.items.get(request.item_id)
+            if item is None:
+                return marketplace_pb2.OperationResponse(success=False, message="Item not found")
+            aggregate = self.ratings.setdefault(request.item_id, RatingAggregate())
+            if request.buyer_address in aggregate.raters:
+                return marketplace_pb2.OperationResponse(success=False, message="Buyer has already rated this item")
+            # Keep the stored average current so reads never recompute it
+            item.rating = aggregate.add(request.buyer_address, request.rating)
+            self.search_cache.invalidate(item.category)
+            self.persist(("rate", request.item_id, request.buyer_address, request.rating))
+        return self.commit(marketplace_pb2.OperationResponse(success=True, message="Rating successful, average rating updated."))
 
     def find_seller_uuid_by_item_id(self, item_id):
         '''
         Find the seller's UUID given an item ID.
         '''
-        item = self.items.get(item_id)
-        if item:
-            print("find seller by uuid by item id", item.seller_address)
-            print(item.seller_address)
-            return item.seller_address
-        return None
+        return self.item_sellers.get(item_id)
 
-    def notify_seller(self, seller_address, item, quantity_sold, buyer_address):
+    def notify_seller(self, seller_uuid, item, quantity_sold, buyer_address):
         '''
         Notify the seller of a purchase.
         '''
-        print("seller address: ", seller_address)
-        # Extract UUID from seller_address
-        seller_uuid = seller_address.split(':')[1]  # Adjust based on your actual format
-        print("Server UUID:", seller_uuid)
-
-        print("Important, UUID:", seller_uuid)
-        
-        message = f"Item Sold: {item.name}, Quantity: {quantity_sold}, Buyer: {buyer_address}"
-        if seller_uuid not in self.seller_notifications:
-            print("This is something I don't understand")
-            self.seller_notifications[seller_uuid] = []
-        print("Seller UUID in storage")
-        self.seller_notifications[seller_uuid].append(message)
-        print(f"Notification stored for seller {seller_uuid}: {message}")
+        notification = SaleNotification(item.name, quantity_sold, buyer_address)
+        with self.notification_lock:
+            if self.push_notification(self.seller_subscribers, seller_uuid, notification):
+                log.debug("Notification pushed to seller %s: %s", seller_uuid, notification)
+                return
+            self.enqueue_notification(self.seller_notifications, seller_uuid, notification)
+            self.persist(("notify", "seller", [seller_uuid], notification))
+        log.debug("Notification stored for seller %s: %s", seller_uuid, notification)
 
     def FetchSellerNotifications(self, request, context):
         '''
         Fetch notifications for a seller.
         '''
-        seller_uuid = request.uuid
-        notifications = self.seller_notifications.get(seller_uuid, [])
-        self.seller_notifications[seller_uuid] = []  
-        return marketplace_pb2.NotificationResponse(messages=notifications)
+        return self.fetch_notifications("seller", self.seller_notifications, request.uuid)
     
     def FetchNotifications(self, request, context):
         '''
         Fetch notifications for a buyer.
         '''
-        messages = self.notifications.get(request.buyer_address, [])
-        if messages:
-            print(f"{datetime.now()} - Sending notifications to {request.buyer_address}: {messages}")
+        response = self.fetch_notifications("buyer", self.notifications, request.buyer_address)
+        if response.messages:
+            log.debug("Sending %s notifications to %s", len(response.messages), request.buyer_address)
+        return response
+
+    def fetch_notifications(self, kind, pending, recipient):
+        '''
+        Drain a recipient's queue into a NotificationResponse.
+        '''
         # Clear notifications after fetching
-        self.notifications[request.buyer_address] = []
-        return marketplace_pb2.NotificationResponse(messages=messages)
+        with self.notification_lock:
+            notifications = pending.pop(recipient, None)
+            if notifications is not None:
+                self.persist(("fetched", kind, recipient))
+        if notifications is None:
+            return marketplace_pb2.NotificationResponse()
+        dropped = notifications.dropped
+        messages = [notification.text for notification in notifications.drain()]
+        return marketplace_pb2.NotificationResponse(messages=messages, dropped=dropped)
+
+    def enqueue_notification(self, pending, recipient, notification):
+        '''
+        Queue a notification for a recipient without an open stream, to be fetched later.
+        Must be called with notification_lock held.
+        '''
+        notifications = pending.get(recipient)
+        if notifications is None:
+            notifications = pending[recipient] = NotificationQueue(NOTIFICATION_QUEUE_SIZE)
+        coalesced, dropped = notifications.push(notification)
+        self.notifications_coalesced += coalesced
+        self.notifications_dropped += dropped
+
+    def GetStats(self, request, context):
+        '''
+        Report per-method call counts, error counts and latency percentiles, plus in-flight calls and queue depth,
+        and the search cache's hit rate.
+        '''
+        response = stats_response(self.metrics)
+        hits, misses, stale, evictions, entries = self.search_cache.stats()
+        response.search_cache.CopyFrom(marketplace_pb2.SearchCacheStats(hits=hits, misses=misses, stale=stale,
+                                                                        evictions=evictions, entries=entries))
+        return response
+
+    def GetNotificationStats(self, request, context):
+        '''
+        Report the depth of the pending notification queues and how many notifications were coalesced or dropped.
+        '''
+        with self.notification_lock:
+            depths = [len(notifications) for pending in (self.notifications, self.seller_notifications)
+                      for notifications in pending.values()]
+            return marketplace_pb2.NotificationStats(
+                queues=len(depths),
+                pending=sum(depths),
+                max_depth=max(depths, default=0),
+                coalesced=self.notifications_coalesced,
+                dropped=self.notifications_dropped,
+                streams=sum(len(queues) for queues in self.subscribers.values()) +
+                        sum(len(queues) for queues in self.seller_subscribers.values()))
     
+    def push_notification(self, subscribers, recipient, notification):
+        '''
+        Hand a notification to the recipient's open streams.
+        Returns False if the recipient has no stream, so the caller can queue it for fetching.
+        Must be called with notification_lock held.
+        '''
+        queues = subscribers.get(recipient)
+        if not queues:
+            return False
+        for q in queues:
+            q.put(notification)
+        return True
+
+    def open_subscription(self, request, q):
+        '''
+        Register a queue (anything with a put method) for a seller's (uuid) or buyer's (buyer_address) notifications.
+        Returns the key to pass to close_subscription and the notifications queued before the stream opened.
+        The queue is fed notification objects; streams send their text.
+        '''
+        if request.uuid:
+            kind, recipient, subscribers, pending = "seller", request.uuid, self.seller_subscribers, self.seller_notifications
+        else:
+            kind, recipient, subscribers, pending = "buyer", request.buyer_address, self.subscribers, self.notifications
+        log.debug("Notification stream opened for %s", recipient)
+        # Register and take the backlog atomically so no notification slips between the two
+        with self.notification_lock:
+            subscribers.setdefault(recipient, set()).add(q)
+            backlog = pending.pop(recipient, None)
+            if backlog is not None:
+                self.persist(("fetched", kind, recipient))
+        return (subscribers, recipient), backlog.drain() if backlog is not None else []
+
+    def close_subscription(self, key, q):
+        '''
+        Unregister a queue added by open_subscription.
+        '''
+        subscribers, recipient = key
+        with self.notification_lock:
+            queues = subscribers.get(recipient)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del subscribers[recipient]
+        log.debug("Notification stream closed for %s", recipient)
+
+    def SubscribeNotifications(self, request, context):
+        '''
+        Stream notifications to a seller (by uuid) or buyer (by buyer_address).
+        Anything queued before the stream opened is sent first.
+        Refused with RESOURCE_EXHAUSTED when too many streams are open.
+        '''
+        if not self.streams.acquire(context):
+            return
+        q = queue.SimpleQueue()
+        key, backlog = self.open_subscription(request, q)
+        context.add_callback(lambda: q.put(None))  # Wake the stream up when the client goes away
+        try:
+            if backlog:
+                yield marketplace_pb2.NotificationResponse(messages=[notification.text for notification in backlog])
+            while True:
+                notification = q.get()
+                if notification is None:
+                    break
+                messages = [notification.text]
+                # Send anything else that arrived meanwhile in the same response
+                while not q.empty():
+                    notification = q.get()
+                    if notification is None:
+                        return
+                    messages.append(notification.text)
+                yield marketplace_pb2.NotificationResponse(messages=messages)
+        finally:
+            self.close_subscription(key, q)
+            self.streams.release()
+
+    def open_replication(self, sink):
+        '''
+        Start feeding catalog changes to a replica's sink. Returns the encoded
+        state the changes apply to; taking it and subscribing happen atomically.
+        '''
+        with self.frozen():
+            state = self.snapshot_state(0)
+            self.replicas.subscribe(sink)
+        return encode_snapshot(state)
+
+    def Replicate(self, request, context):
+        '''
+        Stream the catalog to a read replica: its current state, then each change
+        as it is logged, batched while the replica catches up. A heartbeat is
+        sent every REPLICATION_HEARTBEAT seconds when nothing changes. Every batch
+        carries the time up to which it brings the replica current, from which
+        the replica tells how far behind it is.
+        '''
+        q = queue.SimpleQueue()
+        sink = ReplicaSink(q)
+        as_of = time.time()  # Taken first, as the snapshot may include changes made while it is taken
+        snapshot = self.open_replication(sink)
+        context.add_callback(lambda: q.put(None))  # Wake the stream up when the replica goes away
+        log.info("Replica %s connected", context.peer())
+        try:
+            yield marketplace_pb2.ReplicationBatch(snapshot=snapshot, as_of=as_of)
+            while True:
+                try:
+                    records = q.get(timeout=REPLICATION_HEARTBEAT)
+                except queue.Empty:
+                    yield marketplace_pb2.ReplicationBatch(as_of=time.time())
+                    continue
+                # Send everything else queued meanwhile in the same batch
+                batches = []
+                while records is not None:
+                    batches.append(records)
+                    as_of = time.time()  # Once the queue is empty, every change logged before this is in the batch
+                    if q.empty():
+                        break
+                    records = q.get()
+                if batches:
+                    yield marketplace_pb2.ReplicationBatch(records=encode_records(batches), as_of=as_of)
+                if records is None:
+                    break
+        finally:
+            self.replicas.unsubscribe(sink)
+            if sink.overflowed:
+                log.warning("Replica %s fell too far behind and was disconnected", context.peer())
+            else:
+                log.info("Replica %s disconnected", context.peer())
+
     def notify_buyers(self, item_id, action):
         '''
         Notify buyers interested in an item about updates or purchases.
         '''
-        interested_buyers = self.item_watchers.get(item_id, [])
-        if item_id in self.items:
-            item = self.items[item_id]
-            # Format the item details into a notification message
-            notification_message = f"\n#######\n\nThe Following Item has been {action}:\n\n" \
-                                f"Item ID: {item.id}, Price: ${item.price}, Name: {item.name}, " \
-                                f"Category: {self.get_category_name(item.category)},\n" \
-                                f"Description: {item.description}.\n" \
-                                f"Quantity Remaining: {item.quantity}\n" \
-                                f"Rating: {item.rating} / 5  |  Seller: {item.seller_address}\n\n#######"
-            for buyer in interested_buyers:
-                if buyer not in self.notifications:
-                    self.notifications[buyer] = []
-                self.notifications[buyer].append(notification_message)
-                print(f"{datetime.now()} - Notification stored for {buyer}: Item {item_id} has been {action}.")
+        interested_buyers = self.identify_interested_buyers(item_id)
+        item = self.items.get(item_id)
+        if item is not None:
+            # One shared record for every watcher; its text is formatted on first delivery
+            notification = ItemNotification(item, action, self.get_category_name(item.category))
+            stored = []
+            with self.notification_lock:
+                for buyer in interested_buyers:
+                    if not self.push_notification(self.subscribers, buyer, notification):
+                        self.enqueue_notification(self.notifications, buyer, notification)
+                        stored.append(buyer)
+                if stored:
+                    self.persist(("notify", "buyer", stored, notification))
+            if interested_buyers:
+                log.debug("Item %s has been %s: notified %s watchers, %s stored for fetching.", item_id, action, len(interested_buyers), len(stored))
         else:
-            print(f"{datetime.now()} - Attempted to notify buyers for a non-existent item: {item_id}.")
+            log.debug("Attempted to notify buyers for a non-existent item: %s.", item_id)
 
     def get_category_name(self, category):
         '''
@@ -236,36 +906,156 @@ class MarketplaceService(marketplace_pb2_grpc.MarketplaceServicer):
         '''
         Add an item to a buyer's wishlist.
         '''
-        if request.item_id not in self.items:
-            print(f"{datetime.now()} - Wishlist addition failed: Item {request.item_id} not found for {request.buyer_address}.")
-            return marketplace_pb2.OperationResponse(success=False, message="Item not found")
+        # The item is looked up under wishlist_lock, which DeleteItem takes after
+        # removing an item to clear its watchers, so no wish outlives its item
+        with self.wishlist_lock:
+            if request.item_id not in self.items:
+                log.info("Wishlist addition failed: Item %s not found for %s.", request.item_id, request.buyer_address)
+                return marketplace_pb2.OperationResponse(success=False, message="Item not found")
+            added = self.add_to_wishlist(request.buyer_address, request.item_id)
+            if added:
+                self.persist(("wish", request.buyer_address, request.item_id))
 
-        if request.buyer_address not in self.wishlist:
-            self.wishlist[request.buyer_address] = []
-        
-        if request.item_id not in self.wishlist[request.buyer_address]:
-            self.wishlist[request.buyer_address].append(request.item_id)
-            # Update 'item_watchers' for notification purposes
-            if request.item_id not in self.item_watchers:
-                self.item_watchers[request.item_id] = []
-            self.item_watchers[request.item_id].append(request.buyer_address)
-            
-            print(f"{datetime.now()} - Item {request.item_id} added to wishlist for {request.buyer_address}.")
-            return marketplace_pb2.OperationResponse(success=True, message="Item added to wishlist")
+        if added:
+            log.info("Item %s added to wishlist for %s.", request.item_id, request.buyer_address)
+            return self.commit(marketplace_pb2.OperationResponse(success=True, message="Item added to wishlist"))
         else:
-            print(f"{datetime.now()} - Item {request.item_id} already in wishlist for {request.buyer_address}.")
+            log.info("Item %s already in wishlist for %s.", request.item_id, request.buyer_address)
             return marketplace_pb2.OperationResponse(success=False, message="Item already in wishlist")
 
-def serve():
+    def add_to_wishlist(self, buyer_address, item_id):
+        '''
+        Add an item to a buyer's wishlist and watch it. Returns False if it was already there.
+        Must be called with wishlist_lock held.
+        '''
+        wishes = self.wishlist.setdefault(buyer_address, {})
+        if item_id in wishes:
+            return False
+        wishes[item_id] = None
+        # Update 'item_watchers' for notification purposes
+        self.item_watchers.setdefault(item_id, {})[buyer_address] = None
+        return True
+
+    def RemoveFromWishList(self, request, context):
+        '''
+        Remove an item from a buyer's wishlist, so they stop being notified about it.
+        '''
+        with self.wishlist_lock:
+            removed = self.remove_from_wishlist(request.buyer_address, request.item_id)
+            if removed:
+                self.persist(("unwish", request.buyer_address, request.item_id))
+        if removed:
+            log.info("Item %s removed from wishlist for %s.", request.item_id, request.buyer_address)
+            return self.commit(marketplace_pb2.OperationResponse(success=True, message="Item removed from wishlist"))
+        return marketplace_pb2.OperationResponse(success=False, message="Item not in wishlist")
+
+    def remove_from_wishlist(self, buyer_address, item_id):
+        '''
+        Take an item off a buyer's wishlist and stop them watching it. Returns False if it was not there.
+        Must be called with wishlist_lock held.
+        '''
+        if not self.discard_wish(buyer_address, item_id):
+            return False
+        watchers = self.item_watchers[item_id]
+        del watchers[buyer_address]
+        if not watchers:
+            del self.item_watchers[item_id]
+        return True
+
+    def discard_wish(self, buyer_address, item_id):
+        '''
+        Take an item off a buyer's wishlist only, dropping the wishlist once empty.
+        Returns False if it was not there. Must be called with wishlist_lock held.
+        '''
+        wishes = self.wishlist.get(buyer_address)
+        if wishes is None or item_id not in wishes:
+            return False
+        del wishes[item_id]
+        if not wishes:
+            del self.wishlist[buyer_address]
+        return True
+
+    def GetWishList(self, request, context):
+        '''
+        Return the items on a buyer's wishlist, in the order they were added.
+        '''
+        with self.wishlist_lock:
+            item_ids = list(self.wishlist.get(request.buyer_address, ()))
+        response = marketplace_pb2.WishListResponse()
+        for item_id in item_ids:
+            item = self.items.get(item_id)
+            if item is not None:  # Deleted since the wishlist was read
+                item.fill(response.items.add())
+        return response
+
+def stats_response(metrics):
     '''
-    Start the server.
+    Build a StatsResponse from RpcMetrics (an empty one if metrics is None).
+    '''
+    if metrics is None:
+        return marketplace_pb2.StatsResponse()
+    response = marketplace_pb2.StatsResponse(queue_depth=metrics.queue_depth(),
+                                             uptime_seconds=time.time() - metrics.started)
+    for method, calls, errors, in_flight, p50, p95, p99, slowest in metrics.snapshot():
+        response.methods.add(method=method, calls=calls, errors=errors, in_flight=in_flight,
+                             p50_ms=p50 * 1000, p95_ms=p95 * 1000, p99_ms=p99 * 1000, max_ms=slowest * 1000)
+        response.in_flight += in_flight
+    return response
+
+def create_server(port=50051, max_workers=MAX_WORKERS, data_dir=None, snapshot_interval=SNAPSHOT_INTERVAL,
+                  shard_index=0, shard_count=1, service=None):
     '''
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    marketplace_pb2_grpc.add_MarketplaceServicer_to_server(MarketplaceService(), server)
-    server.add_insecure_port('[::]:50051')
-    print("Market Server started. Listening on port 50051.")
+    Build and start a server without blocking. Port 0 picks a free port.
+    Serves the given service (e.g. a ReplicaService), or a new MarketplaceService.
+    Returns (server, service, bound port).
+    '''
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    if service is None:
+        service = MarketplaceService(data_dir, snapshot_interval, shard_index=shard_index, shard_count=shard_count)
+    service.metrics = RpcMetrics(executor)
+    service.streams = stream_limit(max_workers)
+    interceptors = [MetricsInterceptor(service.metrics),
+                    SerializedResponseInterceptor({SEARCH_ITEMS: service.serialized_search})]
+    server = grpc.server(executor, interceptors=interceptors, options=SERVER_OPTIONS)
+    marketplace_pb2_grpc.add_MarketplaceServicer_to_server(service, server)
+    port = server.add_insecure_port(f'[::]:{port}')
     server.start()
+    return server, service, port
+
+def serve(port=50051, max_workers=MAX_WORKERS, data_dir=None, snapshot_interval=SNAPSHOT_INTERVAL,
+          shard_index=0, shard_count=1, service=None):
+    '''
+    Start the server.
+    '''
+    server, _, port = create_server(port, max_workers, data_dir, snapshot_interval, shard_index, shard_count, service)
+    log.info("Market Server started. Listening on port %s with %s workers.", port, max_workers)
+    if shard_count > 1:
+        log.info("Serving as shard %s of %s.", shard_index, shard_count)
     server.wait_for_termination()
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the marketplace server.")
+    parser.add_argument("--port", type=int, default=50051, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Size of the RPC thread pool")
+    parser.add_argument("--aio", action="store_true", help="Serve with grpc.aio on an asyncio event loop instead of a thread pool")
+    parser.add_argument("--data-dir", help="Directory for the write-ahead log and snapshots; state is kept in memory only if omitted")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL, help="Seconds between snapshots")
+    parser.add_argument("--shard-index", type=int, default=0, help="This server's shard number when run behind shard_router.py")
+    parser.add_argument("--shard-count", type=int, default=1, help="Total number of shards")
+    parser.add_argument("--replica-of", help="Run as a read-only replica of the primary server at this address")
+    parser.add_argument("--max-staleness", type=float, help="Seconds a replica may lag the primary and still serve reads (default 5)")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING or ERROR (default: $LOG_LEVEL or INFO)")
+    parser.add_argument("--log-sample", type=float, help="Fraction of records below WARNING to keep (default: $LOG_SAMPLE_RATE or 1)")
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_sample)
+    if args.replica_of:
+        if args.aio or args.data_dir:
+            parser.error("a replica keeps no data directory and cannot run with --aio")
+        from replica_server import MAX_STALENESS, ReplicaService
+        replica = ReplicaService(args.replica_of, args.max_staleness or MAX_STALENESS)
+        serve(args.port, args.workers, service=replica)
+    elif args.aio:
+        from async_market_server import serve_async
+        asyncio.run(serve_async(args.port, args.data_dir, args.snapshot_interval, args.shard_index, args.shard_count))
+    else:
+        serve(args.port, args.workers, args.data_dir, args.snapshot_interval, args.shard_index, args.shard_count)
\ No newline at end of file
@@ -0,0 +1,222 @@
+import bisect
+import threading
+import time
+import grpc
+
+def latency_bounds(per_doubling):
+    '''
+    Histogram bucket upper bounds in seconds: 10us doubling every per_doubling buckets, up to about 3 minutes.
+    '''
+    return [0.00001 * 2 ** (i / per_doubling) for i in range(24 * per_doubling + 1)]
+
+LATENCY_BOUNDS = latency_bounds(4)  # Buckets about 19% wide, for the server's per-method statistics
+
+class LatencyHistogram:
+    '''
+    Fixed log-scale histogram of latencies. Percentiles are reported as the
+    upper bound of the bucket they fall in, so they are accurate to a bucket's
+    width: about 19% with the default bounds.
+    '''
+    __slots__ = ("bounds", "counts", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket catches anything slower
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        '''
+        Add the calls recorded in another histogram, with the same bounds, to this one.
+        '''
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        '''
+        Latency in seconds below which `fraction` of the recorded calls fall.
+        '''
+        if not self.total:
+            return 0.0
+        rank = fraction * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+class MethodStats:
+    '''
+    Counters for one RPC method.
+    '''
+    __slots__ = ("calls", "errors", "in_flight", "latency", "lock")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = LatencyHistogram()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, seconds, failed):
+        with self.lock:
+            self.in_flight -= 1
+            self.calls += 1
+            self.errors += failed
+            self.latency.record(seconds)
+
+class RpcMetrics:
+    '''
+    Per-method call counts, error counts, latency histograms and in-flight gauges,
+    filled in by MetricsInterceptor or AsyncMetricsInterceptor.
+    '''
+    def __init__(self, executor=None):
+        self.methods = {}  # Maps full method name to MethodStats
+        self.lock = threading.Lock()  # Guards adding to self.methods
+        self.executor = executor  # Thread pool serving RPCs, for queue depth
+        self.started = time.time()
+
+    def method(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            with self.lock:
+                stats = self.methods.setdefault(name, MethodStats())
+        return stats
+
+    def snapshot(self):
+        '''
+        Return (method, calls, errors, in_flight, p50, p95, p99, max) per method, latencies in seconds.
+        '''
+        with self.lock:
+            methods = sorted(self.methods.items())
+        rows = []
+        for name, stats in methods:
+            with stats.lock:
+                latency = stats.latency
+                rows.append((name, stats.calls, stats.errors, stats.in_flight, latency.percentile(0.5),
+                             latency.percentile(0.95), latency.percentile(0.99), latency.max))
+        return rows
+
+    def queue_depth(self):
+        '''
+        RPCs waiting for a free worker thread (0 without a thread pool).
+        '''
+        work_queue = getattr(self.executor, "_work_queue", None)
+        return work_queue.qsize() if work_queue is not None else 0
+
+def failed(context):
+    '''
+    Whether the handler set a non-OK status on the call.
+    '''
+    code = context.code()
+    return code is not None and code != grpc.StatusCode.OK
+
+def wrap_handler(handler, wrap_unary, wrap_stream):
+    '''
+    Rebuild a method handler with its behaviour wrapped, keeping its serializers.
+    '''
+    if handler.unary_unary:
+        factory, behavior = grpc.unary_unary_rpc_method_handler, wrap_unary(handler.unary_unary)
+    elif handler.unary_stream:
+        factory, behavior = grpc.unary_stream_rpc_method_handler, wrap_stream(handler.unary_stream)
+    elif handler.stream_unary:
+        factory, behavior = grpc.stream_unary_rpc_method_handler, wrap_unary(handler.stream_unary)
+    else:
+        factory, behavior = grpc.stream_stream_rpc_method_handler, wrap_stream(handler.stream_stream)
+    return factory(behavior,
+                   request_deserializer=handler.request_deserializer,
+                   response_serializer=handler.response_serializer)
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    '''
+    Server interceptor that times every call into RpcMetrics.
+    Streaming calls are timed until the last response is sent.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None  # Unknown method, don't create stats for it
+        stats = self.metrics.method(handler_call_details.method)
+
+        def wrap_unary(behavior):
+            def timed(request, context):
+                stats.start()
+                started = time.perf_counter()
+                error = True
+                try:
+                    response = behavior(request, context)
+                    error = failed(context)
+                    return response
+                finally:
+                    stats.finish(time.perf_counter() - started, error)
+            return timed
+
+        def wrap_stream(behavior):
+            def timed(request, context):
+                stats.start()
+                started = time.perf_counter()
+                error = True
+                try:
+                    yield from behavior(request, context)
+                    error = failed(context)
+                finally:
+                    stats.finish(time.perf_counter() - started, error)
+            return timed
+
+        return wrap_handler(handler, wrap_unary, wrap_stream)
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    '''
+    grpc.aio counterpart of MetricsInterceptor.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None  # Unknown method, don't create stats for it
+        stats = self.metrics.method(handler_call_details.method)
+
+        def wrap_unary(behavior):
+            async def timed(request, context):
+                stats.start()
+                started = time.perf_counter()
+                error = True
+                try:
+                    response = await behavior(request, context)
+                    error = failed(context)
+                    return response
+                finally:
+                    stats.finish(time.perf_counter() - started, error)
+            return timed
+
+        def wrap_stream(behavior):
+            async def timed(request, context):
+                stats.start()
+                started = time.perf_counter()
+                error = True
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                    error = failed(context)
+                finally:
+                    stats.finish(time.perf_counter() - started, error)
+            return timed
+
+        return wrap_handler(handler, wrap_unary, wrap_stream)
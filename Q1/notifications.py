@@ -0,0 +1,122 @@
+import collections
+
+class ItemNotification:
+    '''
+    An update to or purchase of a wishlisted item.
+    One instance is shared by every watcher of the item, and its text is only
+    formatted once, the first time it is delivered.
+    '''
+    __slots__ = ("item_id", "action", "price", "name", "category", "description",
+                 "quantity", "rating", "seller_address", "formatted")
+
+    def __init__(self, item, action, category):
+        self.item_id = item.id
+        self.action = action
+        self.price = item.price
+        self.name = item.name
+        self.category = category  # Readable category name
+        self.description = item.description
+        self.quantity = item.quantity
+        self.rating = item.rating
+        self.seller_address = item.seller_address
+        self.formatted = None
+
+    @property
+    def key(self):
+        '''
+        Watchers only care about an item's latest state, so queued notifications for the same item coalesce.
+        '''
+        return ("item", self.item_id)
+
+    @property
+    def text(self):
+        if self.formatted is None:
+            self.formatted = f"\n#######\n\nThe Following Item has been {self.action}:\n\n" \
+                             f"Item ID: {self.item_id}, Price: ${self.price}, Name: {self.name}, " \
+                             f"Category: {self.category},\n" \
+                             f"Description: {self.description}.\n" \
+                             f"Quantity Remaining: {self.quantity}\n" \
+                             f"Rating: {self.rating} / 5  |  Seller: {self.seller_address}\n\n#######"
+        return self.formatted
+
+    def __str__(self):
+        return self.text
+
+class SaleNotification:
+    '''
+    A purchase of one of a seller's items. Every sale is reported, so these never coalesce.
+    '''
+    __slots__ = ("name", "quantity", "buyer_address", "formatted")
+    key = None
+
+    def __init__(self, name, quantity, buyer_address):
+        self.name = name
+        self.quantity = quantity
+        self.buyer_address = buyer_address
+        self.formatted = None
+
+    @property
+    def text(self):
+        if self.formatted is None:
+            self.formatted = f"Item Sold: {self.name}, Quantity: {self.quantity}, Buyer: {self.buyer_address}"
+        return self.formatted
+
+    def __str__(self):
+        return self.text
+
+class NotificationQueue:
+    '''
+    Bounded queue of one recipient's pending notifications.
+    A notification whose key matches a queued one replaces it and moves to the
+    back. Once the queue holds `capacity` notifications, the oldest is dropped
+    to make room.
+    '''
+    __slots__ = ("pending", "capacity", "dropped", "sequence")
+
+    def __init__(self, capacity):
+        self.pending = collections.OrderedDict()  # Maps coalescing key to notification, oldest first
+        self.capacity = capacity
+        self.dropped = 0  # Notifications dropped since the queue was last drained
+        self.sequence = 0  # Source of unique keys for notifications that never coalesce
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, notification):
+        '''
+        Queue a notification. Returns (coalesced, dropped): whether it replaced a
+        queued notification and how many old ones were dropped to fit it.
+        '''
+        key = notification.key
+        if key is None:
+            self.sequence += 1
+            key = self.sequence
+        coalesced = key in self.pending
+        if coalesced:
+            del self.pending[key]
+        self.pending[key] = notification
+        dropped = 0
+        while len(self.pending) > self.capacity:
+            self.pending.popitem(last=False)
+            dropped += 1
+        self.dropped += dropped
+        return coalesced, dropped
+
+    def drain(self):
+        '''
+        Remove and return the queued notifications, oldest first.
+        '''
+        notifications = list(self.pending.values())
+        self.pending.clear()
+        self.dropped = 0
+        return notifications
+
+    def copy(self):
+        '''
+        Return an independent copy of the queue.
+        '''
+        clone = NotificationQueue(self.capacity)
+        clone.pending = collections.OrderedDict(self.pending)
+        clone.dropped = self.dropped
+        clone.sequence = self.sequence
+        return clone
@@ -0,0 +1,203 @@
+import asyncio
+import glob
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+FRAME_HEADER = struct.Struct("<II")  # Payload length and CRC32 of every log record
+SNAPSHOT_FILE = "snapshot.pickle"
+
+def segment_path(data_dir, number):
+    '''
+    Path of the numbered log segment in data_dir.
+    '''
+    return os.path.join(data_dir, f"wal-{number:08d}.log")
+
+def segment_numbers(data_dir):
+    '''
+    Numbers of the log segments present in data_dir, in ascending order.
+    '''
+    names = glob.glob(os.path.join(data_dir, "wal-*.log"))
+    return sorted(int(os.path.basename(name)[4:-4]) for name in names)
+
+def fsync_dir(data_dir):
+    '''
+    Make renames and deletions in data_dir durable.
+    '''
+    fd = os.open(data_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_segment(path):
+    '''
+    Yield the records of a log segment in order.
+    A torn or corrupt record (from a crash mid-write) ends the segment; it is
+    truncated there so later appends never follow garbage.
+    '''
+    with open(path, "r+b") as f:
+        good = 0
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            length, crc = FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            good = f.tell()
+            yield pickle.loads(payload)
+        if f.seek(0, os.SEEK_END) != good:
+            f.truncate(good)
+
+def write_snapshot(data_dir, state):
+    '''
+    Atomically replace the snapshot in data_dir.
+    '''
+    path = os.path.join(data_dir, SNAPSHOT_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(data_dir)
+
+def load_snapshot(data_dir):
+    '''
+    Return the state saved by write_snapshot, or None if there is none.
+    '''
+    path = os.path.join(data_dir, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+class WriteAheadLog:
+    '''
+    Append-only log of state changes, split into numbered segment files.
+    Records are buffered by append() and written by a background thread that
+    fsyncs once per batch (group commit), so many concurrent writers share one
+    fsync. Every record gets a log sequence number (LSN); wait() and
+    wait_async() block until a given LSN is on disk.
+    '''
+    def __init__(self, data_dir, segment):
+        self.data_dir = data_dir
+        self.segment = segment
+        self.file = open(segment_path(data_dir, segment), "ab")
+        self.buffer = bytearray()
+        self.lsn = 0  # LSN of the last appended record
+        self.durable_lsn = 0  # LSN of the last record known to be on disk
+        self.segment_bytes = 0  # Bytes appended to the current segment
+        self.cond = threading.Condition()
+        self.async_waiters = []  # (lsn, loop, future) waiting in wait_async
+        self.local = threading.local()  # Last LSN appended by each thread
+        self.closed = False
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, *records):
+        '''
+        Buffer records for the next group commit and return the LSN of the last one.
+        '''
+        frames = []
+        for record in records:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            frames.append(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)))
+            frames.append(payload)
+        data = b"".join(frames)
+        with self.cond:
+            self.buffer += data
+            self.segment_bytes += len(data)
+            self.lsn += len(records)
+            lsn = self.lsn
+            self.cond.notify_all()
+        self.local.lsn = lsn
+        return lsn
+
+    def last_lsn(self):
+        '''
+        LSN of the last record appended by the calling thread (0 if none).
+        '''
+        return getattr(self.local, "lsn", 0)
+
+    def wait(self, lsn):
+        '''
+        Block until every record up to lsn is durable.
+        '''
+        with self.cond:
+            while self.durable_lsn < lsn and not self.closed:
+                self.cond.wait()
+
+    async def wait_async(self, lsn):
+        '''
+        Wait on the running event loop until every record up to lsn is durable.
+        '''
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if self.durable_lsn >= lsn or self.closed:
+                return
+            future = loop.create_future()
+            self.async_waiters.append((lsn, loop, future))
+        await future
+
+    def flush_loop(self):
+        '''
+        Write and fsync buffered records until the log is closed.
+        Appends made while an fsync is running are committed together by the next one.
+        '''
+        while True:
+            with self.cond:
+                while not self.buffer and not self.closed:
+                    self.cond.wait()
+                if not self.buffer:
+                    return
+                data, self.buffer = self.buffer, bytearray()
+                lsn = self.lsn
+                f = self.file
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            with self.cond:
+                self.durable_lsn = lsn
+                self.cond.notify_all()
+                ready = [waiter for waiter in self.async_waiters if waiter[0] <= lsn]
+                self.async_waiters = [waiter for waiter in self.async_waiters if waiter[0] > lsn]
+            for _, loop, future in ready:
+                loop.call_soon_threadsafe(self.resolve, future)
+
+    @staticmethod
+    def resolve(future):
+        if not future.done():
+            future.set_result(None)
+
+    def rotate(self):
+        '''
+        Flush the current segment and start the next one. Returns the new segment number.
+        The caller must make sure nothing is appended concurrently.
+        '''
+        with self.cond:
+            while self.durable_lsn < self.lsn:
+                self.cond.wait()
+            self.file.close()
+            self.segment += 1
+            self.file = open(segment_path(self.data_dir, self.segment), "ab")
+            self.segment_bytes = 0
+        fsync_dir(self.data_dir)
+        return self.segment
+
+    def close(self):
+        '''
+        Flush everything still buffered and stop the flusher.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.flusher.join()
+        self.file.close()
+        for _, loop, future in self.async_waiters:
+            loop.call_soon_threadsafe(self.resolve, future)
+        self.async_waiters = []
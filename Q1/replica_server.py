@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+import grpc
+import marketplace_pb2
+import marketplace_pb2_grpc
+from market_client import CHANNEL_OPTIONS
+from market_server import MarketplaceService
+from replication import decode_records, decode_snapshot
+from search_index import SearchIndex
+
+log = logging.getLogger("replica_server")
+
+MAX_STALENESS = 5.0  # Seconds the catalog may be behind the primary's before reads are refused
+RECONNECT_DELAY = 1.0  # Seconds to wait before reconnecting to the primary
+
+class ReplicaService(MarketplaceService):
+    '''
+    Read-only copy of a primary server's catalog for SearchItems, StreamSearchItems
+    and DisplaySellerItems. The catalog is loaded from the primary and kept up
+    to date from its Replicate stream. Every batch on the stream says up to which
+    time on the primary's clock it brings the catalog current, and an idle
+    primary sends a heartbeat every second. Reads are refused with
+    FAILED_PRECONDITION once the catalog is more than max_staleness seconds behind
+    (counting from the last batch applied, however recently one arrived), so a
+    reply is never staler than that, as long as the two hosts' clocks agree;
+    clients then read from the primary. Every other call is refused the same way
+    and must go to the primary.
+    '''
+    def __init__(self, primary, max_staleness=MAX_STALENESS):
+        super().__init__()
+        self.primary = primary
+        self.max_staleness = max_staleness
+        self.current_as_of = None  # Primary's time.time() the catalog is current as of, None until loaded
+        threading.Thread(target=self.follow, daemon=True).start()
+
+    def follow(self):
+        '''
+        Apply the primary's Replicate stream, reconnecting (and reloading the catalog) whenever it breaks.
+        A batch that cannot be applied leaves the catalog in doubt, so reads are refused
+        until a fresh copy is loaded.
+        '''
+        options = CHANNEL_OPTIONS + [("grpc.max_receive_message_length", -1)]  # The catalog comes in one message
+        stub = marketplace_pb2_grpc.MarketplaceStub(grpc.insecure_channel(self.primary, options=options))
+        connected = True  # Whether the last attempt got through, so an outage is only reported once
+        while True:
+            stream = stub.Replicate(marketplace_pb2.ReplicationRequest())
+            try:
+                for batch in stream:
+                    if batch.snapshot:
+                        self.load(decode_snapshot(batch.snapshot))
+                        log.info("Loaded %s items from the primary at %s", len(self.items), self.primary)
+                        connected = True
+                    elif batch.records:
+                        self.apply(decode_records(batch.records))
+                    self.current_as_of = batch.as_of
+                log.warning("The primary at %s ended replication", self.primary)
+            except grpc.RpcError as e:
+                if connected:
+                    log.warning("Lost the primary at %s: %s", self.primary, e.details())
+                connected = False
+            except Exception:
+                log.exception("Failed to apply replication from the primary at %s, reloading", self.primary)
+                self.current_as_of = None
+                stream.cancel()
+            time.sleep(RECONNECT_DELAY)
+
+    def load(self, state):
+        '''
+        Replace the catalog with a snapshot sent by the primary.
+        '''
+        with self.catalog_lock:
+            self.items = {}
+            self.seller_items = {}
+            self.item_sellers = {}
+            self.ratings = {}
+            self.wishlist = {}
+            self.item_watchers = {}
+            self.search_index = SearchIndex()
+            self.search_cache.clear()
+            self.restore_state(state)
+
+    def apply(self, records):
+        '''
+        Apply a batch of the primary's log records.
+        '''
+        with self.catalog_lock:
+            for record in records:
+                self.apply_record(record)
+
+    def lag(self):
+        '''
+        Seconds the catalog is behind the primary's, or None before it is loaded.
+        '''
+        if self.current_as_of is None:
+            return None
+        return max(0.0, time.time() - self.current_as_of)  # Clamped, as the primary's clock may run ahead
+
+    def fresh(self, context):
+        '''
+        Whether reads may be served. Otherwise sets FAILED_PRECONDITION on the call and returns False.
+        '''
+        lag = self.lag()
+        if lag is not None and lag <= self.max_staleness:
+            return True
+        context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+        context.set_details("Replica has not loaded the catalog yet" if lag is None else
+                            f"Replica is {lag:.1f}s behind the primary")
+        return False
+
+    def read_only(self, context, response):
+        '''
+        Refuse a call that has to be served by the primary.
+        '''
+        context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+        context.set_details(f"Read-only replica, send this call to the primary at {self.primary}")
+        return response
+
+    def SearchItems(self, request, context):
+        if not self.fresh(context):
+            return marketplace_pb2.SearchResponse()
+        return super().SearchItems(request, context)
+
+    def serialized_search(self, request, context):
+        if not self.fresh(context):
+            return marketplace_pb2.SearchResponse()
+        return super().serialized_search(request, context)
+
+    def StreamSearchItems(self, request, context):
+        if self.fresh(context):
+            yield from super().StreamSearchItems(request, context)
+
+    def DisplaySellerItems(self, request, context):
+        if not self.fresh(context):
+            return marketplace_pb2.DisplaySellerItemsResponse()
+        return super().DisplaySellerItems(request, context)
+
+    def GetStats(self, request, context):
+        response = super().GetStats(request, context)
+        response.replica_lag_seconds = self.lag() or 0.0
+        return response
+
+    def RegisterSeller(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def AddItem(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def BulkAddItems(self, request, context):
+        return self.read_only(context, marketplace_pb2.BulkOperationResponse())
+
+    def UpdateItem(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def BulkUpdateItems(self, request, context):
+        return self.read_only(context, marketplace_pb2.BulkOperationResponse())
+
+    def DeleteItem(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def BuyItem(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def BuyItems(self, request, context):
+        return self.read_only(context, marketplace_pb2.BulkOperationResponse())
+
+    def RateItem(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def AddToWishList(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def RemoveFromWishList(self, request, context):
+        return self.read_only(context, marketplace_pb2.OperationResponse())
+
+    def GetWishList(self, request, context):
+        return self.read_only(context, marketplace_pb2.WishListResponse())
+
+    def FetchNotifications(self, request, context):
+        return self.read_only(context, marketplace_pb2.NotificationResponse())
+
+    def FetchSellerNotifications(self, request, context):
+        return self.read_only(context, marketplace_pb2.NotificationResponse())
+
+    def GetNotificationStats(self, request, context):
+        return self.read_only(context, marketplace_pb2.NotificationStats())
+
+    def SubscribeNotifications(self, request, context):
+        self.read_only(context, None)
+        return iter(())
+
+    def Replicate(self, request, context):
+        self.read_only(context, None)
+        return iter(())
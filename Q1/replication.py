@@ -0,0 +1,94 @@
+import json
+import threading
+
+REPLICATED_OPS = {"seller", "add", "delete", "update", "stock", "rate"}  # Log records replicas need to serve reads
+REPLICATION_HEARTBEAT = 1.0  # Seconds between batches sent to an idle replica, so it knows it is current
+REPLICA_BACKLOG = 10000  # Unsent batches a replica may fall behind by before it is disconnected
+
+class ReplicaSink:
+    '''
+    Feeds one replica's stream. Wraps a queue (anything with put and qsize) that
+    receives lists of records. If the replica falls more than REPLICA_BACKLOG
+    batches behind, the sink stops queueing and puts None instead, so the stream
+    ends and the replica starts over from a fresh snapshot instead of the
+    primary buffering without bound.
+    '''
+    def __init__(self, q):
+        self.q = q
+        self.overflowed = False
+
+    def put(self, records):
+        if self.overflowed:
+            return
+        if self.q.qsize() >= REPLICA_BACKLOG:
+            self.overflowed = True
+            self.q.put(None)
+        else:
+            self.q.put(records)
+
+class ReplicationFeed:
+    '''
+    Hands the primary's catalog changes to the connected replicas' sinks.
+    '''
+    def __init__(self):
+        self.sinks = set()
+        self.lock = threading.Lock()  # Guards sinks
+
+    def subscribe(self, sink):
+        with self.lock:
+            self.sinks.add(sink)
+
+    def unsubscribe(self, sink):
+        with self.lock:
+            self.sinks.discard(sink)
+
+    def publish(self, records):
+        '''
+        Pass on the records replicas need. Called in commit order, under the lock ordering the change.
+        '''
+        if not self.sinks:
+            return
+        records = [record for record in records if record[0] in REPLICATED_OPS]
+        if not records:
+            return
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.put(records)
+
+# Replication payloads are JSON rather than pickles like the write-ahead log, since a
+# replica unpickling what arrives over the network would run whatever code the sender chose.
+
+def encode_snapshot(state):
+    '''
+    Encode the catalog part of a MarketplaceService.snapshot_state() for a replica.
+    '''
+    return json.dumps({
+        "sellers": state["sellers"],
+        "items": state["items"],
+        "ratings": [[item_id, total, count, sorted(raters)]
+                    for item_id, (total, count, raters) in state["ratings"].items()],
+    }).encode()
+
+def decode_snapshot(data):
+    '''
+    Rebuild a state for MarketplaceService.restore_state() from encode_snapshot's output.
+    '''
+    catalog = json.loads(data)
+    return {
+        "sellers": catalog["sellers"],
+        "items": catalog["items"],
+        "ratings": {item_id: (total, count, set(raters)) for item_id, total, count, raters in catalog["ratings"]},
+        "wishlist": {},
+        "notifications": {},
+        "seller_notifications": {},
+    }
+
+def encode_records(batches):
+    '''
+    Flatten queued record lists into one ReplicationBatch payload.
+    '''
+    return json.dumps([record for records in batches for record in records]).encode()
+
+def decode_records(data):
+    return json.loads(data)
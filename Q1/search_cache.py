@@ -0,0 +1,131 @@
+import collections
+import threading
+import time
+import grpc
+
+SEARCH_CACHE_SIZE = 1024  # Cached SearchItems responses
+SEARCH_CACHE_TTL = 60  # Seconds a cached response may be served
+SEARCH_CACHE_MAX_ENTRY = 1 << 20  # Larger responses are not cached
+
+class SearchCache:
+    '''
+    LRU cache of serialized SearchItems responses, keyed by query.
+    Every change to an item bumps the generation of its category and the
+    catalog-wide version. An entry remembers the generation (or, for searches
+    over every category, the version) it was computed at and is only served
+    while that is still current, so a hit never returns stale results. The
+    generation must be read before the search runs, so a change that races
+    with it invalidates the entry.
+    '''
+    def __init__(self, capacity=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # Maps key to (generation, expiry, data), least recently used first
+        self.generations = {}  # Maps category to the number of changes to its items
+        self.version = 0  # Number of changes to any item
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # Misses on an entry invalidated by a change or expired
+        self.evictions = 0
+        self.lock = threading.Lock()  # Always taken last, after any marketplace lock
+
+    def generation(self, category):
+        '''
+        Current generation of a category, or the catalog version for category None (any category).
+        '''
+        return self.version if category is None else self.generations.get(category, 0)
+
+    def get(self, key, category):
+        '''
+        Return the cached response for key if it is still current, else None.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                generation, expiry, data = entry
+                if generation == self.generation(category) and expiry > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                del self.entries[key]
+                self.stale += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, data):
+        '''
+        Cache a response computed at the given generation.
+        '''
+        if len(data) > SEARCH_CACHE_MAX_ENTRY:
+            return
+        with self.lock:
+            self.entries[key] = (generation, time.monotonic() + self.ttl, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, category):
+        '''
+        Record a change to an item in category, making cached results that could include it stale.
+        '''
+        with self.lock:
+            self.generations[category] = self.generations.get(category, 0) + 1
+            self.version += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+            self.generations = {category: generation + 1 for category, generation in self.generations.items()}
+
+    def stats(self):
+        '''
+        Return (hits, misses, stale, evictions, entries).
+        '''
+        with self.lock:
+            return self.hits, self.misses, self.stale, self.evictions, len(self.entries)
+
+def pass_serialized(serializer):
+    '''
+    Wrap a response serializer so responses that are already bytes are sent as they are.
+    '''
+    def serialize(response):
+        return response if isinstance(response, bytes) else serializer(response)
+    return serialize
+
+class SerializedResponseInterceptor(grpc.ServerInterceptor):
+    '''
+    Answers unary methods with functions that may return their responses
+    already serialized, such as hits from SearchCache, which are then sent
+    without re-encoding. handlers maps method paths to such functions, called
+    like the servicer's own handlers. Those keep returning messages, so a server
+    without this interceptor works the same, only without the cache.
+    '''
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        serialized = self.handlers.get(handler_call_details.method)
+        if handler is None or serialized is None or not handler.unary_unary:
+            return handler
+        return grpc.unary_unary_rpc_method_handler(serialized,
+                                                   request_deserializer=handler.request_deserializer,
+                                                   response_serializer=pass_serialized(handler.response_serializer))
+
+class AsyncSerializedResponseInterceptor(grpc.aio.ServerInterceptor):
+    '''
+    grpc.aio counterpart of SerializedResponseInterceptor, given coroutine functions.
+    '''
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        serialized = self.handlers.get(handler_call_details.method)
+        if handler is None or serialized is None or not handler.unary_unary:
+            return handler
+        return grpc.unary_unary_rpc_method_handler(serialized,
+                                                   request_deserializer=handler.request_deserializer,
+                                                   response_serializer=pass_serialized(handler.response_serializer))
@@ -0,0 +1,131 @@
+import bisect
+
+class Posting:
+    '''
+    Set of item IDs that iterates in ascending ID order and can resume after a given ID
+    by binary search, so paging through a search never rescans the IDs already returned.
+    Removed IDs stay in the sorted list, skipped, until they make up half of it.
+    '''
+    __slots__ = ("members", "order")
+
+    def __init__(self):
+        self.members = set()
+        self.order = []  # Ascending item IDs, including removed ones not yet compacted away
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, item_id):
+        return item_id in self.members
+
+    def __iter__(self):
+        return self.iter_after()
+
+    def add(self, item_id):
+        if item_id in self.members:
+            return
+        self.members.add(item_id)
+        order = self.order
+        if not order or item_id > order[-1]:
+            order.append(item_id)  # The usual case, as IDs are handed out in ascending order
+            return
+        position = bisect.bisect_left(order, item_id)
+        if position == len(order) or order[position] != item_id:  # Otherwise removed earlier and still listed
+            order.insert(position, item_id)
+
+    def discard(self, item_id):
+        self.members.discard(item_id)
+        if len(self.order) > 2 * len(self.members) + 16:
+            self.order = [i for i in self.order if i in self.members]
+
+    def iter_after(self, after=None):
+        '''
+        Return a lazy iterator over the IDs above `after` (all of them if None), in ascending order.
+        '''
+        order, members = self.order, self.members
+        start = 0 if after is None else bisect.bisect_right(order, after)
+        return (order[i] for i in range(start, len(order)) if order[i] in members)
+
+EMPTY_POSTING = Posting()
+
+class SearchIndex:
+    '''
+    In-memory index over item names and categories used by SearchItems.
+    Names are indexed by lowercase trigrams, categories by buckets of item IDs.
+    Postings are kept in ascending item ID order, so results come back in ID
+    order and a search can resume after the last ID of the previous page.
+    '''
+    GRAM_SIZE = 3
+
+    def __init__(self):
+        self.names = {}  # Maps item_id to its lowercased name
+        self.all = Posting()  # Every indexed item_id
+        self.grams = {}  # Maps trigram to a Posting of item_ids
+        self.categories = {}  # Maps category to a Posting of item_ids
+        self.item_categories = {}  # Maps item_id to its category
+
+    def _grams(self, text):
+        '''
+        Return the distinct trigrams of an already lowercased string.
+        '''
+        size = self.GRAM_SIZE
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def add(self, item_id, name, category):
+        '''
+        Index an item by name and category.
+        '''
+        if item_id in self.names:
+            self.remove(item_id)
+        lowered = name.lower()
+        self.names[item_id] = lowered
+        self.all.add(item_id)
+        self.item_categories[item_id] = category
+        self.categories.setdefault(category, Posting()).add(item_id)
+        for gram in self._grams(lowered):
+            self.grams.setdefault(gram, Posting()).add(item_id)
+
+    def remove(self, item_id):
+        '''
+        Drop an item from the index. Unknown IDs are ignored.
+        '''
+        lowered = self.names.pop(item_id, None)
+        if lowered is None:
+            return
+        self.all.discard(item_id)
+        category = self.item_categories.pop(item_id)
+        bucket = self.categories[category]
+        bucket.discard(item_id)
+        if not bucket:
+            del self.categories[category]
+        for gram in self._grams(lowered):
+            posting = self.grams[gram]
+            posting.discard(item_id)
+            if not posting:
+                del self.grams[gram]
+
+    def iter_search(self, name="", category=None, after=None):
+        '''
+        Return a lazy iterator over the IDs of items whose name contains `name`
+        (case-insensitive), restricted to `category` unless it is None, in ascending
+        order, starting after ID `after` if it is given.
+        The index must not change while the iterator is being consumed.
+        '''
+        query = name.lower()
+        candidates = self.all if category is None else self.categories.get(category, EMPTY_POSTING)
+        if not query:
+            return candidates.iter_after(after)
+
+        grams = self._grams(query)
+        if grams:
+            # Every trigram of the query must appear in a matching name, so
+            # walk the rarest posting and probe the rest.
+            postings = sorted((self.grams.get(gram, EMPTY_POSTING) for gram in grams), key=len)
+            others = postings[1:]
+            if category is not None:
+                others.append(candidates)
+            ids = (i for i in postings[0].iter_after(after) if all(i in posting for posting in others))
+        else:
+            # Queries shorter than a trigram fall back to the category bucket
+            ids = candidates.iter_after(after)
+        return (i for i in ids if query in self.names[i])
@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import struct
+import marketplace_pb2
+
+SortKey = marketplace_pb2.SortKey
+SORT_FIELDS = {SortKey.PRICE: "price", SortKey.RATING: "rating", SortKey.QUANTITY: "quantity"}
+DESCENDING_BY_DEFAULT = {SortKey.RATING, SortKey.QUANTITY, SortKey.RELEVANCE}  # Best first unless asked otherwise
+FLOAT32 = struct.Struct("<f")
+
+def float32(value):
+    '''
+    Round a float to the precision it has in an Item message, so servers and
+    the shard router, which only sees messages, compute the same sort keys.
+    '''
+    return FLOAT32.unpack(FLOAT32.pack(value))[0]
+
+def relevance(name, query):
+    '''
+    Score a name containing query (lowercased): an exact match beats a prefix, which beats
+    the start of a later word, which beats a match anywhere. Within a tier, shorter names score higher.
+    '''
+    if not query:
+        return 0.0
+    name = name.lower()
+    if name == query:
+        tier = 3
+    elif name.startswith(query):
+        tier = 2
+    elif " " + query in name:
+        tier = 1
+    else:
+        tier = 0
+    return tier + len(query) / len(name)
+
+class SearchOrder:
+    '''
+    The order, range filters and limit of a SearchRequest.
+    Results are ordered by a key of (sort value, item ID), or the item ID alone
+    when sorting by ID, so ties are broken by ascending ID. The key of the last
+    item returned is the page token for the next page, followed by how many
+    results the limit still allows.
+    Works on ItemRecords and Item messages alike.
+    '''
+    def __init__(self, request):
+        self.sort_by = request.sort_by
+        descending = request.sort_by in DESCENDING_BY_DEFAULT
+        if request.order != marketplace_pb2.SortOrder.DEFAULT_ORDER:
+            descending = request.order == marketplace_pb2.SortOrder.DESCENDING
+        self.sign = -1 if descending else 1
+        self.query = request.name.lower()
+        self.min_price = request.min_price if request.HasField("min_price") else None
+        self.max_price = request.max_price if request.HasField("max_price") else None
+        self.min_rating = request.min_rating if request.HasField("min_rating") else None
+        self.max_rating = request.max_rating if request.HasField("max_rating") else None
+        self.limit = request.limit
+        self.fields = (self.sort_by, self.sign, self.min_price, self.max_price, self.min_rating, self.max_rating,
+                       self.limit)  # Everything besides name, category and paging that the results depend on
+        self.filtered = any(bound is not None for bound in
+                            (self.min_price, self.max_price, self.min_rating, self.max_rating))
+
+    def key(self, item):
+        if self.sort_by == SortKey.ID:
+            return (item.id,)
+        if self.sort_by == SortKey.RELEVANCE:
+            value = relevance(item.name, self.query)
+        elif self.sort_by == SortKey.QUANTITY:
+            value = item.quantity
+        else:
+            value = float32(getattr(item, SORT_FIELDS[self.sort_by]))
+        return (self.sign * value, item.id)
+
+    def matches(self, item):
+        '''
+        Whether an item passes the price and rating filters.
+        '''
+        price, rating = float32(item.price), float32(item.rating)
+        return ((self.min_price is None or price >= self.min_price) and
+                (self.max_price is None or price <= self.max_price) and
+                (self.min_rating is None or rating >= self.min_rating) and
+                (self.max_rating is None or rating <= self.max_rating))
+
+    def parse_token(self, page_token):
+        '''
+        Return (key to continue after or None, results the limit still allows or None).
+        Raises ValueError for malformed tokens.
+        '''
+        if not page_token:
+            return None, self.limit or None
+        parts = page_token.split(",")
+        size = 1 if self.sort_by == SortKey.ID else 2
+        if len(parts) != size + (1 if self.limit else 0):
+            raise ValueError(page_token)
+        after = (int(parts[0]),) if size == 1 else (float(parts[0]), int(parts[1]))
+        if not self.limit:
+            return after, None
+        remaining = int(parts[size])
+        if remaining < 1:
+            raise ValueError(page_token)
+        return after, remaining
+
+    def token(self, after, remaining):
+        '''
+        Page token continuing after key `after`. A plain item ID when sorting by ID without a limit.
+        '''
+        parts = [repr(value) if isinstance(value, float) else str(value) for value in after]
+        if remaining is not None:
+            parts.append(str(remaining))
+        return ",".join(parts)
+
+    def page_count(self, page_size, remaining):
+        '''
+        How many results the next page may hold, or None for all of them.
+        '''
+        counts = [count for count in (page_size, remaining) if count]
+        return min(counts) if counts else None
+
+    def next_token(self, last_item, count, remaining):
+        '''
+        Token for the page after a full page of `count` items ending with last_item, or "" once the limit is used up.
+        '''
+        if remaining is not None:
+            remaining -= count
+            if not remaining:
+                return ""
+        return self.token(self.key(last_item), remaining)
+
+    def select(self, items, after, count):
+        '''
+        Return the first `count` (all if None) of `items` in this order that pass
+        the filters and come after key `after`. `items` must be in ascending ID
+        order. Other orders keep a heap of `count` items instead of sorting every match.
+        '''
+        if self.filtered:
+            items = (item for item in items if self.matches(item))
+        if self.sort_by == SortKey.ID:
+            if after is not None:
+                items = itertools.dropwhile(lambda item: item.id <= after[0], items)
+            return list(items if count is None else itertools.islice(items, count))
+        if after is not None:
+            items = (item for item in items if self.key(item) > after)
+        if count is None:
+            return sorted(items, key=self.key)
+        return heapq.nsmallest(count, items, key=self.key)
@@ -3,26 +3,26 @@ import threading
 import grpc
 import uuid
 import marketplace_pb2
-import marketplace_pb2_grpc
+from market_client import DEFAULT_TIMEOUT, MarketClient
 
 # Configuration
 SERVER_ADDRESS = "10.190.0.2:50051"
 SELLER_ADDRESS = "10.190.0.3"
+BATCH_SIZE = 1000  # Entries sent per bulk RPC, keeps each message well under gRPC's size limit
 
-class SellerClient:
-    def __init__(self, address):
+class SellerClient(MarketClient):
+    def __init__(self, address, pool=None, timeout=DEFAULT_TIMEOUT):
         '''
         Client for the seller to interact with the marketplace.
         '''
-        self.channel = grpc.insecure_channel(address)
-        self.stub = marketplace_pb2_grpc.MarketplaceStub(self.channel)
+        super().__init__(address, pool, timeout)
         self.uuid = str(uuid.uuid4()).split('-')[0]
         self.seller_address = f"{SELLER_ADDRESS}:{self.uuid[:8]}"  # Mock IP:Port with UUID
 
     def register_seller(self):
         """Register the seller with the market."""
         try:
-            response = self.stub.RegisterSeller(marketplace_pb2.RegisterSellerRequest(ip_port=self.seller_address, uuid=self.uuid))
+            response = self.call("RegisterSeller", marketplace_pb2.RegisterSellerRequest(ip_port=self.seller_address, uuid=self.uuid))
             print(f"RegisterSeller response: {response.message}")
             return response.success
         except grpc.RpcError as e:
@@ -40,25 +40,61 @@ class SellerClient:
             rating=0.0  # Initial rating
         )
         try:
-            response = self.stub.AddItem(marketplace_pb2.ItemOperationRequest(uuid=self.uuid, item=item))
+            response = self.call("AddItem", marketplace_pb2.ItemOperationRequest(uuid=self.uuid, item=item))
             print(f"AddItem response: {response.message}")
             return response.success
         except grpc.RpcError as e:
             print(f"AddItem failed with {e.code()}: {e.details()}")
 
+    def bulk_add_items(self, items):
+        """Add many items, given as (name, category, quantity, description, price) tuples. Returns the new item IDs."""
+        item_ids = []
+        for start in range(0, len(items), BATCH_SIZE):
+            batch = [marketplace_pb2.Item(
+                name=name,
+                category=category,
+                quantity=quantity,
+                description=description,
+                seller_address=self.seller_address,
+                price=price
+            ) for name, category, quantity, description, price in items[start:start + BATCH_SIZE]]
+            try:
+                response = self.call("BulkAddItems", marketplace_pb2.BulkAddItemsRequest(uuid=self.uuid, items=batch))
+            except grpc.RpcError as e:
+                print(f"BulkAddItems failed with {e.code()}: {e.details()}")
+                break
+            item_ids.extend(result.item_id for result in response.results if result.success)
+        print(f"BulkAddItems added {len(item_ids)} of {len(items)} items")
+        return item_ids
+
     def update_item(self, item_id, quantity, price):
         """Update details of an existing item."""
         try:
-            response = self.stub.UpdateItem(marketplace_pb2.UpdateItemRequest(uuid=self.uuid, id=item_id, quantity=quantity, price=price))
+            response = self.call("UpdateItem", marketplace_pb2.UpdateItemRequest(uuid=self.uuid, id=item_id, quantity=quantity, price=price))
             print(f"UpdateItem response: {response.message}")
             return response.success
         except grpc.RpcError as e:
             print(f"UpdateItem failed with {e.code()}: {e.details()}")
 
+    def bulk_update_items(self, updates):
+        """Update many items, given as (item_id, quantity, price) tuples. Returns one OperationResponse per update."""
+        results = []
+        for start in range(0, len(updates), BATCH_SIZE):
+            batch = [marketplace_pb2.UpdateItemRequest(id=item_id, quantity=quantity, price=price)
+                     for item_id, quantity, price in updates[start:start + BATCH_SIZE]]
+            try:
+                response = self.call("BulkUpdateItems", marketplace_pb2.BulkUpdateItemsRequest(uuid=self.uuid, updates=batch))
+            except grpc.RpcError as e:
+                print(f"BulkUpdateItems failed with {e.code()}: {e.details()}")
+                break
+            results.extend(response.results)
+        print(f"BulkUpdateItems updated {sum(result.success for result in results)} of {len(updates)} items")
+        return results
+
     def delete_item(self, item_id):
         """Delete an item from the market."""
         try:
-            response = self.stub.DeleteItem(marketplace_pb2.DeleteItemRequest(uuid=self.uuid, id=item_id))
+            response = self.call("DeleteItem", marketplace_pb2.DeleteItemRequest(uuid=self.uuid, id=item_id))
             print(f"DeleteItem response: {response.message}")
             return response.success
         except grpc.RpcError as e:
@@ -67,7 +103,7 @@ class SellerClient:
     def display_seller_items(self):
         """Display all items listed by the seller."""
         try:
-            response = self.stub.DisplaySellerItems(marketplace_pb2.DisplaySellerItemsRequest(uuid=self.uuid))
+            response = self.call("DisplaySellerItems", marketplace_pb2.DisplaySellerItemsRequest(uuid=self.uuid))
             for item in response.items:
                 rating = item.rating if item.rating != -1 else "UNRATED";
                 print(f"Item ID: {item.id}, Name: {item.name}, Price: ${item.price}, Rating: {rating}, Quantity: {item.quantity}")
@@ -79,16 +115,33 @@ class SellerClient:
     def fetch_notifications(self):
         """Fetch and display notifications for the seller."""
         try:
-            response = self.stub.FetchSellerNotifications(marketplace_pb2.NotificationRequest(uuid=self.uuid))
+            response = self.call("FetchSellerNotifications", marketplace_pb2.NotificationRequest(uuid=self.uuid))
             for notification in response.messages:
                 print(notification)
+            if response.dropped:
+                print(f"{response.dropped} older notifications were dropped")
         except grpc.RpcError as e:
             print(f"Failed to fetch notifications: {e.code()}: {e.details()}")
 
+    def listen_for_notifications(self):
+        """Print notifications as the server pushes them, until the stream ends."""
+        responses = self.stream("SubscribeNotifications", marketplace_pb2.NotificationRequest(uuid=self.uuid))
+        for response in responses:
+            for notification in response.messages:
+                print(notification)
+
     def start_notification_listener(self):
         """Start a background thread to listen for notifications."""
         
         def listener():
+            while True:
+                try:
+                    self.listen_for_notifications()
+                except grpc.RpcError as e:
+                    if e.code() in (grpc.StatusCode.UNIMPLEMENTED, grpc.StatusCode.RESOURCE_EXHAUSTED):
+                        break
+                time.sleep(5)  # Back off before resubscribing
+            # Server cannot stream, or has no room for another stream; fall back to polling
             while True:
                 self.fetch_notifications()
                 time.sleep(5)  # Adjust frequency as needed
@@ -0,0 +1,356 @@
+from concurrent import futures
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import zlib
+import grpc
+import marketplace_pb2
+import marketplace_pb2_grpc
+from market_client import ChannelPool, MarketClient
+from market_server import MAX_WORKERS, SEARCH_PAGE_SIZE, SERVER_OPTIONS, StreamLimit, stats_response, stream_limit
+from metrics import MetricsInterceptor, RpcMetrics
+from search_order import SearchOrder
+from server_logging import setup_logging
+
+log = logging.getLogger("shard_router")
+
+MAX_FORWARD_TIMEOUT = 24 * 3600  # Longer remaining times mean the caller set no deadline
+
+class ShardRouter(marketplace_pb2_grpc.MarketplaceServicer):
+    '''
+    Front end for a catalog partitioned over several marketplace servers.
+    Shard k (started with --shard-index k --shard-count N) owns the items with
+    (id - 1) % N == k, so calls about one item go straight to its shard. A
+    seller's items are all added on the seller's home shard, picked by hashing
+    their UUID, so their listings and sale notifications live in one place.
+    Sellers are registered on every shard. Searches and buyer notification
+    fetches are sent to every shard at once and the results merged.
+    '''
+    def __init__(self, addresses):
+        pool = ChannelPool()
+        self.shards = [MarketClient(address, pool) for address in addresses]
+        self.metrics = None  # RpcMetrics backing GetStats, set by serve()
+        self.streams = StreamLimit()  # Open notification streams, limited by serve() to a share of its threads
+
+    def item_shard(self, item_id):
+        '''
+        Client for the shard that owns an item.
+        '''
+        return self.shards[(item_id - 1) % len(self.shards)]
+
+    def seller_shard(self, seller_uuid):
+        '''
+        Client for a seller's home shard. crc32 is stable across processes, unlike hash().
+        '''
+        return self.shards[zlib.crc32(seller_uuid.encode()) % len(self.shards)]
+
+    def timeout(self, context):
+        '''
+        The caller's remaining deadline in seconds, or None (the client library's default) if it set none.
+        '''
+        remaining = context.time_remaining()
+        return remaining if remaining < MAX_FORWARD_TIMEOUT else None
+
+    def forward(self, shard, method, request, context):
+        '''
+        Call a unary RPC on one shard within the caller's remaining deadline,
+        passing shard failures back to the caller with the same status code.
+        '''
+        try:
+            return shard.call(method, request, timeout=self.timeout(context))
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def broadcast(self, method, requests, context):
+        '''
+        Call a unary RPC on several shards in parallel, given (shard, request) pairs.
+        Returns the responses in the same order.
+        '''
+        timeout = self.timeout(context)
+        calls = [shard.future(method, request, timeout=timeout) for shard, request in requests]
+        try:
+            return [call.result() for call in calls]
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def RegisterSeller(self, request, context):
+        '''
+        Register the seller on every shard, so each accepts updates and deletes of the seller's items.
+        '''
+        responses = self.broadcast("RegisterSeller", [(shard, request) for shard in self.shards], context)
+        for response in responses:
+            if not response.success:
+                return response
+        return responses[0]
+
+    def AddItem(self, request, context):
+        return self.forward(self.seller_shard(request.uuid), "AddItem", request, context)
+
+    def BulkAddItems(self, request, context):
+        return self.forward(self.seller_shard(request.uuid), "BulkAddItems", request, context)
+
+    def DisplaySellerItems(self, request, context):
+        return self.forward(self.seller_shard(request.uuid), "DisplaySellerItems", request, context)
+
+    def FetchSellerNotifications(self, request, context):
+        return self.forward(self.seller_shard(request.uuid), "FetchSellerNotifications", request, context)
+
+    def UpdateItem(self, request, context):
+        return self.forward(self.item_shard(request.id), "UpdateItem", request, context)
+
+    def DeleteItem(self, request, context):
+        return self.forward(self.item_shard(request.id), "DeleteItem", request, context)
+
+    def BuyItem(self, request, context):
+        return self.forward(self.item_shard(request.item_id), "BuyItem", request, context)
+
+    def RateItem(self, request, context):
+        return self.forward(self.item_shard(request.item_id), "RateItem", request, context)
+
+    def AddToWishList(self, request, context):
+        return self.forward(self.item_shard(request.item_id), "AddToWishList", request, context)
+
+    def RemoveFromWishList(self, request, context):
+        return self.forward(self.item_shard(request.item_id), "RemoveFromWishList", request, context)
+
+    def GetWishList(self, request, context):
+        '''
+        A buyer's wishes are kept on the shards owning the items; collect them from all.
+        '''
+        responses = self.broadcast("GetWishList", [(shard, request) for shard in self.shards], context)
+        return marketplace_pb2.WishListResponse(items=[item for response in responses for item in response.items])
+
+    def BulkUpdateItems(self, request, context):
+        '''
+        Split the updates by owning shard, apply each part in parallel and reassemble the results in request order.
+        '''
+        return self.scatter("BulkUpdateItems", request.updates, lambda update: update.id,
+                            lambda updates: marketplace_pb2.BulkUpdateItemsRequest(uuid=request.uuid, updates=updates),
+                            context)
+
+    def BuyItems(self, request, context):
+        '''
+        Split the orders by owning shard, place each part in parallel and reassemble the results in request order.
+        '''
+        return self.scatter("BuyItems", request.orders, lambda order: order.item_id,
+                            lambda orders: marketplace_pb2.BuyItemsRequest(orders=orders), context)
+
+    def scatter(self, method, entries, item_id, make_request, context):
+        '''
+        Send each entry of a bulk request to the shard owning its item and
+        return one BulkOperationResponse with the results in the original order.
+        '''
+        positions = {}  # Maps shard to the positions of its entries in the request
+        for position, entry in enumerate(entries):
+            positions.setdefault(self.item_shard(item_id(entry)), []).append(position)
+        requests = [(shard, make_request([entries[position] for position in shard_positions]))
+                    for shard, shard_positions in positions.items()]
+        results = [None] * len(entries)
+        for shard_positions, response in zip(positions.values(), self.broadcast(method, requests, context)):
+            for position, result in zip(shard_positions, response.results):
+                results[position] = result
+        return marketplace_pb2.BulkOperationResponse(results=results)
+
+    def SearchItems(self, request, context):
+        '''
+        Search every shard and merge the results into one page in the request's order.
+        Page tokens are the same as on a single server.
+        '''
+        order = SearchOrder(request)
+        return self.search_page(request, order, self.parse_page_token(order, request.page_token, context),
+                                request.page_size, context)
+
+    def StreamSearchItems(self, request, context):
+        '''
+        Stream merged search results in pages of page_size (SEARCH_PAGE_SIZE by default) items.
+        '''
+        order = SearchOrder(request)
+        cursor = self.parse_page_token(order, request.page_token, context)
+        page_size = request.page_size or SEARCH_PAGE_SIZE
+        while True:
+            response = self.search_page(request, order, cursor, page_size, context)
+            if response.items:
+                yield response
+            if not response.next_page_token:
+                return
+            cursor = order.parse_token(response.next_page_token)
+
+    def parse_page_token(self, order, page_token, context):
+        try:
+            return order.parse_token(page_token)
+        except ValueError:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page token")
+
+    def search_page(self, request, order, cursor, page_size, context):
+        '''
+        Fetch the next page of matches after the cursor from every shard and keep the first page_size in order.
+        Each shard returns its matches in that order, so nothing a shard left
+        out can sort before the last item kept. The request's limit is applied
+        here; shards are asked for one page at a time.
+        '''
+        after, remaining = cursor
+        count = order.page_count(page_size, remaining)
+        shard_request = marketplace_pb2.SearchRequest()
+        shard_request.CopyFrom(request)
+        shard_request.page_size = count or 0
+        shard_request.page_token = "" if after is None else order.token(after, None)
+        shard_request.limit = 0
+        responses = self.broadcast("SearchItems", [(shard, shard_request) for shard in self.shards], context)
+        merged = heapq.merge(*[response.items for response in responses], key=order.key)
+        if count is None:
+            return marketplace_pb2.SearchResponse(items=list(merged))
+        items = list(itertools.islice(merged, count + 1))  # One extra to tell if another page follows
+        more = len(items) > count or any(response.next_page_token for response in responses)
+        del items[count:]
+        next_page_token = order.next_token(items[-1], count, remaining) if more and items else ""
+        return marketplace_pb2.SearchResponse(items=items, next_page_token=next_page_token)
+
+    def FetchNotifications(self, request, context):
+        '''
+        A buyer's notifications are kept on the shards owning the items they watch; collect them from all.
+        '''
+        responses = self.broadcast("FetchNotifications", [(shard, request) for shard in self.shards], context)
+        return marketplace_pb2.NotificationResponse(
+            messages=[message for response in responses for message in response.messages],
+            dropped=sum(response.dropped for response in responses))
+
+    def SubscribeNotifications(self, request, context):
+        '''
+        Stream a seller's notifications from their home shard, or a buyer's from every shard.
+        Refused with RESOURCE_EXHAUSTED when too many streams are open here or on a shard.
+        '''
+        if not self.streams.acquire(context):
+            return
+        shards = [self.seller_shard(request.uuid)] if request.uuid else self.shards
+        streams = [shard.stream("SubscribeNotifications", request) for shard in shards]
+        responses = queue.SimpleQueue()
+        refused = []  # Errors of shards that cannot or will not stream; the client should poll instead
+
+        def pump(stream):
+            try:
+                for response in stream:
+                    responses.put(response)
+            except grpc.RpcError as e:
+                if e.code() in (grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.UNIMPLEMENTED):
+                    refused.append(e)
+                elif e.code() != grpc.StatusCode.CANCELLED:
+                    log.warning("Notification stream from a shard ended: %s", e.details())
+            responses.put(None)
+
+        def cancel():
+            for stream in streams:
+                stream.cancel()
+
+        context.add_callback(cancel)  # Close the shard streams when the client goes away
+        for stream in streams:
+            threading.Thread(target=pump, args=(stream,), daemon=True).start()
+        open_streams = len(streams)
+        try:
+            while open_streams:
+                response = responses.get()
+                if response is None:
+                    open_streams -= 1
+                    if refused:
+                        context.set_code(refused[0].code())
+                        context.set_details(refused[0].details())
+                        return
+                else:
+                    yield response
+        finally:
+            cancel()
+            self.streams.release()
+
+    def GetNotificationStats(self, request, context):
+        '''
+        Notification queue statistics summed over all shards.
+        '''
+        responses = self.broadcast("GetNotificationStats", [(shard, request) for shard in self.shards], context)
+        return marketplace_pb2.NotificationStats(
+            queues=sum(response.queues for response in responses),
+            pending=sum(response.pending for response in responses),
+            max_depth=max(response.max_depth for response in responses),
+            coalesced=sum(response.coalesced for response in responses),
+            dropped=sum(response.dropped for response in responses),
+            streams=sum(response.streams for response in responses))
+
+    def GetStats(self, request, context):
+        '''
+        The router's own per-method statistics, i.e. latency as seen through the router.
+        Ask a shard directly for its statistics.
+        '''
+        return stats_response(self.metrics)
+
+def spawn_shards(count, first_port, data_dir=None, aio=False, log_level=None):
+    '''
+    Start `count` shard servers on this machine, one process each, on consecutive ports.
+    Returns their addresses and processes.
+    '''
+    addresses, processes = [], []
+    for index in range(count):
+        port = first_port + index
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "market_server.py"),
+                   "--port", str(port), "--shard-index", str(index), "--shard-count", str(count)]
+        if data_dir:
+            command += ["--data-dir", os.path.join(data_dir, f"shard-{index}")]
+        if aio:
+            command.append("--aio")
+        if log_level:
+            command += ["--log-level", log_level]
+        processes.append(subprocess.Popen(command))
+        addresses.append(f"localhost:{port}")
+    return addresses, processes
+
+def create_server(port, addresses, max_workers=MAX_WORKERS):
+    '''
+    Build and start the router in front of the shards at the given addresses, without blocking.
+    Port 0 picks a free port. Returns (server, router, bound port).
+    '''
+    router = ShardRouter(addresses)
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    router.metrics = RpcMetrics(executor)
+    router.streams = stream_limit(max_workers)
+    server = grpc.server(executor, interceptors=[MetricsInterceptor(router.metrics)], options=SERVER_OPTIONS)
+    marketplace_pb2_grpc.add_MarketplaceServicer_to_server(router, server)
+    port = server.add_insecure_port(f'[::]:{port}')
+    server.start()
+    return server, router, port
+
+def serve(port, addresses, max_workers=MAX_WORKERS):
+    '''
+    Start the router in front of the shards at the given addresses.
+    '''
+    server, _, port = create_server(port, addresses, max_workers)
+    log.info("Shard router started. Listening on port %s, routing to %s", port, ", ".join(addresses))
+    server.wait_for_termination()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Route marketplace calls over a sharded catalog.")
+    parser.add_argument("--port", type=int, default=50051, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Size of the RPC thread pool")
+    parser.add_argument("--shards", help="Comma-separated shard addresses, in shard index order")
+    parser.add_argument("--spawn", type=int, help="Start this many shard servers on this machine instead")
+    parser.add_argument("--shard-port", type=int, default=50061, help="Port of the first spawned shard")
+    parser.add_argument("--data-dir", help="Give each spawned shard a data directory under this one")
+    parser.add_argument("--aio", action="store_true", help="Run spawned shards with grpc.aio")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING or ERROR (default: $LOG_LEVEL or INFO)")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    if args.spawn:
+        addresses, processes = spawn_shards(args.spawn, args.shard_port, args.data_dir, args.aio, args.log_level)
+    elif args.shards:
+        addresses, processes = args.shards.split(","), []
+    else:
+        parser.error("give either --shards or --spawn")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Stop spawned shards on kill too
+    try:
+        serve(args.port, addresses, args.workers)
+    finally:
+        for process in processes:
+            process.terminate()
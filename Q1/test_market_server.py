@@ -0,0 +1,347 @@
+'''
+Tests for the market server. Run from Q1 after ./setup.sh with:
+    python3 -m unittest
+'''
+
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import grpc
+import marketplace_pb2
+import marketplace_pb2_grpc
+import shard_router
+from market_client import ChannelPool, MarketClient
+from market_server import ItemRecord, MarketplaceService, StreamLimit, create_server
+from notifications import ItemNotification, NotificationQueue, SaleNotification
+from replica_server import ReplicaService
+from replication import ReplicaSink
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.05)
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+
+    def open_service(self):
+        service = MarketplaceService(data_dir=self.data_dir, snapshot_interval=3600)
+        self.addCleanup(service.wal.close)
+        return service
+
+    def test_buy_racing_add_is_logged_after_it(self):
+        '''
+        A buy of a new item's ID while the add is being logged must not reach the log
+        before the add, or the log cannot be replayed.
+        '''
+        service = self.open_service()
+        service.sellers["seller"] = {"ip_port": "localhost:1"}
+        persist = service.persist
+        racing = []
+
+        def persist_with_racing_buy(*records):
+            if records[0][0] == "add":
+                order = marketplace_pb2.BuyItemRequest(item_id=records[0][2], quantity=1, buyer_address="buyer")
+                racing.append(service.buy_item(order).success)
+            persist(*records)
+
+        service.persist = persist_with_racing_buy
+        item = marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=5,
+                                    seller_address="localhost:1", price=10)
+        item_id, = service.add_items("seller", [item])
+        service.persist = persist
+        self.assertEqual(racing, [False])  # Not visible until its add is logged
+        self.assertTrue(service.buy_item(marketplace_pb2.BuyItemRequest(item_id=item_id, quantity=2,
+                                                                        buyer_address="buyer")).success)
+        service.wal.close()
+
+        recovered = self.open_service()
+        self.assertEqual(recovered.items[item_id].quantity, 3)
+
+    def test_snapshots_do_not_use_up_item_ids(self):
+        service = self.open_service()
+        item = marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=5,
+                                    seller_address="localhost:1", price=10)
+        first, = service.add_items("seller", [item])
+        service.take_snapshot()
+        service.open_replication(ReplicaSink(queue.SimpleQueue()))
+        second, = service.add_items("seller", [item])
+        self.assertEqual(second, first + 1)
+        service.take_snapshot()
+        service.wal.close()
+
+        recovered = self.open_service()
+        third, = recovered.add_items("seller", [item])
+        self.assertEqual(third, second + 1)
+
+class NotificationQueueTest(unittest.TestCase):
+    def notification(self, item_id, action="updated"):
+        return ItemNotification(ItemRecord(item_id, "lamp", marketplace_pb2.ELECTRONICS, 1, "", "localhost:1", 10),
+                                action, "Electronics")
+
+    def test_notifications_for_the_same_item_coalesce(self):
+        q = NotificationQueue(10)
+        first, other, latest = self.notification(1), self.notification(2), self.notification(1, "purchased")
+        self.assertEqual(q.push(first), (False, 0))
+        self.assertEqual(q.push(other), (False, 0))
+        self.assertEqual(q.push(latest), (True, 0))
+        self.assertEqual(q.drain(), [other, latest])  # The newer one replaces the older and moves to the back
+
+    def test_sales_never_coalesce(self):
+        q = NotificationQueue(10)
+        sales = [SaleNotification("lamp", 1, "buyer") for _ in range(3)]
+        self.assertEqual([q.push(sale) for sale in sales], [(False, 0)] * 3)
+        self.assertEqual(q.drain(), sales)
+
+    def test_oldest_are_dropped_when_full(self):
+        q = NotificationQueue(2)
+        notifications = [self.notification(item_id) for item_id in (1, 2, 3, 4)]
+        self.assertEqual([q.push(notification) for notification in notifications],
+                         [(False, 0), (False, 0), (False, 1), (False, 1)])
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(q.drain(), notifications[2:])
+        self.assertEqual(q.dropped, 0)  # Counted again from the drain
+
+    @mock.patch("market_server.NOTIFICATION_QUEUE_SIZE", 2)
+    def test_service_counts_coalesced_and_dropped(self):
+        service = MarketplaceService()
+        service.sellers["seller"] = {"ip_port": "localhost:1"}
+        item = marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=5,
+                                    seller_address="localhost:1", price=10)
+        item_ids = service.add_items("seller", [item] * 3)
+        for item_id in item_ids:
+            service.AddToWishList(marketplace_pb2.WishlistRequest(item_id=item_id, buyer_address="buyer"), None)
+        for item_id in (item_ids[0], item_ids[1], item_ids[0], item_ids[2]):
+            service.UpdateItem(marketplace_pb2.UpdateItemRequest(id=item_id, uuid="seller", quantity=4, price=10), None)
+
+        stats = service.GetNotificationStats(marketplace_pb2.NotificationStatsRequest(), None)
+        self.assertEqual((stats.pending, stats.coalesced, stats.dropped), (2, 1, 1))
+        response = service.FetchNotifications(marketplace_pb2.NotificationRequest(buyer_address="buyer"), None)
+        self.assertEqual(response.dropped, 1)
+        self.assertEqual(len(response.messages), 2)
+        for message, item_id in zip(response.messages, (item_ids[0], item_ids[2])):
+            self.assertIn(f"Item ID: {item_id},", message)
+
+class SearchPagingTest(unittest.TestCase):
+    def setUp(self):
+        self.service = MarketplaceService()
+
+    def add(self, item_id, name="lamp"):
+        with self.service.catalog_lock:
+            self.service.insert_item("seller", ItemRecord(item_id, name, marketplace_pb2.ELECTRONICS, 1, "",
+                                                          "localhost:1", 10))
+
+    def page_through(self, page_size):
+        request = marketplace_pb2.SearchRequest(name="lamp", category=marketplace_pb2.ANY, page_size=page_size)
+        ids = []
+        while True:
+            response = self.service.SearchItems(request, None)
+            ids += [item.id for item in response.items]
+            if not response.next_page_token:
+                return ids
+            request.page_token = response.next_page_token
+
+    def test_pages_cover_items_inserted_out_of_id_order(self):
+        for item_id in (2, 1, 5, 3):
+            self.add(item_id)
+        self.assertEqual(self.page_through(0), [1, 2, 3, 5])
+        self.assertEqual(self.page_through(1), [1, 2, 3, 5])
+
+    def test_pages_skip_removed_items(self):
+        for item_id in range(1, 101):
+            self.add(item_id)
+        with self.service.catalog_lock:
+            for item_id in range(1, 100, 2):
+                self.service.remove_item(item_id)
+        self.add(7)
+        self.assertEqual(self.page_through(7), sorted([7] + list(range(2, 101, 2))))
+
+class SearchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.service = MarketplaceService()
+        self.service.sellers["seller"] = {"ip_port": "localhost:1"}
+        items = [marketplace_pb2.Item(name=name, category=category, quantity=5, seller_address="localhost:1", price=10)
+                 for name, category in (("lamp", marketplace_pb2.ELECTRONICS), ("shirt", marketplace_pb2.FASHION))]
+        self.lamp, self.shirt = self.service.add_items("seller", items)
+
+    def search(self, category=marketplace_pb2.ELECTRONICS):
+        request = marketplace_pb2.SearchRequest(category=category)
+        item, = marketplace_pb2.SearchResponse.FromString(self.service.serialized_search(request, None)).items
+        return item
+
+    def hits(self):
+        return self.service.search_cache.stats()[0]
+
+    def test_repeated_searches_are_hits(self):
+        self.assertEqual(self.search().id, self.lamp)
+        self.assertEqual(self.search().id, self.lamp)
+        self.assertEqual(self.hits(), 1)
+        # SearchItems itself answers with a message, uncached
+        response = self.service.SearchItems(marketplace_pb2.SearchRequest(category=marketplace_pb2.FASHION), None)
+        self.assertEqual([item.id for item in response.items], [self.shirt])
+
+    def test_changes_invalidate_their_category(self):
+        changes = [
+            (lambda item_id: self.service.BuyItem(marketplace_pb2.BuyItemRequest(
+                item_id=item_id, quantity=2, buyer_address="buyer"), None),
+             lambda item: item.quantity, 3),
+            (lambda item_id: self.service.RateItem(marketplace_pb2.RateItemRequest(
+                item_id=item_id, buyer_address="buyer", rating=4), None),
+             lambda item: item.rating, 4),
+            (lambda item_id: self.service.UpdateItem(marketplace_pb2.UpdateItemRequest(
+                id=item_id, uuid="seller", quantity=7, price=12), None),
+             lambda item: (item.quantity, item.price), (7, 12)),
+        ]
+        for change, field, value in changes:
+            self.search()
+            self.search(marketplace_pb2.FASHION)
+            hits = self.hits()
+            self.assertTrue(change(self.lamp).success)
+            self.assertEqual(field(self.search()), value)
+            self.assertEqual(self.hits(), hits)  # The electronics search was recomputed
+            self.assertEqual(self.search(marketplace_pb2.FASHION).id, self.shirt)
+            self.assertEqual(self.hits(), hits + 1)  # The fashion search was not
+
+class StreamLimitTest(unittest.TestCase):
+    def test_streams_past_the_limit_are_refused(self):
+        limit = StreamLimit(1)
+        context = mock.Mock()
+        self.assertTrue(limit.acquire(context))
+        self.assertFalse(limit.acquire(context))
+        context.set_code.assert_called_once_with(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        limit.release()
+        self.assertTrue(limit.acquire(context))
+
+    def test_server_keeps_workers_for_unary_calls(self):
+        server, service, port = create_server(0, max_workers=4)  # Half of the workers, 2, may hold streams
+        self.addCleanup(server.stop, 0)
+        channel = grpc.insecure_channel(f"localhost:{port}")
+        self.addCleanup(channel.close)
+        stub = marketplace_pb2_grpc.MarketplaceStub(channel)
+        streams = [stub.SubscribeNotifications(marketplace_pb2.NotificationRequest(buyer_address=f"buyer {i}"))
+                   for i in range(2)]
+        for stream in streams:
+            self.addCleanup(stream.cancel)
+        wait_for(lambda: service.streams.open == 2)
+
+        with self.assertRaises(grpc.RpcError) as refused:
+            next(stub.SubscribeNotifications(marketplace_pb2.NotificationRequest(buyer_address="buyer 2")))
+        self.assertEqual(refused.exception.code(), grpc.StatusCode.RESOURCE_EXHAUSTED)
+        stub.SearchItems(marketplace_pb2.SearchRequest(), timeout=5)
+
+class ShardRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.shards = []
+        for index in range(2):
+            server, shard, port = create_server(0, max_workers=8, shard_index=index, shard_count=2)
+            self.addCleanup(server.stop, 0)
+            self.shards.append((shard, f"localhost:{port}"))
+        server, _, port = shard_router.create_server(0, [address for _, address in self.shards], max_workers=8)
+        self.addCleanup(server.stop, 0)
+        channel = grpc.insecure_channel(f"localhost:{port}")
+        self.addCleanup(channel.close)
+        self.router = marketplace_pb2_grpc.MarketplaceStub(channel)
+
+    def add(self, shard_index, prices):
+        shard, address = self.shards[shard_index]
+        items = [marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=1,
+                                      seller_address=address, price=price) for price in prices]
+        return list(zip(prices, shard.add_items("seller", items)))
+
+    def page_through(self, request):
+        ids = []
+        while True:
+            response = self.router.SearchItems(request)
+            self.assertLessEqual(len(response.items), request.page_size)
+            ids += [item.id for item in response.items]
+            if not response.next_page_token:
+                return ids
+            request.page_token = response.next_page_token
+
+    def test_pages_merge_shards_in_sort_order_up_to_the_limit(self):
+        items = self.add(0, [5, 1, 9, 4, 3]) + self.add(1, [2, 8, 4, 7, 6])  # Price 4 on both shards
+        for order, expected in ((marketplace_pb2.SortOrder.ASCENDING, sorted(items)),
+                                (marketplace_pb2.SortOrder.DESCENDING,
+                                 sorted(items, key=lambda item: (-item[0], item[1])))):
+            request = marketplace_pb2.SearchRequest(name="lamp", category=marketplace_pb2.ANY, page_size=2,
+                                                    sort_by=marketplace_pb2.SortKey.PRICE, order=order, limit=5)
+            self.assertEqual(self.page_through(request), [item_id for _, item_id in expected[:5]])
+
+class ReplicaTest(unittest.TestCase):
+    def test_replica_reloads_after_a_batch_fails(self):
+        server, primary, port = create_server(0, max_workers=8)
+        self.addCleanup(server.stop, 0)
+        primary.sellers["seller"] = {"ip_port": "localhost:1"}
+        item = marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=5,
+                                    seller_address="localhost:1", price=10)
+        first, = primary.add_items("seller", [item])
+        replica = ReplicaService(f"localhost:{port}")
+        wait_for(lambda: first in replica.items)
+
+        apply = replica.apply
+        failures = []
+
+        def failing_apply(records):
+            if not failures:
+                failures.append(records)
+                raise KeyError("injected")
+            apply(records)
+
+        replica.apply = failing_apply
+        second, = primary.add_items("seller", [item])
+        wait_for(lambda: failures and second in replica.items)
+        self.assertEqual(replica.items[second].quantity, 5)
+        self.assertIsNotNone(replica.lag())
+
+    def test_reads_go_to_the_primary_while_the_stream_is_held_back(self):
+        '''
+        A replica that keeps receiving batches, but late, is behind by their age however often they arrive.
+        '''
+        primary = MarketplaceService()
+        replicate = primary.Replicate
+
+        def held_back(request, context):
+            batches = queue.SimpleQueue()
+
+            def receive():
+                for batch in replicate(request, context):
+                    batches.put((time.monotonic() + 3, batch))
+
+            threading.Thread(target=receive, daemon=True).start()
+            while True:
+                release_at, batch = batches.get()
+                time.sleep(max(0, release_at - time.monotonic()))
+                yield batch
+
+        primary.Replicate = held_back
+        server, _, port = create_server(0, max_workers=8, service=primary)
+        self.addCleanup(server.stop, 0)
+        replica_server, replica, replica_port = create_server(0, max_workers=8,
+                                                              service=ReplicaService(f"localhost:{port}", 2))
+        self.addCleanup(replica_server.stop, 0)
+        primary.sellers["seller"] = {"ip_port": "localhost:1"}
+        item = marketplace_pb2.Item(name="lamp", category=marketplace_pb2.ELECTRONICS, quantity=5,
+                                    seller_address="localhost:1", price=10)
+        wait_for(lambda: replica.current_as_of is not None)
+        wait_for(lambda: replica.lag() > 2)
+        item_id, = primary.add_items("seller", [item])
+
+        pool = ChannelPool(1)
+        self.addCleanup(pool.close)
+        client = MarketClient(f"localhost:{port}", pool=pool, replicas=[f"localhost:{replica_port}"])
+        request = marketplace_pb2.SearchRequest(name="lamp", category=marketplace_pb2.ANY)
+        with self.assertRaises(grpc.RpcError) as refused:
+            client.replica_stubs[0].SearchItems(request)
+        self.assertEqual(refused.exception.code(), grpc.StatusCode.FAILED_PRECONDITION)
+        self.assertEqual([found.id for found in client.call("SearchItems", request).items], [item_id])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,33 @@
+import collections
 import zmq
 import json
-import time
+import logging
+import os
+import threading
+import wire
+from message_log import MessageLog
+from message_store import MessageStore, CACHE_MESSAGES
+from server_logging import setup_logging
+
+log = logging.getLogger("group_server")
+
+WORKER_THREADS = 8  # Requests handled at once; each worker blocks only its own client
+READY = b"READY"  # Sent by a worker thread when it starts
+PUBLISH_PORT_OFFSET = 1000  # New messages are published on the group's port plus this
+MAX_PAGE_SIZE = 1000  # Most messages in one get_messages reply to a paging client; it fetches the rest after the last one received
 
 class GroupServer:
-    def __init__(self, group_id, message_server_address, message_server_ip_addr):
+    def __init__(self, group_id, message_server_address, message_server_ip_addr, messages=None):
         '''
         A server for a group chat.    
+        Messages are kept in memory unless a MessageStore is given to keep them on disk.
         '''
         self.group_id = group_id
         self.users = set()  # Set of user UUIDs
-        self.messages = []  # List of messages (dicts with 'user_id', 'timestamp', 'message')
+        self.messages = messages if messages is not None else MessageLog()  # Messages in the order they were sent
+        self.lock = threading.Lock()  # Guards users, appends to messages and publisher, shared by the worker threads
+        self.publish_port = group_id + PUBLISH_PORT_OFFSET
+        self.publisher = None  # PUB socket for new messages, bound by start()
         self.context = zmq.Context()
         self.message_server_address = message_server_address
         self.message_server_ip_addr = message_server_ip_addr
@@ -19,87 +37,195 @@ class GroupServer:
         '''
         Register the group server with the message server.
         '''
-        print(f"[GroupServer {self.group_id}] Registering with the message server.")
+        log.info("[GroupServer %s] Registering with the message server.", self.group_id)
         socket = self.context.socket(zmq.REQ)
         socket.connect(self.message_server_address)
         socket.send_json({"action": "register", "group_id": self.group_id, "address": f"tcp://10.190.0.3:{self.group_id}"})
         response = socket.recv_json()
-        print(f"[GroupServer {self.group_id}] Registration response: {response}")
+        log.info("[GroupServer %s] Registration response: %s", self.group_id, response)
 
     def handle_join(self, user_id):
         '''
         Add a user to the group.
         '''
-        if user_id not in self.users:
+        with self.lock:
+            if user_id in self.users:
+                return "USER ALREADY IN GROUP"
             self.users.add(user_id)
-            print(f"[GroupServer {self.group_id}] User {user_id} joined.")
-            return "SUCCESS"
-        else:
-            return "USER ALREADY IN GROUP"
+        log.info("[GroupServer %s] User %s joined.", self.group_id, user_id)
+        return "SUCCESS"
 
     def handle_leave(self, user_id):
         '''
         Remove a user from the group.
         '''
-        if user_id in self.users:
+        with self.lock:
+            if user_id not in self.users:
+                return "USER NOT IN GROUP"
             self.users.remove(user_id)
-            print(f"[GroupServer {self.group_id}] User {user_id} left.")
-            return "SUCCESS"
-        else:
-            return "USER NOT IN GROUP"
+        log.info("[GroupServer %s] User %s left.", self.group_id, user_id)
+        return "SUCCESS"
 
     def handle_send_message(self, user_id, message):
         '''
         Add a message to the group.
         '''
-        if user_id in self.users:
-            timestamp = time.time()
-            self.messages.append({"user_id": user_id, "timestamp": timestamp, "message": message})
-            print(f"[GroupServer {self.group_id}] Message received from user {user_id}.")
-            return "SUCCESS"
+        with self.lock:
+            if user_id not in self.users:
+                return "USER NOT IN GROUP"
+            entry = self.messages.append(user_id, message)
+            if self.publisher is not None:
+                # Published under the lock, so subscribers get messages in sequence order.
+                # Once per format; the PUB socket only sends each to the users subscribed to it.
+                for fmt in wire.FORMATS:
+                    self.publisher.send_multipart([self.topic(fmt)] + wire.encode(entry, fmt))
+        log.info("[GroupServer %s] Message received from user %s.", self.group_id, user_id)
+        return "SUCCESS"
+
+    def handle_get_messages(self, user_id, timestamp=0, after_seq=None, limit=None, page_size=MAX_PAGE_SIZE):
+        '''
+        Send messages to a user, oldest first: those with sequence numbers above after_seq
+        if it is given, else all since a given timestamp. At most limit messages are sent,
+        and at most page_size unless it is None; the user fetches the rest by passing the
+        last sequence number received as after_seq.
+        Returns the list of messages and whether more follow them, or an error string.
+        '''
+        with self.lock:
+            if user_id not in self.users:
+                return "USER NOT IN GROUP"
+        # Read without the lock, so a fetch from disk never holds up other users.
+        # Both message logs allow reads alongside appends.
+        page = min(filter(None, (limit, page_size)), default=None)
+        fetch = page + 1 if page else None  # One extra to tell if more follow
+        if after_seq is not None:
+            messages = self.messages.after(after_seq, fetch)
+        else:
+            messages = self.messages.since(timestamp, fetch)
+        if after_seq is not None:
+            log.info("[GroupServer %s] Sending messages to user %s after #%s.", self.group_id, user_id, after_seq)
         else:
-            return "USER NOT IN GROUP"
+            log.info("[GroupServer %s] Sending messages to user %s since timestamp %s.", self.group_id, user_id, timestamp)
+        return messages[:page], page is not None and len(messages) > page
 
-    def handle_get_messages(self, user_id, timestamp=0):
+    def topic(self, fmt):
         '''
-        Send all messages since a given timestamp to a user.
+        Topic new messages are published under in a format: the group ID and the format.
+        '''
+        return f"{self.group_id}/{fmt}".encode()
+
+    def handle_request(self, message, fmt=None):
         '''
-        if user_id in self.users:
-            messages_since = [msg for msg in self.messages if msg['timestamp'] >= timestamp]
-            print(f"[GroupServer {self.group_id}] Sending messages to user {user_id} since timestamp {timestamp}.")
-            return json.dumps(messages_since)
+        Handle one request from a user and return the reply.
+        fmt is the connection's negotiated wire format, or None for plain JSON.
+        '''
+        action = message['action']
+        if action == 'hello':
+            return {"response": "SUCCESS", "format": wire.choose(message.get('formats', ()))}
+        user_id = message['user_id']
+
+        if action == 'join':
+            # Tell the user where to subscribe for live messages
+            return {"response": self.handle_join(user_id), "publish_port": self.publish_port}
+        elif action == 'leave':
+            response = self.handle_leave(user_id)
+        elif action == 'send_message':
+            response = self.handle_send_message(user_id, message['message'])
+        elif action == 'get_messages':
+            timestamp = message.get('timestamp', 0)
+            # Only clients that negotiated a format or ask for a range know to fetch the next page;
+            # plain send_json clients are sent the whole history, as before paging
+            paged = fmt is not None or 'after_seq' in message or 'limit' in message
+            response = self.handle_get_messages(user_id, timestamp, message.get('after_seq'), message.get('limit'),
+                                                MAX_PAGE_SIZE if paged else None)
+            if isinstance(response, tuple):
+                messages, more = response
+                if fmt is None:
+                    messages = json.dumps(messages)  # Plain JSON clients expect the messages as a JSON string
+                return {"response": messages, "more": more}
         else:
-            return "USER NOT IN GROUP"
+            log.warning("[GroupServer %s] Received invalid action: %s", self.group_id, action)
+            response = "INVALID ACTION"
+        return {"response": response}
 
-    def start(self):
+    def start(self, workers=WORKER_THREADS):
         '''
         Start the server.
+        Users' REQ sockets connect to a ROUTER socket. Each request is passed
+        through a second ROUTER socket to a worker thread that has said it is
+        idle, and the reply is routed back to the user, so a slow request only
+        delays its own user. (A DEALER back end would deal requests out round-robin,
+        queueing some behind a busy worker.)
+        New messages are also published on a PUB socket for live delivery.
         '''
-        print(f"[GroupServer {self.group_id}] Starting server.")
-        socket = self.context.socket(zmq.REP)
-        socket.bind(f"tcp://*:{self.group_id}")
+        log.info("[GroupServer %s] Starting server with %s workers.", self.group_id, workers)
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.bind(f"tcp://*:{self.publish_port}")
+        frontend = self.context.socket(zmq.ROUTER)
+        frontend.bind(f"tcp://*:{self.group_id}")
+        backend = self.context.socket(zmq.ROUTER)
+        backend.bind(self.workers_address())
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
 
+        idle = collections.deque()  # Identities of the workers waiting for a request
+        both = zmq.Poller()
+        both.register(frontend, zmq.POLLIN)
+        both.register(backend, zmq.POLLIN)
+        workers_only = zmq.Poller()  # Used while every worker is busy, leaving requests queued
+        workers_only.register(backend, zmq.POLLIN)
         while True:
-            message = socket.recv_json()
-            action = message['action']
-            user_id = message['user_id']
-
-            if action == 'join':
-                response = self.handle_join(user_id)
-            elif action == 'leave':
-                response = self.handle_leave(user_id)
-            elif action == 'send_message':
-                response = self.handle_send_message(user_id, message['message'])
-            elif action == 'get_messages':
-                timestamp = message.get('timestamp', 0)
-                response = self.handle_get_messages(user_id, timestamp)
-            else:
-                response = "INVALID ACTION"
-                print(f"[GroupServer {self.group_id}] Received invalid action: {action}")
-
-            socket.send_json({"response": response})
+            events = dict((both if idle else workers_only).poll())
+            if backend in events:
+                # [worker, b"", b"READY"] or [worker, b"", user, b"", reply frames...]
+                worker, _, *reply = backend.recv_multipart()
+                idle.append(worker)
+                if reply != [READY]:
+                    frontend.send_multipart(reply)
+            if frontend in events:
+                # [user, b"", request frames...]
+                backend.send_multipart([idle.popleft(), b""] + frontend.recv_multipart())
+
+    def workers_address(self):
+        return f"inproc://group-{self.group_id}-workers"
+
+    def worker(self):
+        '''
+        Answer requests passed on by start(), one at a time.
+        '''
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(self.workers_address())
+        socket.send(READY)
+        while True:
+            user, empty, *request = socket.recv_multipart()
+            fmt = None  # Errors in undecodable requests are reported in plain JSON
+            try:
+                message, fmt = wire.decode(request)
+                reply = self.handle_request(message, fmt)
+            except Exception as e:
+                log.exception("[GroupServer %s] Failed to handle %r: %s", self.group_id, request, e)
+                reply = {"response": "ERROR"}  # Always reply, or the user's REQ socket waits forever
+            socket.send_multipart([user, empty] + wire.encode(reply, fmt))
+
+def open_message_store(group_id):
+    '''
+    Open the group's on-disk message store, configured by the GROUP_DATA_DIR,
+    GROUP_CACHE_MESSAGES, GROUP_RETENTION_HOURS and GROUP_RETENTION_MB environment
+    variables. Returns None, keeping messages in memory, if GROUP_DATA_DIR is not set.
+    '''
+    data_dir = os.environ.get("GROUP_DATA_DIR")
+    if not data_dir:
+        return None
+    hours = os.environ.get("GROUP_RETENTION_HOURS")
+    megabytes = os.environ.get("GROUP_RETENTION_MB")
+    store = MessageStore(os.path.join(data_dir, f"group-{group_id}"),
+                         cache_size=int(os.environ.get("GROUP_CACHE_MESSAGES", CACHE_MESSAGES)),
+                         retention_seconds=float(hours) * 3600 if hours else None,
+                         retention_bytes=int(float(megabytes) * 1024 * 1024) if megabytes else None)
+    log.info("[GroupServer %s] Loaded %s messages from %s.", group_id, len(store), store.directory)
+    return store
 
 def main(self_port):
+    setup_logging()
     ip_addr = "10.190.0.2" #input("Enter Message Server IP Address: ")
-    group_server = GroupServer(self_port, f"tcp://{ip_addr}:5555", ip_addr)
+    group_server = GroupServer(self_port, f"tcp://{ip_addr}:5555", ip_addr, open_message_store(self_port))
     group_server.start()
\ No newline at end of file
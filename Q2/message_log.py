@@ -0,0 +1,52 @@
+import bisect
+import time
+
+class MessageLog:
+    '''
+    Append-only log of a group's messages.
+    Every message gets the next sequence number and a timestamp no earlier
+    than the previous one's, so the timestamps form a sorted list that "since"
+    queries binary-search. Sequence numbers map straight to list positions,
+    so a client can resume exactly after the last message it saw. Both kinds
+    of query cost O(log n + returned).
+    Queries may run alongside one appending thread: the lists only grow, so a
+    query racing an append at worst misses the message being added.
+    '''
+    def __init__(self):
+        self.timestamps = []  # Timestamp of each message, non-decreasing
+        self.entries = []  # Messages (dicts with 'seq', 'user_id', 'timestamp', 'message'), in order
+        self.first_seq = 1  # Sequence number of entries[0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def next_seq(self):
+        return self.first_seq + len(self.entries)
+
+    def append(self, user_id, message):
+        '''
+        Add a message and return its entry.
+        '''
+        timestamp = time.time()
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            timestamp = self.timestamps[-1]  # The wall clock stepped back; keep the log sorted
+        entry = {"seq": self.next_seq(), "user_id": user_id, "timestamp": timestamp, "message": message}
+        self.timestamps.append(timestamp)
+        self.entries.append(entry)
+        return entry
+
+    def since(self, timestamp, limit=None):
+        '''
+        Return messages sent at or after timestamp, oldest first, at most limit of them.
+        '''
+        return self.slice(bisect.bisect_left(self.timestamps, timestamp), limit)
+
+    def after(self, seq, limit=None):
+        '''
+        Return messages with sequence numbers above seq, oldest first, at most limit of them.
+        '''
+        return self.slice(max(seq + 1 - self.first_seq, 0), limit)
+
+    def slice(self, start, limit):
+        end = len(self.entries) if not limit else start + limit
+        return self.entries[start:end]
@@ -1,39 +1,51 @@
 import zmq
-import json
+import logging
+import wire
+from server_logging import setup_logging
+
+log = logging.getLogger("message_server")
 
 def main():
     '''
     Start the message server.
     '''
+    setup_logging()
     context = zmq.Context()
     socket = context.socket(zmq.REP)
     socket.bind("tcp://*:5555")  # Bind to a TCP port
-    print("Message Server is running on port 5555.")
+    log.info("Message Server is running on port 5555.")
 
     groups = {}
 
     while True:
+        # Wait for a request from a client
+        request = socket.recv_multipart()
+        fmt = None  # Errors in undecodable requests are reported in plain JSON
         try:
-            # Wait for a request from a client
-            message = socket.recv_json()
+            message, fmt = wire.decode(request)
             action = message.get('action')
 
-            if action == 'register':
+            if action == 'hello':
+                # Agree on a wire format for the rest of the connection
+                reply = {"status": "SUCCESS", "format": wire.choose(message.get('formats', ()))}
+            elif action == 'register':
                 # Register a new group server
-                group_id = message['group_id']
+                group_id = str(message['group_id'])  # The same key in every wire format
                 group_address = message['address']
                 groups[group_id] = group_address
-                print(f"Registering group '{group_id}' with address '{group_address}'.")
-                socket.send_json({"status": "SUCCESS"})
+                log.info("Registering group '%s' with address '%s'.", group_id, group_address)
+                reply = {"status": "SUCCESS"}
             elif action == 'get_groups':
                 # Send the list of groups to a user
-                print("Received request for group list. Sending group list.")
-                socket.send_json(groups)
+                log.info("Received request for group list. Sending group list.")
+                reply = groups
             else:
-                print(f"Received unknown action: {action}")
-                socket.send_json({"status": "ERROR", "message": "Unknown action"})
+                log.warning("Received unknown action: %s", action)
+                reply = {"status": "ERROR", "message": "Unknown action"}
         except Exception as e:
-            print(f"An error occurred: {e}")
+            log.exception("An error occurred: %s", e)
+            reply = {"status": "ERROR", "message": str(e)}  # A REP socket must reply before the next request
+        socket.send_multipart(wire.encode(reply, fmt))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,355 @@
+'''
+On-disk log of a group's messages, kept across restarts in bounded memory.
+The log is split into segment files named after the sequence number of
+their first message. Each segment has an index file that holds the timestamp
+and file offset of every record. Records are only ever appended to the newest
+segment. A message is found by choosing its segment, then doing one index
+lookup (by sequence number) or a binary search of the index (by timestamp).
+Old segments are read through memory maps, so a fetch only touches the pages
+it returns and never loads a whole segment into the Python heap. The most
+recent messages are also cached in memory, since most fetches ask for those.
+'''
+
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct("<QdII")  # Sequence number, timestamp, payload length and CRC32 of every log record
+INDEX_ENTRY = struct.Struct("<dQ")  # Timestamp and log offset of every record, in the segment's index file
+SEGMENT_BYTES = 8 * 1024 * 1024  # A new segment is started once the newest one reaches this size
+CACHE_MESSAGES = 1000  # Most recent messages kept in memory
+
+def fsync_dir(directory):
+    '''
+    Make new and deleted files in directory durable.
+    '''
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def map_file(path):
+    '''
+    Open a read-only memory map of a file. The file may be deleted or appended to
+    while the map is open; the map keeps showing what the file held when it was mapped.
+    '''
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Segment:
+    '''
+    One log file and its index file. Only the newest segment is open for writing.
+    '''
+    def __init__(self, directory, first_seq):
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = base + ".log"
+        self.index_path = base + ".idx"
+        self.first_seq = first_seq  # Sequence number of the segment's first message
+        self.log = self.index = None  # Files appended to, while this is the newest segment
+        self.size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0  # Bytes in the log file
+        self.count = 0  # Messages in the segment
+        self.last_timestamp = 0  # Timestamp of the segment's last message
+        self.readers = 0  # Reads in progress, which retention waits for before deleting the files
+        self.deleted = False  # Dropped by retention; the files go when the last reader is done
+        if os.path.exists(self.index_path):
+            self.count = os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        if self.count:
+            with open(self.index_path, "rb") as f:
+                f.seek((self.count - 1) * INDEX_ENTRY.size)
+                self.last_timestamp, _ = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+
+    def recover(self):
+        '''
+        Rebuild the index from the log, dropping a torn or corrupt record at its end
+        (from a crash mid-write), and open both files for appending.
+        '''
+        index = bytearray()
+        good = 0
+        self.last_timestamp = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+            while good + RECORD_HEADER.size <= len(data):
+                _, timestamp, length, crc = RECORD_HEADER.unpack_from(data, good)
+                payload = data[good + RECORD_HEADER.size:good + RECORD_HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                index += INDEX_ENTRY.pack(timestamp, good)
+                self.last_timestamp = timestamp
+                good += RECORD_HEADER.size + length
+        self.log = open(self.log_path, "ab")
+        self.log.truncate(good)
+        with open(self.index_path, "wb") as f:
+            f.write(index)
+        self.index = open(self.index_path, "ab")
+        self.size = good
+        self.count = len(index) // INDEX_ENTRY.size
+
+    def append(self, entry):
+        '''
+        Write a message to the end of the segment.
+        The files are flushed so the message survives the process crashing,
+        but only synced to disk when the segment is sealed.
+        '''
+        payload = json.dumps([entry['user_id'], entry['message']]).encode()
+        self.log.write(RECORD_HEADER.pack(entry['seq'], entry['timestamp'], len(payload), zlib.crc32(payload)) + payload)
+        self.log.flush()
+        self.index.write(INDEX_ENTRY.pack(entry['timestamp'], self.size))
+        self.index.flush()
+        self.size += RECORD_HEADER.size + len(payload)
+        self.count += 1
+        self.last_timestamp = entry['timestamp']
+
+    def seal(self):
+        '''
+        Sync the segment to disk and stop writing to it.
+        '''
+        for f in (self.log, self.index):
+            if f is not None:
+                os.fsync(f.fileno())
+                f.close()
+        self.log = self.index = None
+
+    def delete(self):
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+    def first_at(self, timestamp, count):
+        '''
+        Position in the segment of the first message sent at or after timestamp,
+        among its first count messages.
+        '''
+        low, high = 0, count
+        if count:
+            with map_file(self.index_path) as index:
+                while low < high:
+                    middle = (low + high) // 2
+                    if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[0] < timestamp:
+                        low = middle + 1
+                    else:
+                        high = middle
+        return low
+
+    def read(self, position, count):
+        '''
+        Return count messages from a position in the segment on.
+        Safe while messages are appended, as those already counted are on file.
+        '''
+        if not count:
+            return []
+        entries = []
+        with map_file(self.index_path) as index, map_file(self.log_path) as log:
+            _, offset = INDEX_ENTRY.unpack_from(index, position * INDEX_ENTRY.size)
+            for _ in range(count):
+                seq, timestamp, length, _ = RECORD_HEADER.unpack_from(log, offset)
+                offset += RECORD_HEADER.size
+                user_id, message = json.loads(log[offset:offset + length])
+                offset += length
+                entries.append({"seq": seq, "user_id": user_id, "timestamp": timestamp, "message": message})
+        return entries
+
+class MessageStore:
+    '''
+    Append-only log of a group's messages, stored on disk in directory.
+    It answers the same queries as MessageLog: by timestamp, or after a
+    sequence number. Recent messages are answered from the cache. Older ones
+    are read from their segment, after a binary search of its index.
+    Retention deletes whole segments, oldest first: those holding only
+    messages older than retention_seconds, and those that take the log past
+    retention_bytes. The newest segment is never deleted. Retention is applied
+    on startup and whenever a segment fills up.
+    Appends and queries may come from several threads. Disk reads run outside
+    the store's lock, with their segments pinned so retention leaves the files
+    until the reads are done.
+    '''
+    def __init__(self, directory, cache_size=CACHE_MESSAGES, segment_bytes=SEGMENT_BYTES,
+                 retention_seconds=None, retention_bytes=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.cache_size = cache_size
+        self.segment_bytes = segment_bytes
+        self.retention_seconds = retention_seconds  # None keeps messages regardless of age
+        self.retention_bytes = retention_bytes  # None keeps messages regardless of the log's size
+        self.lock = threading.Lock()  # Guards segments, first_seq and the cache; held only briefly
+
+        names = glob.glob(os.path.join(directory, "*.log"))
+        first_seqs = sorted(int(os.path.basename(name)[:-4]) for name in names) or [1]
+        self.segments = [Segment(directory, first_seq) for first_seq in first_seqs]  # Oldest first
+        self.segments[-1].recover()  # Only the newest segment can have been cut off by a crash
+        self.first_seq = self.segments[0].first_seq  # Sequence number of the oldest message kept
+        self.enforce_retention()
+        # Timestamp of the newest message, which the next one's may not be earlier than
+        self.last_timestamp = next((s.last_timestamp for s in reversed(self.segments) if s.count), 0)
+
+        # The newest messages, with their timestamps; holds between cache_size and twice that
+        # once full, so that trimming it is amortized O(1)
+        self.cache = self.read(self.plan(max(self.first_seq, self.next_seq() - cache_size), cache_size)) if cache_size else []
+        self.cache_timestamps = [entry['timestamp'] for entry in self.cache]
+
+    def __len__(self):
+        return self.next_seq() - self.first_seq
+
+    def next_seq(self):
+        newest = self.segments[-1]
+        return newest.first_seq + newest.count
+
+    def size(self):
+        '''
+        Bytes the log takes on disk, not counting the indexes.
+        '''
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, user_id, message):
+        '''
+        Add a message and return its entry.
+        '''
+        with self.lock:
+            newest = self.segments[-1]
+            timestamp = time.time()
+            if timestamp < self.last_timestamp:
+                timestamp = self.last_timestamp  # The wall clock stepped back; keep the log sorted
+            entry = {"seq": self.next_seq(), "user_id": user_id, "timestamp": timestamp, "message": message}
+            newest.append(entry)
+            self.last_timestamp = timestamp
+            if self.cache_size:
+                self.cache.append(entry)
+                self.cache_timestamps.append(timestamp)
+                if len(self.cache) >= 2 * self.cache_size:
+                    del self.cache[:-self.cache_size]
+                    del self.cache_timestamps[:-self.cache_size]
+            if newest.size >= self.segment_bytes:
+                self.roll()
+            return entry
+
+    def roll(self):
+        '''
+        Seal the newest segment and start a new one.
+        '''
+        self.segments[-1].seal()
+        segment = Segment(self.directory, self.next_seq())
+        segment.recover()
+        self.segments.append(segment)
+        fsync_dir(self.directory)
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        '''
+        Delete the oldest segments that fall outside the retention limits.
+        Segments being read are dropped from the log at once, but their files are left for read() to delete.
+        '''
+        deleted = False
+        size = self.size()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = (self.retention_seconds is not None and
+                       oldest.last_timestamp < time.time() - self.retention_seconds)
+            if not expired and (self.retention_bytes is None or size <= self.retention_bytes):
+                break
+            size -= oldest.size
+            oldest.seal()
+            oldest.deleted = True
+            if not oldest.readers:
+                oldest.delete()
+            del self.segments[0]
+            deleted = True
+        self.first_seq = self.segments[0].first_seq
+        if deleted:
+            fsync_dir(self.directory)
+
+    def since(self, timestamp, limit=None):
+        '''
+        Return messages sent at or after timestamp, oldest first, at most limit of them.
+        '''
+        with self.lock:
+            if self.cache and timestamp > self.cache_timestamps[0]:
+                # Everything before the cache is older than timestamp
+                position = bisect.bisect_left(self.cache_timestamps, timestamp)
+                return self.cached(self.next_seq() - len(self.cache) + position, limit)
+            # Segments are few next to messages, so they are scanned rather than searched
+            segment = next((segment for segment in self.segments
+                            if segment.count and segment.last_timestamp >= timestamp), None)
+            if segment is None:
+                return []
+            count = segment.count
+            segment.readers += 1
+        try:
+            position = segment.first_at(timestamp, count)
+        finally:
+            self.unpin([segment])
+        return self.after(segment.first_seq + position - 1, limit)
+
+    def after(self, seq, limit=None):
+        '''
+        Return messages with sequence numbers above seq, oldest first, at most limit of them.
+        '''
+        with self.lock:
+            start = max(seq + 1, self.first_seq)
+            entries = self.cached(start, limit)
+            if entries is not None:
+                return entries
+            plan = self.plan(start, limit)
+        return self.read(plan)
+
+    def cached(self, start, limit):
+        '''
+        Return the messages from sequence number start on, at most limit of them, if the cache
+        holds them; else None. Must be called with the lock held.
+        '''
+        cache_start = self.next_seq() - len(self.cache)
+        start = max(start, self.first_seq)  # The cache may reach into segments retention has dropped
+        if start < cache_start:
+            return None
+        position = start - cache_start
+        end = len(self.cache) if not limit else position + limit
+        return self.cache[position:end]
+
+    def plan(self, start, limit):
+        '''
+        Return the (segment, position, count) ranges holding the messages from sequence number
+        start on, at most limit of them, and pin their segments for read().
+        Must be called with the lock held, or before the store is shared.
+        '''
+        ranges = []
+        for segment in self.segments:
+            end = segment.first_seq + segment.count
+            if start >= end:
+                continue
+            count = end - start if not limit else min(end - start, limit)
+            segment.readers += 1
+            ranges.append((segment, start - segment.first_seq, count))
+            start = end
+            if limit:
+                limit -= count
+                if not limit:
+                    break
+        return ranges
+
+    def read(self, plan):
+        '''
+        Read the messages in ranges returned by plan() from disk, then unpin their segments.
+        '''
+        try:
+            entries = []
+            for segment, position, count in plan:
+                entries += segment.read(position, count)
+            return entries
+        finally:
+            self.unpin([segment for segment, _, _ in plan])
+
+    def unpin(self, segments):
+        with self.lock:
+            for segment in segments:
+                segment.readers -= 1
+                if segment.deleted and not segment.readers:
+                    segment.delete()
+
+    def close(self):
+        with self.lock:
+            self.segments[-1].seal()
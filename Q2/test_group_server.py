@@ -0,0 +1,160 @@
+'''
+Tests for the group server. Run from Q2 with:
+    python3 -m unittest
+'''
+
+import json
+import socket
+import threading
+import time
+import unittest
+import zmq
+import wire
+from group_server import MAX_PAGE_SIZE, PUBLISH_PORT_OFFSET, GroupServer
+
+class LocalGroupServer(GroupServer):
+    '''
+    Group server that is not registered with a message server.
+    '''
+    def register_with_message_server(self):
+        pass
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+def group_port():
+    '''
+    A free port for a group server whose publish port is free too.
+    '''
+    while True:
+        port = free_port()
+        try:
+            with socket.socket() as s:
+                s.bind(("", port + PUBLISH_PORT_OFFSET))
+            return port
+        except OSError:
+            continue
+
+class GetMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalGroupServer(0, None, None)
+        self.addCleanup(self.server.context.term)
+        self.server.handle_join("user")
+        for i in range(MAX_PAGE_SIZE + 5):
+            self.server.messages.append("user", f"message {i}")
+
+    def test_plain_json_requests_get_the_whole_history(self):
+        reply = self.server.handle_request({"action": "get_messages", "user_id": "user", "timestamp": 0})
+        self.assertEqual(len(json.loads(reply['response'])), MAX_PAGE_SIZE + 5)
+        self.assertFalse(reply['more'])
+
+    def test_paging_requests_get_one_page(self):
+        reply = self.server.handle_request({"action": "get_messages", "user_id": "user", "timestamp": 0}, wire.JSON)
+        self.assertEqual(len(reply['response']), MAX_PAGE_SIZE)
+        self.assertTrue(reply['more'])
+        reply = self.server.handle_request({"action": "get_messages", "user_id": "user", "after_seq": MAX_PAGE_SIZE})
+        self.assertEqual([entry['seq'] for entry in json.loads(reply['response'])],
+                         list(range(MAX_PAGE_SIZE + 1, MAX_PAGE_SIZE + 6)))
+        self.assertFalse(reply['more'])
+
+class WireTest(unittest.TestCase):
+    message = {"action": "send_message", "user_id": "user", "message": "héllo"}
+
+    def test_plain_json_round_trip(self):
+        frames = wire.encode(self.message)
+        self.assertEqual(frames, [json.dumps(self.message).encode()])  # As send_json sends it
+        self.assertEqual(wire.decode(frames), (self.message, None))
+
+    def test_format_round_trips(self):
+        for fmt in wire.FORMATS:
+            frames = wire.encode(self.message, fmt)
+            self.assertEqual(frames[0], fmt.encode())
+            self.assertEqual(wire.decode(frames), (self.message, fmt))
+
+    def test_unknown_format_is_rejected(self):
+        with self.assertRaises(ValueError):
+            wire.decode([b"xml", b"<message/>"])
+
+    def test_choose(self):
+        self.assertEqual(wire.choose(wire.FORMATS), wire.FORMATS[0])
+        self.assertEqual(wire.choose([wire.JSON]), wire.JSON)
+        self.assertEqual(wire.choose(["xml"]), wire.JSON)
+        self.assertEqual(wire.choose([]), wire.JSON)
+
+class RunningServerTest(unittest.TestCase):
+    '''
+    Requests to a group server running its worker pool.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalGroupServer(group_port(), None, None)
+        threading.Thread(target=cls.server.start, daemon=True).start()  # Runs until the process exits
+        cls.context = zmq.Context()
+
+    def connect(self, socket_type=zmq.REQ, port=None):
+        client = self.context.socket(socket_type)
+        client.setsockopt(zmq.LINGER, 0)
+        client.setsockopt(zmq.RCVTIMEO, 5000)
+        client.connect(f"tcp://localhost:{port or self.server.group_id}")
+        self.addCleanup(client.close)
+        return client
+
+    def test_malformed_requests_get_an_error_reply(self):
+        malformed, valid = self.connect(), self.connect()
+        with self.assertLogs("group_server", "ERROR"):
+            malformed.send(b"not json")
+            valid.send_json({"action": "join", "user_id": "valid"})
+            self.assertEqual(malformed.recv_json(), {"response": "ERROR"})
+            malformed.send_multipart([b"unknown format", b"{}"])
+            self.assertEqual(malformed.recv_json(), {"response": "ERROR"})
+        self.assertEqual(valid.recv_json()['response'], "SUCCESS")
+        malformed.send_json({"action": "join", "user_id": "malformed"})  # The socket is still usable
+        self.assertEqual(malformed.recv_json()['response'], "SUCCESS")
+
+    def test_subscribers_get_only_their_format(self):
+        subscribers = {}
+        for fmt in (wire.JSON, wire.MSGPACK):
+            subscribers[fmt] = self.connect(zmq.SUB, self.server.publish_port)
+            subscribers[fmt].setsockopt(zmq.SUBSCRIBE, self.server.topic(fmt))
+        time.sleep(0.3)  # For the subscriptions to reach the publisher
+        self.server.handle_join("sender")
+        self.assertEqual(self.server.handle_send_message("sender", "hello"), "SUCCESS")
+        for fmt, subscriber in subscribers.items():
+            if fmt in wire.FORMATS:
+                topic, *frames = subscriber.recv_multipart()
+                self.assertEqual(topic, self.server.topic(fmt))
+                entry, received = wire.decode(frames)
+                self.assertEqual((entry['message'], received), ("hello", fmt))
+            self.assertFalse(subscriber.poll(200))  # Nothing else, and nothing at all in formats not offered
+
+    def test_negotiate(self):
+        client = self.connect()
+        fmt = wire.negotiate(client, {"action": "hello", "user_id": "negotiator"})
+        self.assertEqual(fmt, wire.FORMATS[0])
+        client.send_multipart(wire.encode({"action": "join", "user_id": "negotiator"}, fmt))
+        reply, received = wire.decode(client.recv_multipart())
+        self.assertEqual((reply['response'], received), ("SUCCESS", fmt))
+
+    def test_negotiate_with_a_server_without_hello(self):
+        '''
+        A server from before formats were negotiated answers hello as an invalid action, in plain JSON.
+        '''
+        server = self.context.socket(zmq.REP)
+        server.setsockopt(zmq.LINGER, 0)
+        self.addCleanup(server.close)
+        port = server.bind_to_random_port("tcp://127.0.0.1")
+
+        def answer():
+            request = server.recv_json()
+            server.send_json({"response": "INVALID ACTION" if 'user_id' in request else "ERROR"})
+
+        responder = threading.Thread(target=answer, daemon=True)
+        responder.start()
+        client = self.connect(port=port)
+        self.assertIsNone(wire.negotiate(client, {"action": "hello", "user_id": "legacy"}))
+        responder.join()
+
+if __name__ == "__main__":
+    unittest.main()
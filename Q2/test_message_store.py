@@ -0,0 +1,112 @@
+'''
+Tests for the in-memory and on-disk message logs. Run from Q2 with:
+    python3 -m unittest
+'''
+
+import glob
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from message_log import MessageLog
+from message_store import MessageStore
+
+class MessageLogTest(unittest.TestCase):
+    def setUp(self):
+        self.log = MessageLog()
+        # The wall clock steps back from 12 to 9 before the fourth message
+        with mock.patch("message_log.time.time", side_effect=[10, 11, 12, 9, 13]):
+            self.entries = [self.log.append("user", f"message {i}") for i in range(5)]
+
+    def test_timestamps_never_go_backwards(self):
+        self.assertEqual([entry['timestamp'] for entry in self.entries], [10, 11, 12, 12, 13])
+        self.assertEqual([entry['seq'] for entry in self.entries], [1, 2, 3, 4, 5])
+
+    def test_since(self):
+        self.assertEqual(self.log.since(0), self.entries)
+        self.assertEqual(self.log.since(11), self.entries[1:])
+        self.assertEqual(self.log.since(11.5), self.entries[2:])
+        self.assertEqual(self.log.since(12), self.entries[2:])  # Both messages stamped 12
+        self.assertEqual(self.log.since(11, 2), self.entries[1:3])
+        self.assertEqual(self.log.since(14), [])
+
+    def test_after(self):
+        self.assertEqual(self.log.after(0), self.entries)
+        self.assertEqual(self.log.after(3), self.entries[3:])
+        self.assertEqual(self.log.after(1, 2), self.entries[1:3])
+        self.assertEqual(self.log.after(-5, 1), self.entries[:1])
+        self.assertEqual(self.log.after(5), [])
+
+class MessageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # Every message one second after the last, so timestamps pick out single messages
+        clock = mock.patch("message_store.time.time", side_effect=itertools.count(1000))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def open_store(self, **options):
+        options.setdefault("segment_bytes", 500)
+        store = MessageStore(self.directory, **options)
+        self.addCleanup(store.close)
+        return store
+
+    def fill(self, store, count):
+        return [store.append("user", f"message {i}") for i in range(count)]
+
+    def segment_files(self):
+        return sorted(glob.glob(os.path.join(self.directory, "*.log")))
+
+    def test_full_segments_roll_over(self):
+        store = self.open_store(cache_size=0)
+        entries = self.fill(store, 50)
+        self.assertGreater(len(self.segment_files()), 3)
+        self.assertEqual(store.after(0), entries)
+        self.assertEqual([entry['seq'] for entry in entries], list(range(1, 51)))
+
+    def test_reopened_store_continues_the_log(self):
+        store = self.open_store(cache_size=10)
+        entries = self.fill(store, 50)
+        store.close()
+        with open(self.segment_files()[-1], "ab") as f:
+            f.write(b"\x00" * 7)  # A record torn by a crash
+
+        reopened = self.open_store(cache_size=10)
+        self.assertEqual(len(reopened), 50)
+        self.assertEqual(reopened.after(0), entries)
+        self.assertEqual(reopened.after(45), entries[45:])  # From the reloaded cache
+        self.assertEqual(reopened.append("user", "after restart")['seq'], 51)
+
+    def test_retention_waits_for_pinned_segments(self):
+        store = self.open_store(cache_size=0)
+        self.fill(store, 20)
+        oldest = self.segment_files()[0]
+        with store.lock:
+            plan = store.plan(1, 5)
+        store.retention_bytes = 1
+        self.fill(store, 20)  # Rolls, which applies retention
+        self.assertGreater(store.first_seq, 1)
+        self.assertTrue(os.path.exists(oldest))
+        self.assertEqual([entry['seq'] for entry in store.read(plan)], [1, 2, 3, 4, 5])
+        self.assertFalse(os.path.exists(oldest))
+
+    def test_queries_span_the_cache_and_the_segments(self):
+        store = self.open_store(cache_size=10)
+        entries = self.fill(store, 60)
+        cache_start = store.next_seq() - len(store.cache)
+        self.assertGreater(cache_start, 5)
+        first = cache_start - 5  # Five messages on disk before the cache
+
+        self.assertEqual(store.after(first - 1), entries[first - 1:])
+        self.assertEqual(store.after(first - 1, 8), entries[first - 1:first + 7])
+        self.assertEqual(store.since(entries[first - 1]['timestamp']), entries[first - 1:])
+        self.assertEqual(store.since(entries[first - 1]['timestamp'], 8), entries[first - 1:first + 7])
+        self.assertEqual(store.since(entries[-3]['timestamp']), entries[-3:])
+        self.assertEqual(store.since(0, 3), entries[:3])
+        self.assertEqual(store.since(entries[-1]['timestamp'] + 1), [])
+
+if __name__ == "__main__":
+    unittest.main()
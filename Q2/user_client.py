@@ -1,6 +1,11 @@
 import zmq
 import json
+import threading
 import uuid
+import wire
+
+SUBSCRIBE_SETTLE_MS = 200  # Time for a new subscription to reach the group server before catching up
+POLL_MS = 500  # How often a subscription checks whether it was cancelled
 
 class UserClient:
     def __init__(self, message_server_address):
@@ -12,15 +17,52 @@ class UserClient:
         self.message_server_address = message_server_address
         self.group_sockets = {}
         self.group_addresses = {}
+        self.last_seq = {}  # Maps group_id to the sequence number of the last message fetched from it
+        self.publish_addresses = {}  # Maps group_id to the address its new messages are published on
+        self.subscriptions = {}  # Maps group_id to the Event that stops its live message thread
+        self.formats = {}  # Maps each open REQ socket to its negotiated wire format (None for plain JSON)
+        self.message_server_socket = None  # Opened by the first get_groups
+
+    def connect(self, address):
+        '''
+        Open a REQ socket to a server and agree on a wire format with it.
+        '''
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(address)
+        # user_id is included so that servers without "hello" answer it with an error instead of failing
+        self.formats[socket] = wire.negotiate(socket, {"action": "hello", "user_id": self.user_id})
+        return socket
+
+    def close(self, socket):
+        self.formats.pop(socket, None)
+        socket.close()
+
+    def request(self, socket, message):
+        '''
+        Send a request in the socket's wire format and return the reply.
+        '''
+        socket.send_multipart(wire.encode(message, self.formats.get(socket)))
+        reply, _ = wire.decode(socket.recv_multipart())
+        return reply
+
+    def parse_messages(self, response):
+        '''
+        Return the messages in a get_messages response, or None if it is an error.
+        '''
+        if isinstance(response, list):
+            return response
+        try:
+            return json.loads(response)  # Plain JSON connections get the messages as a JSON string
+        except ValueError:
+            return None  # An error such as "USER NOT IN GROUP"
 
     def get_groups(self):
         '''
         Get the list of available groups from the message server.
         '''
-        socket = self.context.socket(zmq.REQ)
-        socket.connect(self.message_server_address)
-        socket.send_json({"action": "get_groups"})
-        groups = socket.recv_json()
+        if self.message_server_socket is None:
+            self.message_server_socket = self.connect(self.message_server_address)
+        groups = self.request(self.message_server_socket, {"action": "get_groups"})
         print("Available groups:")
         for group_id, address in groups.items():
             self.group_addresses[group_id] = address
@@ -34,13 +76,15 @@ class UserClient:
         if group_id not in self.group_addresses:
             print(f"Group {group_id} does not exist.")
         elif group_id not in self.group_sockets:
-            socket = self.context.socket(zmq.REQ)
-            socket.connect(self.group_addresses[group_id])
-            socket.send_json({"action": "join", "user_id": self.user_id})
-            response = socket.recv_json()
+            socket = self.connect(self.group_addresses[group_id])
+            response = self.request(socket, {"action": "join", "user_id": self.user_id})
             print(f"Response to joining group {group_id}: {response['response']}")
             if response['response'] == "SUCCESS":
                 self.group_sockets[group_id] = socket
+                host = self.group_addresses[group_id].rsplit(":", 1)[0]
+                self.publish_addresses[group_id] = f"{host}:{response['publish_port']}"
+            else:
+                self.close(socket)
         else:
             print(f"Group {group_id} already joined.")
 
@@ -50,10 +94,11 @@ class UserClient:
         '''
         if group_id in self.group_sockets:
             socket = self.group_sockets[group_id]
-            socket.send_json({"action": "leave", "user_id": self.user_id})
-            response = socket.recv_json()
+            response = self.request(socket, {"action": "leave", "user_id": self.user_id})
             print(f"Response to leaving group {group_id}: {response['response']}")
+            self.unsubscribe(group_id)
             del self.group_sockets[group_id]
+            self.close(socket)
 
     def send_message(self, group_id, message):
         '''
@@ -62,23 +107,126 @@ class UserClient:
         if group_id in self.group_sockets:
             # Check if the user is part of the group
             socket = self.group_sockets[group_id]
-            socket.send_json({"action": "send_message", "user_id": self.user_id, "message": message})
-            response = socket.recv_json()
+            response = self.request(socket, {"action": "send_message", "user_id": self.user_id, "message": message})
             print(f"Response to sending message to group {group_id}: {response['response']}")
         else:
             # User is not part of the group, print a failed message
             print(f"Failed to send message: You are not a member of group {group_id}")
 
 
-    def get_messages(self, group_id, timestamp=0):
+    def get_messages(self, group_id, timestamp=0, after_seq=None, limit=None):
         '''
-        Get messages from a group.
+        Get messages from a group, either since a timestamp or after a sequence number.
+        The group server sends long histories a page at a time; each page is printed
+        as it arrives and the next one fetched after its last sequence number.
         '''
-        if group_id in self.group_sockets:
-            socket = self.group_sockets[group_id]
-            socket.send_json({"action": "get_messages", "user_id": self.user_id, "timestamp": timestamp})
-            response = socket.recv_json()
-            print(f"Messages from group {group_id}: {response['response']}")
+        if group_id not in self.group_sockets:
+            return []
+        socket = self.group_sockets[group_id]
+        request = {"action": "get_messages", "user_id": self.user_id, "timestamp": timestamp}
+        messages = []
+        for page in self.pages(socket, request, after_seq, limit):
+            if page is None:
+                break
+            print(f"Messages from group {group_id}: {page}")
+            messages += page
+            if page:
+                self.last_seq[group_id] = max(self.last_seq.get(group_id, 0), page[-1]['seq'])
+        return messages
+
+    def pages(self, socket, request, after_seq=None, limit=None):
+        '''
+        Send a get_messages request and yield the messages of each page of the reply, asking
+        for the next page after the last message received while the server says more follow.
+        Yields None and stops if the server answers with an error.
+        '''
+        received = 0
+        while True:
+            if after_seq is not None:
+                request["after_seq"] = after_seq
+            if limit:
+                request["limit"] = limit - received
+            response = self.request(socket, request)
+            page = self.parse_messages(response['response'])
+            if page is None:
+                print(f"Failed to get messages: {response['response']}")
+            yield page
+            received += len(page or ())
+            if not page or not response.get('more') or (limit and received >= limit):
+                return
+            after_seq = page[-1]['seq']
+
+    def get_new_messages(self, group_id, limit=None):
+        '''
+        Get the messages sent to a group since the last fetch, resuming by sequence number.
+        '''
+        return self.get_messages(group_id, after_seq=self.last_seq.get(group_id, 0), limit=limit)
+
+    def subscribe(self, group_id, on_message=None):
+        '''
+        Receive a group's messages as they are sent, on a background thread.
+        Each message is passed to on_message, or printed. Messages sent since the
+        last fetch are fetched first, so none are missed or repeated.
+        '''
+        if group_id not in self.group_sockets:
+            print(f"Failed to subscribe: You are not a member of group {group_id}")
+        elif group_id not in self.subscriptions:
+            stop = self.subscriptions[group_id] = threading.Event()
+            threading.Thread(target=self.listen, args=(group_id, on_message or self.print_message, stop),
+                             daemon=True).start()
+            print(f"Subscribed to group {group_id}.")
+
+    def unsubscribe(self, group_id):
+        '''
+        Stop receiving a group's messages as they are sent.
+        '''
+        stop = self.subscriptions.pop(group_id, None)
+        if stop is not None:
+            stop.set()
+
+    def print_message(self, group_id, message):
+        print(f"[{group_id}] {message['user_id']}: {message['message']}")
+
+    def listen(self, group_id, on_message, stop):
+        '''
+        Deliver a group's published messages in sequence order until stopped.
+        Messages are numbered, so anything missed (before the subscription took
+        effect, or dropped while this client was slow) is fetched from the group
+        server by sequence number, and anything already seen is skipped.
+        '''
+        fetcher = self.connect(self.group_addresses[group_id])  # The group's main socket belongs to the calling thread
+        subscriber = self.context.socket(zmq.SUB)
+        # Messages are published once per wire format, with the format in the topic
+        subscriber.setsockopt(zmq.SUBSCRIBE, f"{group_id}/{self.formats[fetcher] or wire.JSON}".encode())
+        subscriber.connect(self.publish_addresses[group_id])
+
+        def deliver(message):
+            last = self.last_seq.get(group_id, 0)
+            if message['seq'] <= last:
+                return
+            if message['seq'] > last + 1:
+                catch_up()  # Fills the gap, and includes this message
+                return
+            self.last_seq[group_id] = message['seq']
+            on_message(group_id, message)
+
+        def catch_up():
+            request = {"action": "get_messages", "user_id": self.user_id}
+            for missed in self.pages(fetcher, request, self.last_seq.get(group_id, 0)):
+                for message in missed or ():
+                    self.last_seq[group_id] = message['seq']
+                    on_message(group_id, message)
+
+        try:
+            subscriber.poll(SUBSCRIBE_SETTLE_MS)  # Messages published meanwhile are kept for after the catch up
+            catch_up()
+            while not stop.is_set():
+                if subscriber.poll(POLL_MS):
+                    _, *frames = subscriber.recv_multipart()
+                    deliver(wire.decode(frames)[0])
+        finally:
+            subscriber.close()
+            self.close(fetcher)
 
     def user_interface(self):
         '''
@@ -91,7 +239,9 @@ class UserClient:
             print("3. Leave a group")
             print("4. Send a message")
             print("5. Get messages")
-            print("6. Exit")
+            print("6. Subscribe to live messages")
+            print("7. Unsubscribe from live messages")
+            print("8. Exit")
             choice = input("Enter your choice: ")
 
             if choice == '1': # Get list of groups
@@ -108,10 +258,19 @@ class UserClient:
                 self.send_message(group_id, message)
             elif choice == '5': # Get messages
                 group_id = input("Enter group ID to get messages from: ")
-                timestamp = input("Enter timestamp (leave empty for all messages): ")
-                timestamp = float(timestamp) if timestamp else 0
-                self.get_messages(group_id, timestamp)
-            elif choice == '6':
+                timestamp = input("Enter timestamp (leave empty for all messages, 'new' for messages since the last fetch): ")
+                if timestamp == 'new':
+                    self.get_new_messages(group_id)
+                else:
+                    timestamp = float(timestamp) if timestamp else 0
+                    self.get_messages(group_id, timestamp)
+            elif choice == '6': # Subscribe to live messages
+                group_id = input("Enter group ID to subscribe to: ")
+                self.subscribe(group_id)
+            elif choice == '7': # Unsubscribe from live messages
+                group_id = input("Enter group ID to unsubscribe from: ")
+                self.unsubscribe(group_id)
+            elif choice == '8':
                 print("Exiting the application.")
                 break
             else:
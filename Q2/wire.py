@@ -0,0 +1,60 @@
+'''
+Framing of the chat protocol's requests and replies.
+A connection starts out with plain JSON: one frame, as sent by send_json.
+The client then offers its formats in a "hello" request, and from the reply
+on both sides send two frames, the format's name and the encoded message.
+Peers that do not know "hello" reply without a format and the connection
+stays on plain JSON.
+'''
+
+import json
+
+try:
+    import msgpack
+except ImportError:  # Only JSON is offered without it
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+FORMATS = [MSGPACK, JSON] if msgpack is not None else [JSON]  # Formats this side can use, preferred first
+
+def encode(message, fmt=None):
+    '''
+    Return the frames for a message in a negotiated format, or plain JSON if fmt is None.
+    '''
+    if fmt == MSGPACK:
+        return [b"msgpack", msgpack.packb(message, use_bin_type=True)]
+    payload = json.dumps(message).encode()
+    return [payload] if fmt is None else [b"json", payload]
+
+def decode(frames):
+    '''
+    Return (message, format) for received frames; the format is None for plain JSON.
+    '''
+    if len(frames) == 1:
+        return json.loads(frames[0]), None
+    tag, payload = frames
+    if tag == b"msgpack" and msgpack is not None:
+        return msgpack.unpackb(payload, raw=False), MSGPACK
+    if tag == b"json":
+        return json.loads(payload), JSON
+    raise ValueError(f"Unknown message format {tag!r}")
+
+def choose(offered):
+    '''
+    Pick the format for a connection from those a client offered.
+    '''
+    for fmt in FORMATS:
+        if fmt in offered:
+            return fmt
+    return JSON
+
+def negotiate(socket, request):
+    '''
+    Send a hello request (a dict with "action": "hello") on a fresh REQ socket
+    and return the format the peer chose, or None to stay on plain JSON.
+    '''
+    socket.send_multipart(encode(dict(request, formats=FORMATS)))
+    reply, _ = decode(socket.recv_multipart())
+    fmt = reply.get("format")
+    return fmt if fmt in FORMATS else None
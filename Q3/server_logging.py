@@ -0,0 +1,59 @@
+'''
+Leveled logging for the servers, written to stdout by a background thread.
+Q1, Q2 and Q3 are each installed and run from their own directory, so each
+keeps an identical copy of this file. Change all three together.
+'''
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s - %(message)s"
+
+class SamplingFilter(logging.Filter):
+    '''
+    Let through only a fraction of records below WARNING; warnings and errors always pass.
+    '''
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the listener thread.
+    The stock handler formats every record in the calling thread; callers here
+    only pass immutable arguments, so the record can be queued as is.
+    '''
+    def prepare(self, record):
+        return record
+
+def setup_logging(level=None, sample_rate=None):
+    '''
+    Send all log records through a queue to a background thread that writes them to stdout,
+    so logging never blocks a request on the stdout lock.
+    level and sample_rate default to the LOG_LEVEL and LOG_SAMPLE_RATE environment variables.
+    '''
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    sample_rate = float(sample_rate if sample_rate is not None else os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.handlers = [handler]
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)  # Flush whatever is still queued on exit
+    return listener
@@ -1,6 +1,10 @@
 import pika
 import json
+import logging
 import threading
+from server_logging import setup_logging
+
+log = logging.getLogger("youtube_server")
 
 class YoutubeServer:
     
@@ -29,13 +33,13 @@ class YoutubeServer:
             if 'subscribe' in request:
                 self.update_subscription(username, request['youtuber'], request['subscribe'])
                 action = 'subscribed' if request['subscribe'] else 'unsubscribed'
-                print(f"{username} {action} to {request['youtuber']}")
+                log.info("%s %s to %s", username, action, request['youtuber'])
             else:
-                print(f"{username} logged in")
+                log.info("%s logged in", username)
                 self.send_notifications(username)
 
         channel.basic_consume(queue='user_requests', on_message_callback=callback, auto_ack=True)
-        print("Consuming user requests...")
+        log.info("Consuming user requests...")
         try:
             channel.start_consuming()
         finally:
@@ -54,11 +58,11 @@ class YoutubeServer:
             video_info = json.loads(body)
             youtuber = video_info['youtuber']
             video_name = video_info['videoName']
-            print(f"{youtuber} uploaded {video_name}")
+            log.info("%s uploaded %s", youtuber, video_name)
             self.notify_users(youtuber, video_name)
 
         channel.basic_consume(queue='youtuber_uploads', on_message_callback=callback, auto_ack=True)
-        print("Consuming youtuber requests...")
+        log.info("Consuming youtuber requests...")
         try:
             channel.start_consuming()
         finally:
@@ -87,7 +91,7 @@ class YoutubeServer:
                 
                 # Publish the notification to the user's queue
                 channel.basic_publish(exchange='', routing_key=user, body=notification)
-                print(f"Notification sent to {user}: {notification}")
+                log.info("Notification sent to %s: %s", user, notification)
                 
                 connection.close()  # Close the connection after publishing
 
@@ -103,7 +107,7 @@ class YoutubeServer:
         notifications = self.notifications.get(user, [])
         for notification in notifications:
             channel.basic_publish(exchange='', routing_key=user, body=notification)
-            print(f"Notification sent to {user}: {notification}")
+            log.info("Notification sent to %s: %s", user, notification)
         
         self.notifications[user] = []  # Clear notifications after sending
         connection.close()
@@ -122,6 +126,7 @@ class YoutubeServer:
         youtuber_thread.join()
 
 if __name__ == '__main__':
+    setup_logging()
     server = YoutubeServer()
     server.start()
 